@@ -1,10 +1,14 @@
 import argparse 
 import logging
+import time
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+start = time.time()
 from utils_gradio import build_demo
-
-logging.basicConfig(level=logging.INFO)
+from utils_backend import configure_threads
+logger.info(f"Startup phase import: {time.time() - start:.2f}s")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -23,15 +27,97 @@ if __name__ == "__main__":
                         help="Whether to load the model in 4bit")
     parser.add_argument("--load_8bit", action="store_true",
                         help="Whether to load the model in 8bit")
+    parser.add_argument("--api", action="store_true",
+                        help="Also serve the JSON / binary saliency API under /api/v1 next to the UI")
+    parser.add_argument("--api_only", action="store_true",
+                        help="Serve the saliency API without the UI")
+    parser.add_argument("--quantize", type=str, default="none", choices=["none", "int8-weight-only", "int8-dynamic"],
+                        help="Cpu int8 weights for the language model linears (the query / key projections and lm head stay in float), an alternative to --load_8bit / --load_4bit")
+    parser.add_argument("--quantize_qk", action="store_true",
+                        help="Also quantize the query / key projections, the captured attention is less exact")
+    parser.add_argument("--quantize_cache_dir", type=str, default=None,
+                        help="Directory of the cached quantized weights (default: ~/.cache/lvlm-interpret/quantized)")
+    parser.add_argument("--backend", type=str, default="default", choices=["default", "cpu-optimized"],
+                        help="cpu-optimized: IPEX weight prepacking (or torch.compile of the MLPs), bf16 autocast on cpus with native bf16, float32 otherwise")
+    parser.add_argument("--benchmark_backend", action="store_true",
+                        help="Report the decode tokens/s of the cpu-optimized backend against the eager model at startup")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="Intra-op threads (default: torch default, or one per pinned core)")
+    parser.add_argument("--num_interop_threads", type=int, default=None,
+                        help="Inter-op threads")
+    parser.add_argument("--pin_cores", type=str, default=None,
+                        help="Pin the server (and model workers, a slice each) to these cores, e.g. '0-27'")
+    parser.add_argument("--offload_attention", action="store_true",
+                        help="Keep the attention and saved tensors of the relevancy replay in pinned host memory, paged back per layer (cuda)")
+    parser.add_argument("--no_warmup", action="store_true",
+                        help="Skip the warmup forward pass on a blank image after loading the model")
+    parser.add_argument("--vision_cache_mb", type=float, default=1024,
+                        help="Memory for cached pixel values and image features of repeated images (0 disables the cache, the relevancy replay always runs the vision tower)")
+    parser.add_argument("--vision_cache_dir", type=str, default=None,
+                        help="Directory of an on-disk image feature cache that survives restarts")
+    parser.add_argument("--prefix_cache_mb", type=float, default=0,
+                        help="Memory for key / value caches of prompt prefixes reused by later questions and turns on the same image (0 disables)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the answer token by token with a live image attention heatmap")
+    parser.add_argument("--max_batch", type=int, default=1,
+                        help="Coalesce up to this many concurrent queries into one batched generate call (1 disables batching)")
+    parser.add_argument("--max_wait", type=float, default=0.05,
+                        help="Seconds a query waits for others to join its batch")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Serve queries with this many model worker processes spawned after loading, sharing memory-mapped weights (cpu only, 0 or 1 disables)")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        help="Intra-op threads of every model worker (default: cores / workers)")
+    parser.add_argument("--capture_layers", type=str, default="all",
+                        help="Language model layers whose attention is captured, e.g. 'all' or '0-7,31'")
+    parser.add_argument("--capture_heads", type=str, default="all",
+                        help="Attention heads that are captured, e.g. 'all' or '0-15'")
+    parser.add_argument("--capture_rows", type=str, default="all", choices=["all", "last"],
+                        help="Capture all query rows or only the last one of every generation step")
+    parser.add_argument("--capture_keys", type=str, default="all",
+                        help="Key ranges that are captured: 'all' or a comma separated subset of prompt,image,text")
+    parser.add_argument("--capture_dtype", type=str, default=None, choices=["bfloat16", "float16", "float32"],
+                        help="Storage dtype of the captured attention (default: model dtype)")
+    parser.add_argument("--capture_mode", type=str, default="attentions", choices=["attentions", "summary"],
+                        help="Keep the attention tensors or only per step statistics reduced in the hooks (constant memory, Mean Token tabs only)")
+    parser.add_argument("--attention_source", type=str, default="generate", choices=["generate", "replay"],
+                        help="Read the full attention of the causality, rollout and flow tabs from the decoding capture, or from one teacher-forced forward over prompt + answer after every query")
+    parser.add_argument("--attn_encoding", type=str, default="dense", choices=["dense", "q8", "csr", "csr-q8"],
+                        help="Encoding of the saved attention: dense, per row scaled uint8 (q8), top-p sparse (csr) or both (csr-q8)")
+    parser.add_argument("--attn_top_p", type=float, default=0.99,
+                        help="Fraction of the attention mass of every row kept by the csr encodings")
+    parser.add_argument("--attn_max_error", type=float, default=None,
+                        help="Bound on the absolute error of the compact encodings (default: unbounded)")
+    parser.add_argument("--artifact_dir", type=str, default=None,
+                        help="Directory of the per query artifacts (default: $TMPDIR/lvlm-interpret)")
+    parser.add_argument("--artifact_quota_gb", type=float, default=20,
+                        help="Disk quota of the artifacts, least recently used queries are deleted beyond it")
+    parser.add_argument("--artifact_max_age_hours", type=float, default=24,
+                        help="Delete artifacts of queries not accessed for this many hours")
+    parser.add_argument("--artifact_writers", type=int, default=2,
+                        help="Number of background threads writing the artifacts of a query")
     args = parser.parse_args()
 
     assert not( args.load_4bit and args.load_8bit), "Cannot load both 4bit and 8bit models"
+    assert args.quantize == 'none' or not (args.load_4bit or args.load_8bit), "--quantize replaces --load_4bit / --load_8bit"
+    configure_threads(args.num_threads, args.num_interop_threads, args.pin_cores)
+
+    if args.api or args.api_only:
+        import uvicorn
+        from utils_api import create_app
 
-    demo = build_demo(args, embed_mode=False)
-    demo.queue(max_size=5)
-    demo.launch(
-        server_name=args.host,
-        server_port=args.port,
-        share=args.share,
-        debug=True
-    )
+        demo = None
+        if not args.api_only:
+            demo = build_demo(args, embed_mode=False)
+            demo.queue(max_size=max(5, 2 * args.max_batch, 2 * args.num_workers))
+        if args.share:
+            logger.warning("--share is not supported with the API, serving locally")
+        uvicorn.run(create_app(args, demo), host=args.host, port=args.port)
+    else:
+        demo = build_demo(args, embed_mode=False)
+        demo.queue(max_size=max(5, 2 * args.max_batch, 2 * args.num_workers))
+        demo.launch(
+            server_name=args.host,
+            server_port=args.port,
+            share=args.share,
+            debug=True
+        )
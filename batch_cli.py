@@ -0,0 +1,251 @@
+import os
+import csv
+import json
+import time
+import argparse
+import logging
+import multiprocessing
+from contextlib import ExitStack
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the post-processing processes are spawned, heavy imports (gradio, transformers) stay in `run`
+from utils_analytics import ANALYTICS, analyze_query
+
+
+def read_manifest(path):
+    '''
+        (image, question) pairs of a .jsonl or .csv manifest with the columns `image`, `question`
+        and optionally `id`. Image paths are relative to the manifest.
+    '''
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            items = list(csv.DictReader(f))
+        else:
+            items = [json.loads(line) for line in f if line.strip()]
+    root = os.path.dirname(os.path.abspath(path))
+    for i, item in enumerate(items):
+        item['id'] = str(item.get('id') or i)
+        item['image'] = os.path.join(root, item['image'])
+    return items
+
+
+class ShardWriter:
+    '''
+        Rows written as `<prefix>-<n>.parquet` shards of `shard_size` rows (None: only on `flush`), a crash loses
+        the rows of one shard at most. Shards are numbered after the ones already in `output_dir`.
+    '''
+    def __init__(self, output_dir, prefix, shard_size):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.rows = []
+        numbers = [-1]
+        for f in os.listdir(output_dir):
+            if f.startswith(prefix + '-') and f.endswith('.parquet.tmp'):
+                # a shard the last run did not finish writing
+                os.remove(os.path.join(output_dir, f))
+            elif f.startswith(prefix + '-') and f.endswith('.parquet'):
+                numbers.append(int(f[len(prefix) + 1:-len('.parquet')]))
+        self.num_shards = max(numbers) + 1
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if self.shard_size is not None and len(self.rows) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+        if not self.rows:
+            return
+        fn_shard = os.path.join(self.output_dir, f'{self.prefix}-{self.num_shards:05d}.parquet')
+        pd.DataFrame(self.rows).to_parquet(fn_shard + '.tmp', index=False)
+        os.replace(fn_shard + '.tmp', fn_shard)
+        logger.info(f"Wrote {len(self.rows)} rows to {fn_shard}")
+        self.num_shards += 1
+        self.rows = []
+
+    def written_ids(self):
+        '''Ids of the rows in the shards on disk.'''
+        import pandas as pd
+        ids = set()
+        for f in sorted(os.listdir(self.output_dir)):
+            if f.startswith(self.prefix + '-') and f.endswith('.parquet'):
+                ids.update(pd.read_parquet(os.path.join(self.output_dir, f), columns=['id'])['id'].astype(str))
+        return ids
+
+
+def _init_post_worker():
+    import torch
+    # one thread per process, the pool size sets the parallelism
+    torch.set_num_threads(1)
+
+
+def run(args):
+    from PIL import Image
+    import utils_gradio
+    from utils_model import get_processor_model
+    from utils_artifacts import artifact_store
+    from utils_backend import configure_threads
+
+    analytics = [a.strip() for a in args.analytics.split(',') if a.strip()]
+    for name in analytics:
+        assert name in ANALYTICS, f"Unknown analytics {name}, choose from {ANALYTICS}"
+    relevancy_types = tuple(t.strip() for t in args.relevancy_types.split(',') if t.strip())
+    heatmap_dir = os.path.join(args.output_dir, 'heatmaps')
+    os.makedirs(heatmap_dir, exist_ok=True)
+    records = ShardWriter(args.output_dir, 'records', args.shard_size)
+    # flushed with the records, a query is done once its record is in a shard
+    tokens = ShardWriter(args.output_dir, 'tokens', None)
+
+    items = read_manifest(args.manifest)
+    if args.resume:
+        # the heatmaps of queries whose rows were still buffered are computed again
+        done = records.written_ids()
+        items = [item for item in items if item['id'] not in done]
+    logger.info(f"{len(items)} queries to run from {args.manifest}")
+
+    configure_threads(args.num_threads, pin_cores=args.pin_cores)
+    processor, model = get_processor_model(args)
+    utils_gradio.configure(args)
+    utils_gradio.on_model_loaded(args, processor, model)
+
+    post_pool = ProcessPoolExecutor(max_workers=args.post_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_post_worker)
+    # queries whose artifacts are being written: (query, write done, pin), then post-processed
+    writing, running = [], {}
+
+    def dispatch_written():
+        for entry in [e for e in writing if e[1].done()]:
+            writing.remove(entry)
+            query, _, pin = entry
+            future = post_pool.submit(analyze_query, query, analytics, heatmap_dir)
+            running[future] = (query, pin)
+
+    def collect(block):
+        if not running:
+            return
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED) if block else (
+            [f for f in running if f.done()], None)
+        for future in finished:
+            query, pin = running.pop(future)
+            pin.close()
+            try:
+                record, token_rows = future.result()
+            except Exception:
+                logger.exception(f"Post-processing {query['id']} failed")
+                continue
+            tokens.add(token_rows)
+            if len(records.rows) + 1 >= records.shard_size:
+                # the token rows first, a query with a record in a shard has all its rows written
+                tokens.flush()
+            records.add([record])
+            if not args.keep_artifacts:
+                artifact_store.delete(query['attention_key'])
+
+    start = time.time()
+    for n, item in enumerate(items):
+        gen_start = time.time()
+        try:
+            image = Image.open(item['image']).convert('RGB')
+            state = utils_gradio.add_text(None, item['question'], image, args.image_process_mode)[0]
+            state, _ = utils_gradio.lvlm_bot(state, args.temperature, args.top_p, args.max_new_tokens, args.capture_spec)
+            if 'relevancy' in analytics:
+                utils_gradio.ensure_relevancy(state, relevancy_types)
+        except Exception:
+            logger.exception(f"Generation of {item['id']} failed")
+            continue
+        query = dict(
+            id=item['id'], image=item['image'], question=item['question'], answer=state.messages[-1][-1],
+            num_tokens=len(state.output_ids_decoded), gen_seconds=time.time() - gen_start,
+            attention_key=state.attention_key, image_idx=state.image_idx, output_ids_decoded=state.output_ids_decoded,
+            relevancy_types=relevancy_types,
+        )
+        # pinned until post-processed, the quota cannot delete them under the pool
+        pin = ExitStack()
+        pin.enter_context(artifact_store.reading(state.attention_key))
+        written = Future()
+        artifact_store.when_written(state.attention_key, written.set_result)
+        writing.append((query, written, pin))
+
+        dispatch_written()
+        collect(block=False)
+        # bounded backlog: generation only waits when post-processing falls behind
+        while len(running) + len(writing) > 2 * args.post_workers:
+            collect(block=bool(running))
+            dispatch_written()
+            if not running and writing:
+                writing[0][1].result()
+        if (n + 1) % 10 == 0:
+            elapsed = time.time() - start
+            logger.info(f"{n + 1}/{len(items)} queries in {elapsed:.0f}s ({(n + 1) / elapsed:.2f} queries/s)")
+
+    while writing or running:
+        if writing and not running:
+            writing[0][1].result()
+        dispatch_written()
+        collect(block=True)
+    post_pool.shutdown()
+    tokens.flush()
+    records.flush()
+    logger.info(f"Done: {len(items)} queries in {time.time() - start:.0f}s, outputs in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a manifest of (image, question) pairs through generation and the analytics, without the UI")
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="A .jsonl or .csv file with the columns image, question and optionally id")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Directory of the Parquet summaries (records-*.parquet, tokens-*.parquet) and the NPZ heatmaps")
+    parser.add_argument("--model_name_or_path", type=str, default="Intel/llava-gemma-2b",
+                        help="Model name or path to load the model from")
+    parser.add_argument("--load_4bit", action="store_true",
+                        help="Whether to load the model in 4bit")
+    parser.add_argument("--load_8bit", action="store_true",
+                        help="Whether to load the model in 8bit")
+    parser.add_argument("--quantize", type=str, default="none", choices=["none", "int8-weight-only", "int8-dynamic"],
+                        help="Cpu int8 weights for the language model linears, cached on disk after the first run")
+    parser.add_argument("--offload_attention", action="store_true",
+                        help="Keep the attention and saved tensors of the relevancy replay in pinned host memory, paged back per layer (cuda)")
+    parser.add_argument("--backend", type=str, default="default", choices=["default", "cpu-optimized"],
+                        help="cpu-optimized: IPEX weight prepacking (or torch.compile of the MLPs) and bf16 autocast where supported")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="Intra-op threads of the model (default: torch default, or one per pinned core)")
+    parser.add_argument("--pin_cores", type=str, default=None,
+                        help="Pin the model process to these cores, e.g. '0-27'")
+    parser.add_argument("--analytics", type=str, default="cube,rollout",
+                        help=f"Comma separated analytics to compute, from {','.join(ANALYTICS)} (relevancy replays every query with grad)")
+    parser.add_argument("--relevancy_types", type=str, default="llama",
+                        help="Comma separated relevancy maps of the relevancy analytics, from llama,vit,all,all_v2")
+    parser.add_argument("--temperature", type=float, default=0.0,
+                        help="Sampling temperature (0 decodes greedily)")
+    parser.add_argument("--top_p", type=float, default=1.0,
+                        help="Top-p of the sampling")
+    parser.add_argument("--max_new_tokens", type=int, default=64,
+                        help="Maximum number of generated tokens per query")
+    parser.add_argument("--image_process_mode", type=str, default="Default", choices=["Crop", "Resize", "Pad", "Default"],
+                        help="Preprocessing of non-square images")
+    parser.add_argument("--capture_spec", type=str, default=None,
+                        help="Attention capture policy of every query, e.g. 'rows=all;dtype=float16' (the rollout needs rows=all)")
+    parser.add_argument("--attn_encoding", type=str, default="dense", choices=["dense", "q8", "csr", "csr-q8"],
+                        help="Encoding of the saved attention")
+    parser.add_argument("--vision_cache_mb", type=float, default=1024,
+                        help="Memory for cached pixel values and image features of repeated images (0 disables the cache, the relevancy replay always runs the vision tower)")
+    parser.add_argument("--prefix_cache_mb", type=float, default=0,
+                        help="Memory for key / value caches of prompt prefixes shared by questions on the same image (0 disables)")
+    parser.add_argument("--post_workers", type=int, default=max(os.cpu_count() // 4, 1),
+                        help="Processes computing the analytics while the model generates")
+    parser.add_argument("--shard_size", type=int, default=1000,
+                        help="Queries per Parquet shard")
+    parser.add_argument("--artifact_dir", type=str, default=None,
+                        help="Directory of the per query artifacts (default: $TMPDIR/lvlm-interpret)")
+    parser.add_argument("--keep_artifacts", action="store_true",
+                        help="Keep the attention artifacts of every query until exit instead of deleting them once analysed")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the queries whose records are already in the Parquet shards of the output directory")
+    args = parser.parse_args()
+
+    assert not( args.load_4bit and args.load_8bit), "Cannot load both 4bit and 8bit models"
+    run(args)
@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+
+import numpy as np
+import torch
+
+from utils_cache import load_attentions, load_full_attention, load_relevancy
+from utils_cube import load_attention_cube
+from utils_summary import load_attention_summary
+
+logger = logging.getLogger(__name__)
+
+NUM_IMAGE_TOKENS = 576
+GRID = 24
+ANALYTICS = ('cube', 'rollout', 'relevancy')
+separators_list = ['.',',','?','!', ':', ';', '</s>', '/', '!', '(', ')', '[', ']', '{', '}', '<', '>', '|', '\\', '-', '_', '+', '=', '*', '&', '^', '%', '$', '#', '@', '!', '~', '`', ' ', '\t', '\n', '\r', '\x0b', '\x0c']
+
+
+def rollout_map(attn, img_idx, fusion_method='min', cls_idx=0, discard_ratio=0.0, start_roll=0):
+    '''
+        Attention rollout over the prompt + image block of the per layer (1, heads, q, k) attention
+        `attn` (the rows of the prompt are needed). Returns the (576, 576) rollout between the patches.
+    '''
+    import einops
+
+    size = cls_idx + img_idx + NUM_IMAGE_TOKENS
+    I = torch.eye(size)
+    roll_map = torch.eye(size)
+    for layer_idx in range(start_roll, len(attn)):
+        # only the prompt + image block is read from the archive
+        layer_map = attn[layer_idx][0, :, cls_idx:size, cls_idx:size]
+        fused_map = einops.reduce(layer_map, "h q k -> q k", fusion_method).float()
+
+        _, indices = fused_map.topk(int(fused_map.size(-1)*discard_ratio), -1, False)
+        fused_map[0, indices] = 0
+
+        roll_map = roll_map @ (fused_map+I)/2
+        # this makes a lower triangular matrix (use sum dim as 1)
+        roll_map = roll_map/roll_map.sum(dim=-1,keepdim=True)
+    return roll_map[img_idx:img_idx+NUM_IMAGE_TOKENS, img_idx:img_idx+NUM_IMAGE_TOKENS]
+
+
+def word_relevancy(tokens, rows, by_token=False):
+    '''
+        Relevancy maps by word of the per token (1, N) relevancy rows (None for the tokens without one). A word
+        starts at a token beginning with '▁' or at a separator. Its map is the last row of the average of its
+        tokens' zero padded maps, as the full maps were averaged: the rows with the keys of the last token, summed
+        and divided by the number of tokens. The llama rows grow by a key per token, so that is the last token's
+        row only, the ViT rows all have the same keys and are averaged. `by_token` keeps the row of every token,
+        repeated tokens get a '_'.
+    '''
+    word_rel_map = {}
+    if by_token:
+        for token, row in zip(tokens, rows):
+            if row is not None:
+                word_rel_map[token + '_' if token in word_rel_map else token] = row.float()
+        return word_rel_map
+
+    def store(word, word_rows):
+        if word_rows:
+            size = max(row.shape[-1] for row in word_rows)
+            word_rel_map[word] = sum(row.float() for row in word_rows if row.shape[-1] == size) / len(word_rows)
+
+    word, word_rows = None, []
+    for i, (token, row) in enumerate(zip(tokens, rows)):
+        if i == 0 or token.startswith('▁') or token in separators_list:
+            if word is not None:
+                store(word, word_rows)
+            word, word_rows = token, []
+        else:
+            word += token
+        if row is not None:
+            word_rows.append(row)
+    if word is not None:
+        store(word, word_rows)
+    return word_rel_map
+
+
+def relevancy_rows(word_rel_map, img_idx):
+    '''(words, (n, 24, 24) image relevancy) of the last row of every word map, as the Relevancy tab draws them.'''
+    words, rows = [], []
+    for word, rel_map in word_rel_map.items():
+        if word in separators_list:
+            continue
+        if rel_map.shape[-1] == NUM_IMAGE_TOKENS + 1:
+            row = rel_map[0, 1:]
+        else:
+            row = rel_map[-1, img_idx:img_idx+NUM_IMAGE_TOKENS]
+        words.append(word.strip('▁').strip('_'))
+        rows.append(row.float().cpu().numpy().reshape(GRID, GRID))
+    if not rows:
+        return words, np.zeros((0, GRID, GRID), dtype=np.float32)
+    return words, np.stack(rows)
+
+
+def _image_attention(attention_key, img_idx):
+    '''Per token (tokens, 24, 24) image attention and image / question mass, mean over layers and heads.'''
+    summary = load_attention_summary(attention_key)
+    if summary is not None:
+        # summary captures only keep the running image sum and per step masses
+        num_tokens = int(summary['num_tokens'])
+        heatmap = summary['image_sum'].mean((0, 1)) / max(num_tokens, 1)
+        return (None, heatmap.reshape(GRID, GRID),
+                summary['image_mass'].mean((1, 2)), summary['question_mass'].mean((1, 2)))
+    image = load_attention_cube(attention_key, 'image', img_idx)
+    question = load_attention_cube(attention_key, 'question', img_idx)
+    if image is None:
+        return None, None, None, None
+    per_token = image.astype(np.float32).mean((1, 2))
+    return (per_token.reshape(-1, GRID, GRID), per_token.mean(0).reshape(GRID, GRID),
+            per_token.sum(-1), question.astype(np.float32).mean((1, 2)).sum(-1))
+
+
+def analyze_query(query, analytics, heatmap_dir):
+    '''
+        Post-processing of one generated query, runs in a process of the batch_cli pool: reads the
+        artifacts of `query['attention_key']`, writes the heatmaps to `<heatmap_dir>/<id>.npz` and
+        returns (record row, token rows) of scalar summaries. Nothing is plotted.
+    '''
+    start = time.time()
+    key, img_idx, tokens = query['attention_key'], query['image_idx'], query['output_ids_decoded']
+    record = dict((k, v) for k, v in query.items() if k not in ('attention_key', 'output_ids_decoded', 'relevancy_types'))
+    token_rows = [{'id': query['id'], 'token_idx': i, 'token': token} for i, token in enumerate(tokens)]
+    heatmaps = {}
+
+    if 'cube' in analytics:
+        per_token, mean_map, image_mass, question_mass = _image_attention(key, img_idx)
+        if mean_map is not None:
+            heatmaps['image_attention_mean'] = mean_map.astype(np.float32)
+            record['top_patch'] = int(mean_map.argmax())
+            record['image_mass_mean'] = float(np.mean(image_mass))
+            record['question_mass_mean'] = float(np.mean(question_mass))
+            for i, row in enumerate(token_rows[:len(image_mass)]):
+                row['image_mass'] = float(image_mass[i])
+                row['question_mass'] = float(question_mass[i])
+        if per_token is not None:
+            heatmaps['image_attention'] = per_token.astype(np.float16)
+            for i, row in enumerate(token_rows[:len(per_token)]):
+                row['top_patch'] = int(per_token[i].argmax())
+
+    if 'rollout' in analytics:
+        attentions = load_attentions(key)
+        attn = load_full_attention(key) or (attentions[0] if attentions is not None else None)
+        if attn is not None and attn[0].shape[2] >= img_idx + NUM_IMAGE_TOKENS:
+            diag = torch.diag(rollout_map(attn, img_idx)).view(GRID, GRID)
+            heatmaps['rollout'] = (diag / diag.max()).numpy().astype(np.float32)
+            record['rollout_top_patch'] = int(diag.argmax())
+        else:
+            logger.warning(f"No prompt rows for the rollout of {query['id']}, capture them with rows=all")
+
+    if 'relevancy' in analytics:
+        for name in query.get('relevancy_types', ('llama',)):
+            word_rel_map = word_relevancy(tokens, load_relevancy(key, name, range(len(tokens))))
+            words, rows = relevancy_rows(word_rel_map, img_idx)
+            heatmaps[f'relevancy_{name}'] = rows
+            heatmaps[f'relevancy_{name}_words'] = np.array(words)
+            if len(rows):
+                record[f'relevancy_{name}_top_patch'] = int(rows.mean(0).argmax())
+
+    fn_heatmaps = os.path.join(heatmap_dir, f"{query['id']}.npz")
+    np.savez_compressed(fn_heatmaps + '.tmp.npz', **heatmaps)
+    os.replace(fn_heatmaps + '.tmp.npz', fn_heatmaps)
+    record['heatmaps'] = os.path.basename(fn_heatmaps)
+    record['post_seconds'] = time.time() - start
+    return record, token_rows
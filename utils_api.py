@@ -0,0 +1,244 @@
+import io
+import json
+import base64
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import gradio as gr
+from PIL import Image
+from fastapi import APIRouter, FastAPI, File, Form, HTTPException, Query, UploadFile
+from fastapi.responses import Response
+
+import utils_gradio
+from utils_analytics import GRID, NUM_IMAGE_TOKENS, relevancy_rows, rollout_map, word_relevancy
+from utils_artifacts import artifact_store, holds_artifacts
+from utils_cache import load_attentions, load_full_attention, load_relevancy
+from utils_capture import parse_index_list
+from utils_relevancy import RELEVANCY_TYPES
+from utils_cube import load_attention_cube
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/api/v1'
+FORMATS = ('json', 'base64', 'npy')
+DTYPES = ('float16', 'float32')
+MAX_QUERIES = 1024
+
+
+class QueryRegistry:
+    '''Session state of the queries made through the API by request id, the oldest are forgotten beyond `max_queries`.'''
+    def __init__(self, max_queries=MAX_QUERIES):
+        self.max_queries = max_queries
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, state):
+        request_id = state.attention_key.rsplit('/', 1)[-1]
+        with self._lock:
+            self._states[request_id] = state
+            while len(self._states) > self.max_queries:
+                _, evicted = self._states.popitem(last=False)
+                artifact_store.delete(evicted.attention_key)
+        return request_id
+
+    def get(self, request_id):
+        with self._lock:
+            state = self._states.get(request_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail=f"Unknown request id {request_id}")
+        return state
+
+    def pop(self, request_id):
+        with self._lock:
+            return self._states.pop(request_id, None)
+
+
+queries = QueryRegistry()
+
+
+def encode_array(array, fmt, dtype='float16', **meta):
+    '''
+        `array` as raw .npy bytes, or as JSON with its dtype, shape and the values either as nested
+        lists or base64 of the little endian buffer. `meta` goes into the JSON or into X- headers.
+    '''
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {fmt}, choose from {FORMATS}")
+    if dtype not in DTYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown dtype {dtype}, choose from {DTYPES}")
+    array = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<'))
+    if fmt == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, array)
+        headers = dict((f'X-{name.replace("_", "-").title()}', json.dumps(value)) for name, value in meta.items())
+        return Response(buffer.getvalue(), media_type='application/octet-stream', headers=headers)
+    data = base64.b64encode(array.tobytes()).decode() if fmt == 'base64' else array.tolist()
+    return dict(meta, dtype=array.dtype.name, shape=list(array.shape), data=data)
+
+
+def _select(array, axis, selection, name):
+    '''Index, average ('mean') or keep ('all') one axis, returns (array, kept axis name or None).'''
+    if selection == 'all':
+        return array, name
+    if selection == 'mean':
+        return array.mean(axis=axis, dtype=np.float32), None
+    try:
+        index = int(selection)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} is an index, 'mean' or 'all', not {selection}")
+    if not -array.shape[axis] <= index < array.shape[axis]:
+        raise HTTPException(status_code=400, detail=f"{name} {index} out of range ({array.shape[axis]})")
+    return np.take(array, index, axis=axis), None
+
+
+def _run(fn, *args):
+    '''Map the errors the UI handlers raise for users to HTTP errors.'''
+    try:
+        return fn(*args)
+    except gr.Error as e:
+        status = 503 if utils_gradio.model is None else 400
+        raise HTTPException(status_code=status, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@holds_artifacts
+def image_attention_view(state, token, layer, head):
+    cube = load_attention_cube(state.attention_key, 'image', state.image_idx)
+    if cube is None:
+        raise HTTPException(status_code=409, detail="No attention cube for this query (captured in summary mode?)")
+    selections = {'token': token, 'layer': layer, 'head': head}
+    array, axes = cube, ['token', 'layer', 'head']
+    # indices before means, only the selected part of the cube is read and converted to float32
+    for reduce_mean in (False, True):
+        for name in ('head', 'layer', 'token'):
+            selection = selections[name]
+            if selection == 'all' or (selection == 'mean') != reduce_mean:
+                continue
+            array, _ = _select(array, axes.index(name), selection, name)
+            axes.remove(name)
+    array = np.asarray(array, dtype=np.float32)
+    return array.reshape(array.shape[:-1] + (GRID, GRID)), axes + ['row', 'column']
+
+
+@holds_artifacts
+def rollout_view(state, fusion_method, start_layer):
+    attentions = load_attentions(state.attention_key)
+    attn = load_full_attention(state.attention_key) or (attentions[0] if attentions is not None else None)
+    if attn is None or attn[0].shape[2] < state.image_idx + NUM_IMAGE_TOKENS:
+        raise HTTPException(status_code=409, detail="The rollout needs every query row of the prompt, query with the capture policy rows=all")
+    diag = torch.diag(rollout_map(attn, state.image_idx, fusion_method, start_roll=start_layer)).view(GRID, GRID)
+    return (diag / diag.max()).numpy()
+
+
+@holds_artifacts
+def relevancy_view(state, type_selector, token_indices=None):
+    if type_selector not in RELEVANCY_TYPES:
+        raise HTTPException(status_code=404, detail=f"Unknown relevancy {type_selector}, choose from {RELEVANCY_TYPES}")
+    num_tokens = len(state.output_ids_decoded)
+    token_indices = range(num_tokens) if token_indices is None else token_indices
+    if any(not 0 <= t < num_tokens for t in token_indices):
+        raise HTTPException(status_code=400, detail=f"Token indices out of range ({num_tokens} generated tokens)")
+    utils_gradio.ensure_relevancy(state, (type_selector,), token_indices)
+    selected = set(token_indices)
+    rows = load_relevancy(state.attention_key, type_selector, range(num_tokens))
+    rows = [row if t in selected else None for t, row in enumerate(rows)]
+    return relevancy_rows(word_relevancy(state.output_ids_decoded, rows), state.image_idx)
+
+
+def create_router():
+    '''
+        JSON / binary saliency API next to (or instead of) the UI. A query returns the answer, its
+        tokens and a request id; the saliency views of the query are fetched by request id as
+        compact arrays (float16 by default) in the `format` the client asks for.
+    '''
+    router = APIRouter(prefix=API_PREFIX)
+
+    @router.get('/status')
+    def status():
+        pool = utils_gradio.worker_pool
+        return {
+            'ready': utils_gradio.model is not None,
+            'model': utils_gradio.model_status().strip('*'),
+            'workers': pool.stats() if pool is not None else None,
+            'artifacts': artifact_store.stats(),
+        }
+
+    @router.post('/query')
+    def query(image: UploadFile = File(...), question: str = Form(...), temperature: float = Form(0.0),
+              top_p: float = Form(1.0), max_new_tokens: int = Form(64), capture_spec: str = Form(''),
+              image_process_mode: str = Form('Default'), include_image_attention: bool = Form(False)):
+        try:
+            pil_image = Image.open(io.BytesIO(image.file.read())).convert('RGB')
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Cannot read the image: {e}")
+        state = _run(utils_gradio.add_text, None, question, pil_image, image_process_mode)[0]
+        state, _ = _run(utils_gradio.lvlm_bot_pooled, state, temperature, top_p, max_new_tokens, capture_spec)
+        request_id = queries.add(state)
+        response = {
+            'request_id': request_id,
+            'answer': state.messages[-1][-1],
+            'tokens': state.output_ids_decoded,
+            'input_tokens': state.input_text_tokenized,
+            'image_idx': state.image_idx,
+            'views': dict((view, f'{API_PREFIX}/query/{request_id}/{view}')
+                          for view in ('image_attention', 'rollout', 'relevancy')),
+        }
+        if include_image_attention:
+            # per token image attention, mean over layers and heads
+            array, axes = image_attention_view(state, 'all', 'mean', 'mean')
+            response['image_attention'] = encode_array(array, 'base64', axes=axes)
+        return response
+
+    @router.get('/query/{request_id}/image_attention')
+    def image_attention(request_id: str, token: str = 'all', layer: str = 'mean', head: str = 'mean',
+                        format: str = 'json', dtype: str = 'float16'):
+        '''Image attention of the last query row of every token, 24x24 per token / layer / head.'''
+        state = queries.get(request_id)
+        array, axes = image_attention_view(state, token, layer, head)
+        return encode_array(array, format, dtype, request_id=request_id, axes=axes)
+
+    @router.get('/query/{request_id}/rollout')
+    def rollout(request_id: str, fusion: str = Query('min', pattern='^(min|max|mean)$'), start_layer: int = 0,
+                format: str = 'json', dtype: str = 'float16'):
+        state = queries.get(request_id)
+        array = rollout_view(state, fusion, start_layer)
+        return encode_array(array, format, dtype, request_id=request_id, axes=['row', 'column'])
+
+    @router.get('/query/{request_id}/relevancy')
+    def relevancy(request_id: str, type: str = 'llama', tokens: str = 'all', format: str = 'json', dtype: str = 'float16'):
+        '''
+            Image relevancy of the words of the answer, of the generated `tokens` (e.g. '0-4,9') only when given.
+            Computed with grad on the first request of a type and token, stored for the later ones.
+        '''
+        state = queries.get(request_id)
+        try:
+            token_indices = parse_index_list(tokens)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"tokens is 'all' or an index list such as '0-4,9', not {tokens}")
+        words, array = _run(relevancy_view, state, type, token_indices)
+        return encode_array(array, format, dtype, request_id=request_id, words=words, axes=['word', 'row', 'column'])
+
+    @router.delete('/query/{request_id}')
+    def delete(request_id: str):
+        state = queries.pop(request_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail=f"Unknown request id {request_id}")
+        artifact_store.delete(state.attention_key)
+        return {'request_id': request_id, 'deleted': True}
+
+    return router
+
+
+def create_app(args, demo=None):
+    '''FastAPI app serving the API, with the Gradio UI `demo` mounted at / when given.'''
+    app = FastAPI(title="LVLM saliency API")
+    app.include_router(create_router())
+    if demo is None:
+        # no UI: load the model and apply the settings build_demo would have
+        utils_gradio.start_model_loader(args)
+        utils_gradio.configure(args)
+        return app
+    return gr.mount_gradio_app(app, demo, path='/')
@@ -0,0 +1,404 @@
+import os
+import json
+import logging
+
+import numpy as np
+import torch
+
+from utils_codec import decode_rows, decoded_dtype
+
+logger = logging.getLogger(__name__)
+
+# on-disk layout of an attention archive (one directory per query):
+#   <attention_key>_attn/index.json  small index, one entry per (generation step, layer)
+#   <attention_key>_attn/data.bin    raw array segments referenced by the index
+# the index is written last, so its presence marks a complete archive.
+# <attention_key>_full_attn holds a single step: the (batch, heads, N, N) attention over
+# prompt + answer of every layer, recomputed by one teacher-forced forward (utils_replay).
+ARCHIVE_SUFFIX = '_attn'
+FULL_ARCHIVE_SUFFIX = '_full_attn'
+INDEX_NAME = 'index.json'
+DATA_NAME = 'data.bin'
+ARCHIVE_VERSION = 1
+SEGMENT_ALIGN = 64
+
+# numpy has no bfloat16, the raw bits are stored as int16 and viewed back in torch
+_STORAGE_DTYPES = {
+    'bfloat16': (np.int16, torch.bfloat16),
+    'float16': (np.float16, torch.float16),
+    'float32': (np.float32, torch.float32),
+    'float64': (np.float64, torch.float64),
+    'uint8': (np.uint8, torch.uint8),
+    'int32': (np.int32, torch.int32),
+    'int64': (np.int64, torch.int64),
+}
+
+
+def archive_path(attention_key):
+    return attention_key + ARCHIVE_SUFFIX
+
+
+def full_archive_path(attention_key):
+    return attention_key + FULL_ARCHIVE_SUFFIX
+
+
+def _dtype_name(dtype):
+    return str(dtype).split('.')[-1]
+
+
+def _tensor_to_numpy(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        return tensor.view(torch.int16).numpy()
+    return tensor.numpy()
+
+
+def _numpy_to_tensor(array, dtype_name):
+    # copy out of the memory map so the returned tensor owns its memory
+    tensor = torch.from_numpy(np.array(array, copy=True))
+    if dtype_name == 'bfloat16':
+        tensor = tensor.view(torch.bfloat16)
+    return tensor
+
+
+class _SegmentWriter:
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def write(self, value, dtype_name=None):
+        if isinstance(value, torch.Tensor):
+            dtype_name = _dtype_name(value.dtype)
+            array = _tensor_to_numpy(value)
+        else:
+            array = np.ascontiguousarray(value)
+            dtype_name = dtype_name or array.dtype.name
+        pad = (-self.offset) % SEGMENT_ALIGN
+        if pad:
+            self.f.write(b'\0' * pad)
+            self.offset += pad
+        segment = {'offset': self.offset, 'dtype': dtype_name, 'shape': list(array.shape)}
+        self.f.write(array.tobytes())
+        self.offset += array.nbytes
+        return segment
+
+
+def write_attention_archive(path, attentions, capture=None, meta=None, encoding=None):
+    '''
+        Write `outputs.attentions` (a tuple over generation steps of tuples over layers
+        of (batch, heads, q, k) tensors) as an archive laid out per (step, layer).
+        If the attentions were reduced by an AttentionCapture, its layout is recorded
+        so readers see the blocks in full head / key coordinates again.
+        `encoding` (utils_codec.AttentionEncoding) selects a compact block encoding, dense by default.
+        Returns the index that was written.
+    '''
+    os.makedirs(path, exist_ok=True)
+    meta = dict(meta or {})
+    if capture is not None:
+        meta.update(capture.meta())
+    entries = []
+    raw_bytes = 0
+    max_abs_error = 0.0
+    with open(os.path.join(path, DATA_NAME), 'wb') as f:
+        writer = _SegmentWriter(f)
+        for step, layers in enumerate(attentions):
+            layout = capture.block_layout(step) if capture is not None else None
+            for layer, attn in enumerate(layers):
+                entry = {'step': step, 'layer': layer}
+                if attn is None and layout is None:
+                    entry['encoding'] = 'absent'
+                elif attn is None:
+                    # layer dropped by the capture policy, reads back as zeros
+                    entry['encoding'] = 'zeros'
+                    entry['shape'] = layout['full_shape']
+                    entry['dtype'] = capture.policy.dtype or 'float32'
+                else:
+                    if encoding is None:
+                        block_encoding, arrays, error = 'dense', {'data': attn}, 0.0
+                    else:
+                        block_encoding, arrays, error = encoding.encode(attn)
+                    entry['encoding'] = block_encoding
+                    entry['shape'] = list(attn.shape)
+                    entry['dtype'] = _dtype_name(attn.dtype)
+                    entry['segments'] = dict((name, writer.write(array)) for name, array in arrays.items())
+                    if block_encoding != 'dense':
+                        entry['max_error'] = error
+                    raw_bytes += attn.element_size() * attn.nelement()
+                    max_abs_error = max(max_abs_error, error)
+                    if layout is not None and (layout['heads'] is not None or layout['key_ranges'] is not None):
+                        entry.update(layout)
+                entries.append(entry)
+        data_bytes = writer.offset
+
+    if encoding is not None and not encoding.is_dense:
+        meta['encoding'] = {
+            'method': encoding.method,
+            'top_p': encoding.top_p,
+            'max_error_bound': encoding.max_error,
+            'raw_bytes': raw_bytes,
+            'compression_ratio': raw_bytes / max(data_bytes, 1),
+            'max_abs_error': max_abs_error,
+        }
+        logger.info(f"Attention encoding {encoding.to_string()}: {raw_bytes/2**20:.1f} MiB -> {data_bytes/2**20:.1f} MiB "
+                    f"({meta['encoding']['compression_ratio']:.1f}x), max abs error {max_abs_error:.2e}")
+
+    index = {
+        'version': ARCHIVE_VERSION,
+        'num_steps': len(attentions),
+        'num_layers': len(attentions[0]) if len(attentions) else 0,
+        'data_bytes': data_bytes,
+        'meta': meta,
+        'entries': entries,
+    }
+    fn_index = os.path.join(path, INDEX_NAME)
+    with open(fn_index + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(fn_index + '.tmp', fn_index)
+    logger.info(f"Attention archive written to {path} ({data_bytes/2**20:.1f} MiB, {len(entries)} blocks)")
+    return index
+
+
+def is_archive(path):
+    return os.path.exists(os.path.join(path, INDEX_NAME))
+
+
+def _index_key(idx):
+    '''Hashable form of a basic numpy-style index, None for fancy indexing.'''
+    if not isinstance(idx, tuple):
+        idx = (idx,)
+    key = []
+    for i in idx:
+        if isinstance(i, slice):
+            key.append(('slice', i.start, i.stop, i.step))
+        elif i is Ellipsis:
+            key.append('...')
+        elif isinstance(i, (int, np.integer)):
+            key.append(int(i))
+        else:
+            return None
+    return tuple(key)
+
+
+def _split_index(idx, ndim):
+    '''Split a numpy-style index into the index of the leading (row) dims and the last (key) dim.'''
+    if not isinstance(idx, tuple):
+        idx = (idx,)
+    if any(i is Ellipsis for i in idx):
+        pos = [i for i, v in enumerate(idx) if v is Ellipsis][0]
+        fill = (slice(None),) * (ndim - len(idx) + 1)
+        idx = idx[:pos] + fill + idx[pos+1:]
+    idx = idx + (slice(None),) * (ndim - len(idx))
+    return idx[:ndim-1], idx[ndim-1]
+
+
+class AttentionBlock:
+    '''
+        Lazy view of the attention of one (step, layer), shaped like the captured
+        (batch, heads, q, k) tensor. Indexing it numpy-style only pages in the
+        bytes of the selection and returns a torch tensor.
+        Heads and keys dropped by the capture policy read back as zeros, dropped
+        query rows are not expanded (q is the number of captured rows).
+        Compact encodings (see utils_codec) are decoded row by row on read.
+    '''
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+
+    @property
+    def shape(self):
+        return torch.Size(self.entry.get('full_shape', self.entry['shape']))
+
+    @property
+    def dtype(self):
+        return _STORAGE_DTYPES[self.entry['dtype']][1]
+
+    @property
+    def nbytes(self):
+        '''Bytes stored for the block.'''
+        segments = self.entry.get('segments', {}).values()
+        return sum(int(np.prod(s['shape'])) * np.dtype(_STORAGE_DTYPES[s['dtype']][0]).itemsize for s in segments)
+
+    @property
+    def is_reduced(self):
+        return 'full_shape' in self.entry
+
+    @property
+    def is_encoded(self):
+        return self.entry['encoding'] != 'dense'
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        cache = self.archive.cache
+        key = _index_key(idx)
+        if cache is None or key is None:
+            return self._read(idx)
+        cache_key = (self.archive.cache_key, self.archive.cache_tag, self.entry['step'], self.entry['layer'], key)
+        return cache.get(cache_key, lambda: self._read(idx))
+
+    def _read(self, idx):
+        entry = self.entry
+        if entry['encoding'] == 'zeros':
+            np_dtype = _STORAGE_DTYPES[entry['dtype']][0]
+            return _numpy_to_tensor(np.broadcast_to(np.zeros((), dtype=np_dtype), entry['shape'])[idx], entry['dtype'])
+        if not self.is_reduced and not self.is_encoded:
+            segment = entry['segments']['data']
+            return _numpy_to_tensor(self.archive._segment(segment)[idx], segment['dtype'])
+
+        lead_idx, key_idx = _split_index(idx, len(self.shape))
+        row_ids = self._row_ids()[lead_idx]
+        rows = self._decode_rows(row_ids.reshape(-1))
+        rows = rows.reshape(row_ids.shape + (self.shape[-1],))[..., key_idx]
+        tensor = _numpy_to_tensor(rows, decoded_dtype(entry['encoding'], entry['dtype']))
+        return tensor if tensor.dtype == self.dtype else tensor.to(self.dtype)
+
+    def _row_ids(self):
+        '''Stored row number of every (batch, head, q) of the full block, -1 for dropped heads.'''
+        batch_size, num_heads, q_len, _ = self.shape
+        stored_heads = self.entry['shape'][1]
+        heads = self.entry.get('heads') or list(range(num_heads))
+        head_pos = np.full(num_heads, -1, dtype=np.int64)
+        head_pos[heads] = np.arange(len(heads))
+        b = np.arange(batch_size).reshape(-1, 1, 1)
+        q = np.arange(q_len).reshape(1, 1, -1)
+        h = head_pos.reshape(1, -1, 1)
+        return np.where(h >= 0, (b * stored_heads + h) * q_len + q, -1)
+
+    def _decode_rows(self, row_ids):
+        '''(n,) stored row numbers -> (n, k) rows in full key coordinates.'''
+        entry = self.entry
+        segments = dict((name, self.archive._segment(s)) for name, s in entry['segments'].items())
+        valid = row_ids >= 0
+        values = decode_rows(entry['encoding'], segments, row_ids[valid], entry['shape'][-1])
+        rows = np.zeros((len(row_ids), self.shape[-1]), dtype=values.dtype)
+        if not valid.any():
+            return rows
+        key_ranges = entry.get('key_ranges')
+        if key_ranges is None:
+            rows[valid] = values
+        else:
+            cols = np.concatenate([np.arange(start, end) for start, end in key_ranges])
+            expanded = np.zeros((len(values), self.shape[-1]), dtype=values.dtype)
+            expanded[:, cols] = values
+            rows[valid] = expanded
+        return rows
+
+    def load(self):
+        return self[...]
+
+    def __repr__(self):
+        return f"AttentionBlock(step={self.entry['step']}, layer={self.entry['layer']}, shape={tuple(self.shape)}, dtype={self.dtype})"
+
+
+class ArchiveStep:
+    '''Sequence of the per-layer blocks of one generation step, `archive[step][layer]`.'''
+    def __init__(self, archive, step):
+        self.archive = archive
+        self.step = step
+
+    def __len__(self):
+        return self.archive.num_layers
+
+    def __getitem__(self, layer):
+        if isinstance(layer, slice):
+            return [self[i] for i in range(*layer.indices(len(self)))]
+        if layer < 0:
+            layer += len(self)
+        return self.archive.block(self.step, layer)
+
+    def __iter__(self):
+        for layer in range(len(self)):
+            yield self[layer]
+
+
+class AttentionArchive:
+    '''
+        Read side of an attention archive. Mimics the nested `outputs.attentions`
+        tuple (`archive[step][layer]`, `len(archive)`), also accepts `archive[step, layer]`.
+        The data file is memory-mapped, nothing is read until a block is sliced.
+        With a `cache` (see utils_cache.ArtifactCache) decoded slices are kept under `cache_key`
+        and `cache_tag`, which tells archives of the same query apart.
+    '''
+    def __init__(self, path, cache=None, cache_key=None, cache_tag='attn'):
+        self.path = path
+        self.cache = cache
+        self.cache_key = cache_key if cache_key is not None else path
+        self.cache_tag = cache_tag
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.num_steps = self.index['num_steps']
+        self.num_layers = self.index['num_layers']
+        self.meta = self.index.get('meta', {})
+        self._entries = dict(((e['step'], e['layer']), e) for e in self.index['entries'])
+        self._data = None
+
+    def _buffer(self):
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.path, DATA_NAME), dtype=np.uint8, mode='r')
+        return self._data
+
+    def _segment(self, segment):
+        np_dtype = _STORAGE_DTYPES[segment['dtype']][0]
+        count = int(np.prod(segment['shape']))
+        nbytes = count * np.dtype(np_dtype).itemsize
+        if nbytes == 0:
+            return np.zeros(segment['shape'], dtype=np_dtype)
+        offset = segment['offset']
+        return self._buffer()[offset:offset + nbytes].view(np_dtype).reshape(segment['shape'])
+
+    def block(self, step, layer):
+        if step < 0:
+            step += self.num_steps
+        entry = self._entries[(step, layer)]
+        if entry['encoding'] == 'absent':
+            return None
+        return AttentionBlock(self, entry)
+
+    def __len__(self):
+        return self.num_steps
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            step, layer = idx
+            return self.block(step, layer)
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx >= len(self):
+            raise IndexError(f"step {idx} out of range for archive with {len(self)} steps")
+        return ArchiveStep(self, idx)
+
+    def __iter__(self):
+        for step in range(len(self)):
+            yield self[step]
+
+    def __repr__(self):
+        return f"AttentionArchive({self.path!r}, steps={self.num_steps}, layers={self.num_layers})"
+
+
+def load_attentions(attention_key, cache=None):
+    '''
+        Open the attentions saved for `attention_key`. Prefers the archive and falls
+        back to the legacy monolithic `_attn.pt` pickle. Returns None if neither exists.
+    '''
+    path = archive_path(attention_key)
+    if is_archive(path):
+        return AttentionArchive(path, cache=cache, cache_key=attention_key)
+    fn_attention = attention_key + '_attn.pt'
+    if os.path.exists(fn_attention):
+        logger.info(f"Loading legacy attention file {fn_attention}")
+        return torch.load(fn_attention, weights_only=True, mmap=True)
+    return None
+
+
+def load_full_attention(attention_key, cache=None):
+    '''
+        Per layer (batch, heads, N, N) attention over prompt + answer (`full[layer]`) from the
+        replay archive of `attention_key`, None if the query was not replayed.
+    '''
+    path = full_archive_path(attention_key)
+    if not is_archive(path):
+        return None
+    return AttentionArchive(path, cache=cache, cache_key=attention_key, cache_tag='full_attn')[0]
@@ -0,0 +1,405 @@
+import os
+import glob
+import json
+import time
+import socket
+import shutil
+import logging
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils_cache import artifact_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARTIFACT_DIR = os.path.join(os.getenv('TMPDIR', '/tmp/'), 'lvlm-interpret')
+DEFAULT_QUOTA_BYTES = 20 * 2**30
+DEFAULT_MAX_AGE = 24 * 3600
+DEFAULT_WRITERS = int(os.getenv('LVLM_ARTIFACT_WRITERS', 2))
+# every store writes into its own `run-*` directory of the root, marked with this file
+INSTANCE_PREFIX = 'run-'
+INSTANCE_MARKER = '.lvlm-interpret-artifacts'
+# instance directories modified more recently are never purged, whoever owns them
+ORPHAN_GRACE = 3600
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(_path_size(os.path.join(path, name)) for name in os.listdir(path))
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _last_modified(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return 0
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            mtime = max(mtime, _last_modified(os.path.join(path, name)))
+    return mtime
+
+
+def _owner_alive(marker):
+    '''Whether the process that wrote `marker` still runs (unknown owners on other hosts count as alive).'''
+    try:
+        with open(marker) as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if owner.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, KeyError, TypeError):
+        return True
+    return True
+
+
+def _instance_pid(path):
+    # run-<pid>-<random>
+    try:
+        return int(os.path.basename(path)[len(INSTANCE_PREFIX):].split('-')[0])
+    except ValueError:
+        return None
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _Artifact:
+    def __init__(self, key, session_id):
+        self.key = key
+        self.session_id = session_id
+        self.created = time.time()
+        self.last_access = self.created
+        self.refcount = 0
+        self.pending_delete = False
+        # future of the background write, None once written synchronously
+        self.ready = None
+        # bytes on disk, scanned when a write of the key is done
+        self.size = 0
+
+    def paths(self):
+        # every file written for a query starts with its attention key
+        # (tensors, archive, cubes and the pngs saved by the analysis tabs)
+        return glob.glob(glob.escape(self.key) + '*')
+
+    def scan(self):
+        return sum(_path_size(p) for p in self.paths())
+
+
+class ArtifactStore:
+    '''
+        Owns the per-query files written under `root`. Every query (attention key)
+        belongs to a session; artifacts are deleted when their session is cleared,
+        when they are older than `max_age` seconds or least recently used once the
+        total size exceeds `quota_bytes`. Artifacts that a handler is reading
+        (see `reading`) are never deleted under it.
+        Artifacts can be written by a pool of `num_writers` background threads (see `submit`),
+        readers wait for the write of the key they read to finish (see `wait`).
+        Sizes are scanned once per write and kept as a running total, handlers that add files
+        to a key later (plots, relevancy) report them with `rescan`.
+        With `write_only` (model workers) the store only writes: the keys belong to the store of the
+        parent, which tracks, pins and evicts them. Nothing is recorded here beyond the pending write.
+    '''
+    def __init__(self, root=DEFAULT_ARTIFACT_DIR, quota_bytes=DEFAULT_QUOTA_BYTES, max_age=DEFAULT_MAX_AGE,
+                 num_writers=DEFAULT_WRITERS):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.num_writers = num_writers
+        self._artifacts = {}
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self._writer = None
+        self._instance_dir = None
+        self.write_only = False
+        # write only mode: futures of the writes until `when_written` collects them
+        self._detached = {}
+
+    def configure(self, root=None, quota_bytes=None, max_age=None, num_writers=None, write_only=None):
+        with self._lock:
+            if write_only is not None:
+                self.write_only = write_only
+            if root is not None and root != self.root:
+                self.root = root
+                self._instance_dir = None
+            if quota_bytes is not None:
+                self.quota_bytes = quota_bytes
+            if max_age is not None:
+                self.max_age = max_age
+            if num_writers is not None:
+                self.num_writers = num_writers
+
+    def instance_dir(self):
+        '''Directory of the artifacts of this store in `root`, created and marked on first use.'''
+        with self._lock:
+            if self._instance_dir is None:
+                os.makedirs(self.root, exist_ok=True)
+                path = tempfile.mkdtemp(prefix=f'{INSTANCE_PREFIX}{os.getpid()}-', dir=self.root)
+                with open(os.path.join(path, INSTANCE_MARKER), 'w') as f:
+                    json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'created': time.time()}, f)
+                self._instance_dir = path
+            return self._instance_dir
+
+    def purge_orphans(self):
+        '''
+            Remove the instance directories left in `root` by earlier runs: only marked `run-*` directories
+            whose process is gone and which were not modified for ORPHAN_GRACE seconds. Other entries of
+            `root` and the directories of live stores (servers, batch runs) are left alone.
+        '''
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            marker = os.path.join(path, INSTANCE_MARKER)
+            if (not name.startswith(INSTANCE_PREFIX) or path == self._instance_dir or not os.path.isfile(marker)
+                    or _owner_alive(marker) or now - _last_modified(path) < ORPHAN_GRACE):
+                continue
+            _remove_path(path)
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned artifact directories from {self.root}")
+
+    def new_key(self, session_id=None):
+        '''Reserve a fresh attention key (a path prefix in the instance directory) owned by `session_id`.'''
+        f = tempfile.NamedTemporaryFile(dir=self.instance_dir(), delete=False)
+        f.close()
+        os.remove(f.name)
+        with self._lock:
+            self._artifacts[f.name] = _Artifact(f.name, session_id)
+        return f.name
+
+    def register(self, key, session_id=None):
+        with self._lock:
+            if key not in self._artifacts:
+                self._artifacts[key] = _Artifact(key, session_id)
+        self.rescan(key)
+
+    def submit(self, key, fn, *args, session_id=None, **kwargs):
+        '''
+            Write the artifacts of `key` in the background by calling fn(*args, **kwargs).
+            The artifacts are pinned until written and registered afterwards.
+        '''
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=self.num_writers, thread_name_prefix='artifact-writer')
+            if self.write_only:
+                future = self._detached[key] = self._writer.submit(self._write_detached, key, fn, args, kwargs)
+                return future
+            artifact = self._artifacts.get(key)
+            if artifact is None:
+                artifact = self._artifacts[key] = _Artifact(key, session_id)
+            artifact.refcount += 1
+            artifact.ready = self._writer.submit(self._write, artifact, fn, args, kwargs)
+        return artifact.ready
+
+    def _write(self, artifact, fn, args, kwargs):
+        start = time.time()
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Writing the artifacts of {artifact.key} failed")
+            raise
+        finally:
+            self._set_size(artifact, artifact.scan())
+            self._unpin(artifact)
+        logger.info(f"Artifacts of {artifact.key} written in {time.time() - start:.2f}s")
+        self.enforce_quota()
+
+    def _write_detached(self, key, fn, args, kwargs):
+        start = time.time()
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Writing the artifacts of {key} failed")
+            raise
+        logger.info(f"Artifacts of {key} written in {time.time() - start:.2f}s")
+
+    def _set_size(self, artifact, size):
+        with self._lock:
+            if self._artifacts.get(artifact.key) is artifact:
+                self._nbytes += size - artifact.size
+                artifact.size = size
+
+    def rescan(self, key):
+        '''Update the size of `key` after files were added to it, outside of its background write.'''
+        with self._lock:
+            artifact = self._artifacts.get(key)
+        if artifact is None:
+            return
+        # the files are listed without the lock, readers are not held up
+        self._set_size(artifact, artifact.scan())
+        self.enforce_quota()
+
+    def _unpin(self, artifact):
+        with self._lock:
+            artifact.refcount -= 1
+            if artifact.refcount == 0 and artifact.pending_delete:
+                self._delete(artifact)
+
+    def expect(self, key, session_id=None):
+        '''
+            Register `key` as written by another process (a model worker). Readers wait until the
+            returned future is resolved, with None once the files are on disk or with the error.
+        '''
+        future = Future()
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is None:
+                artifact = self._artifacts[key] = _Artifact(key, session_id)
+            artifact.refcount += 1
+            artifact.ready = future
+
+        def written(future):
+            self._set_size(artifact, artifact.scan())
+            self._unpin(artifact)
+            if future.exception() is None:
+                self.enforce_quota()
+
+        future.add_done_callback(written)
+        return future
+
+    def when_written(self, key, callback):
+        '''
+            Call callback(error) once the background write of `key` is done, error is None on success.
+            In write only mode this collects the write, call it once per submitted key.
+        '''
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            ready = artifact.ready if artifact is not None else self._detached.pop(key, None)
+        if ready is None:
+            callback(None)
+        else:
+            ready.add_done_callback(lambda future: callback(future.exception()))
+
+    def wait(self, key, timeout=None):
+        '''Block until the background write of `key` (if any) is done, re-raising its error.'''
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            ready = artifact.ready if artifact is not None else self._detached.get(key)
+        if ready is not None:
+            ready.result(timeout=timeout)
+
+    @contextmanager
+    def reading(self, key):
+        '''Pin the artifacts of `key` while a handler reads them.'''
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None:
+                artifact.refcount += 1
+                artifact.last_access = time.time()
+        try:
+            yield
+        finally:
+            if artifact is not None:
+                with self._lock:
+                    artifact.refcount -= 1
+                    if artifact.refcount == 0 and artifact.pending_delete:
+                        self._delete(artifact)
+
+    def _delete(self, artifact):
+        if artifact.refcount > 0:
+            artifact.pending_delete = True
+            return False
+        for path in artifact.paths():
+            _remove_path(path)
+        artifact_cache.evict(artifact.key)
+        if self._artifacts.pop(artifact.key, None) is artifact:
+            self._nbytes -= artifact.size
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None:
+                return self._delete(artifact)
+        return False
+
+    def release_session(self, session_id):
+        with self._lock:
+            artifacts = [a for a in self._artifacts.values() if a.session_id == session_id]
+            for artifact in artifacts:
+                self._delete(artifact)
+        if artifacts:
+            logger.info(f"Released {len(artifacts)} artifacts of session {session_id}")
+
+    def enforce_quota(self):
+        now = time.time()
+        with self._lock:
+            for artifact in list(self._artifacts.values()):
+                if self.max_age and now - artifact.last_access > self.max_age:
+                    logger.info(f"Deleting artifacts of {artifact.key}: older than {self.max_age}s")
+                    self._delete(artifact)
+            if self._nbytes <= self.quota_bytes:
+                return self._nbytes
+            # least recently used first
+            for artifact in sorted(self._artifacts.values(), key=lambda a: a.last_access):
+                if self._nbytes <= self.quota_bytes:
+                    break
+                if artifact.refcount > 0:
+                    continue
+                logger.info(f"Deleting artifacts of {artifact.key} to stay under the {self.quota_bytes/2**30:.1f} GiB quota")
+                self._delete(artifact)
+            return self._nbytes
+
+    def shutdown(self):
+        if self._writer is not None:
+            # let the pending writes finish before their files are removed
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        with self._lock:
+            for artifact in list(self._artifacts.values()):
+                artifact.refcount = 0
+                self._delete(artifact)
+            if self._instance_dir is not None and os.getpid() == _instance_pid(self._instance_dir):
+                _remove_path(self._instance_dir)
+                self._instance_dir = None
+        logger.info(f"Artifact store {self.root} cleaned up")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'artifacts': len(self._artifacts),
+                'sessions': len(set(a.session_id for a in self._artifacts.values())),
+                'nbytes': self._nbytes,
+                'quota_bytes': self.quota_bytes,
+                'pending_writes': sum(1 for a in self._artifacts.values() if a.ready is not None and not a.ready.done()),
+            }
+
+
+artifact_store = ArtifactStore()
+
+
+def holds_artifacts(fn):
+    '''
+        Decorator for handlers taking the session state first: waits until its artifacts
+        are written and pins them during the call.
+    '''
+    @functools.wraps(fn)
+    def wrapper(state, *args, **kwargs):
+        key = getattr(state, 'attention_key', None)
+        if key is None:
+            return fn(state, *args, **kwargs)
+        artifact_store.wait(key)
+        with artifact_store.reading(key):
+            return fn(state, *args, **kwargs)
+    return wrapper
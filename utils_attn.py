@@ -1,28 +1,27 @@
 import os, sys
 sys.path.append(os.getenv('LLAVA_HOME'))
 
-import einops
 from collections import defaultdict
 import numpy as np
 import torch
-from torchvision.transforms.functional import to_pil_image
 import gradio as gr
 import PIL
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib.colors import to_rgba
-
-import seaborn
 from PIL import Image, ImageDraw
-import pandas as pd
-from scipy import stats
+# matplotlib, seaborn, pandas, scipy and einops are imported by the handlers that use them,
+# they stay out of the startup of the app
 
 import logging
 
+from utils_cache import artifact_cache, load_attentions, load_full_attention, load_relevancy
+from utils_cube import load_attention_cube
+from utils_summary import load_attention_summary, image_to_answer, question_to_answer
+from utils_artifacts import artifact_store, holds_artifacts
+from utils_analytics import separators_list, rollout_map, word_relevancy
+
 logger = logging.getLogger(__name__)
-# cmap = plt.get_cmap('jet')
-cmap = plt.get_cmap('coolwarm')
-separators_list = ['.',',','?','!', ':', ';', '</s>', '/', '!', '(', ')', '[', ']', '{', '}', '<', '>', '|', '\\', '-', '_', '+', '=', '*', '&', '^', '%', '$', '#', '@', '!', '~', '`', ' ', '\t', '\n', '\r', '\x0b', '\x0c']
+
+# heads drawn per page of the Raw Attentions gallery
+HEADS_PER_PAGE = 32
 
 def move_to_device(input, device='cpu'):
 
@@ -55,6 +54,16 @@ def convert_token2word(R_i_i, tokens, separators_list):
             current_count = 1
     return list(word_rel_maps.keys()), torch.Tensor(list(word_rel_maps.values()))
 
+def cmap(values):
+    '''coolwarm colors of `values` in [0, 1].'''
+    from matplotlib import colormaps
+    return colormaps['coolwarm'](values)
+
+def save_figure(fig, attention_key, suffix):
+    '''Save a plot next to the artifacts of `attention_key`, the artifact store counts it in the quota.'''
+    fig.savefig(attention_key + suffix)
+    artifact_store.rescan(attention_key)
+
 def draw_heatmap_on_image(mat, img_recover, normalize=True):
     if normalize:
         mat = (mat - mat.min()) / (mat.max() - mat.min())
@@ -66,15 +75,112 @@ def draw_heatmap_on_image(mat, img_recover, normalize=True):
     
     return img_overlay_attn
 
+@holds_artifacts
 def attn_update_slider(state):
-    fn_attention = state.attention_key + '_attn.pt'
-    attentions = torch.load(fn_attention,weights_only=True, mmap=True)
-    num_layers = len(attentions[0])
+    attentions = load_attentions(state.attention_key)
+    if attentions is not None:
+        num_layers = len(attentions[0])
+    else:
+        # queries captured in summary mode only have per step statistics
+        summary = load_attention_summary(state.attention_key)
+        if summary is None:
+            return state, gr.Slider(0, 0, value=0, step=1, label="Layer")
+        num_layers = summary['image_mass'].shape[1]
     # is slider the best module for this ? 
     return state, gr.Slider(0, num_layers-1, value=num_layers-1, step=1, label="Layer")
 
 
-def handle_attentions_i2t(state, highlighted_text,token_idx=0):
+def selected_tokens(state, highlighted_text):
+    '''(indices of the tokens selected in the highlighted text, highlighted text to show), (None, None) if none is found.'''
+    # which tokens to backprop from -> token_idx_list
+    if highlighted_text is None:
+        generated_text = []
+        for text in state.output_ids_decoded:
+            generated_text.extend([(text, None), (' ', None)])
+        return [0], generated_text
+
+    generated_text = state.output_ids_decoded
+    token_idx_map = dict((t,i) for i,t in enumerate(generated_text))
+    token_idx_list = []
+    for item in highlighted_text:
+        label = item['class_or_confidence']
+        if label is None:
+            continue
+        tokens = item['token'].split(' ')
+
+        for tok in tokens:
+            tok = tok.strip(' ')
+            if tok in token_idx_map:
+                token_idx_list.append(token_idx_map[tok])
+            else:
+                logger.warning(f'{tok} not found in generated text')
+
+    if not token_idx_list:
+        logger.info(highlighted_text)
+        logger.info(generated_text)
+        gr.Warning(f"Selected text not found in generated output")
+        return None, None
+
+    generated_text = []
+    for data in highlighted_text:
+        generated_text.extend([(data['token'], None if data['class_or_confidence'] is None else "'"), (' ', None)])
+    return token_idx_list, generated_text
+
+
+def head_image_attention(attention_key, img_idx, token_idx_list):
+    '''
+        (layers, heads, 576) image attention of every head averaged over the selected tokens, and the score the
+        heads are ranked by (mean of the max normalized map), from one reduction over the attention cube.
+        None without a cube. Cached per query and token selection, the gallery pages reuse it.
+    '''
+    def compute():
+        # (tokens, layers, heads, 576) last query attention over the image patches
+        img_cube = load_attention_cube(attention_key, 'image', img_idx=img_idx)
+        if img_cube is None:
+            return None
+        valid_token_idx = [t for t in token_idx_list if t < len(img_cube)]
+        for token_idx in set(token_idx_list) - set(valid_token_idx):
+            logger.info(f'token index {token_idx} out of bounds')
+        img_attns = img_cube[valid_token_idx].astype(np.float32).sum(0) / len(token_idx_list)
+        scores = (img_attns / img_attns.max(-1, keepdims=True)).mean(-1)
+        return img_attns, scores
+
+    return artifact_cache.get((attention_key, 'head_image_attention', tuple(token_idx_list)), compute)
+
+
+def draw_heatmaps_on_image(mats, img_recover):
+    '''draw_heatmap_on_image of a (n, 24, 24) batch, normalized and colored at once.'''
+    flat = mats.reshape(len(mats), -1)
+    low, high = flat.min(-1, keepdims=True), flat.max(-1, keepdims=True)
+    colors = (cmap(((flat - low) / (high - low)).reshape(mats.shape))[..., :3] * 255).astype(np.uint8)
+    overlays = []
+    for color in colors:
+        mat = Image.fromarray(color).resize((336,336), Image.BICUBIC)
+        mat.putalpha(128)
+        img_overlay_attn = img_recover.copy()
+        img_overlay_attn.paste(mat, mask=mat)
+        overlays.append(img_overlay_attn)
+    return overlays
+
+
+def head_gallery_page(img_attns, scores, recovered_image, page, heads_per_page=HEADS_PER_PAGE):
+    '''Overlays of the heads of one page, all layers ranked by score, only those are drawn. Returns (gallery, pages).'''
+    heads_per_page = int(heads_per_page)
+    order = np.argsort(-np.nan_to_num(scores, nan=-np.inf).ravel(), kind='stable')
+    num_pages = max(1, int(np.ceil(len(order) / heads_per_page)))
+    page = min(max(int(page), 1), num_pages)
+    layers, heads = np.unravel_index(order[(page-1)*heads_per_page:page*heads_per_page], scores.shape)
+    overlays = draw_heatmaps_on_image(img_attns[layers, heads].reshape(-1, 24, 24), recovered_image)
+    gallery = [(overlay, f'Layer_{layer}_Head_{head}') for overlay, layer, head in zip(overlays, layers, heads)]
+    return gallery, num_pages
+
+
+def page_slider(page, num_pages):
+    return gr.Slider(1, num_pages, value=min(page, num_pages), step=1, label=f"Page (of {num_pages}, heads ranked by mean attention)")
+
+
+@holds_artifacts
+def handle_attentions_i2t(state, highlighted_text, heads_per_page=HEADS_PER_PAGE, page=1):
     '''
         Draw attention heatmaps and return as a list of PIL images
         steps:
@@ -85,127 +191,62 @@ def handle_attentions_i2t(state, highlighted_text,token_idx=0):
             fetch img_attn
             img_attn = mha[img_idx:img_idx+576]
             
-            for layer: for head:
-            cummuatively add img_attn over all heads in a layer
-            average the attn over number of selected tokens
-
-            sort on highest response
+            average img_attn over the selected tokens, every layer and head in one reduction
+            rank the heads of all layers on highest response
 
+            draw the heads of one page of the ranking only
     '''
 
     if not hasattr(state, 'attention_key'):
-        return None, None, [], None
-    fn_attention = state.attention_key + '_attn.pt'
+        return None, None, [], None, gr.update()
     recovered_image = state.recovered_image
     img_idx = state.image_idx
     logger.info(f"image idx: {img_idx}") # 5?
-    
-    # which tokens to backprop from -> token_idx_list
-    if highlighted_text is not None:
-        generated_text = state.output_ids_decoded
-        token_idx_map = dict((t,i) for i,t in enumerate(generated_text))
-        token_idx_list = []
-        for item in highlighted_text:
-            label = item['class_or_confidence']
-            if label is None:
-                continue
-            tokens = item['token'].split(' ')
-
-            for tok in tokens:
-                tok = tok.strip(' ')
-                if tok in token_idx_map:
-                    token_idx_list.append(token_idx_map[tok])
-                else:
-                    logger.warning(f'{tok} not found in generated text')
-
-        if not token_idx_list:
-            logger.info(highlighted_text)
-            logger.info(generated_text)
-            gr.Error(f"Selected text not found in generated output")
-            return None, None, [], None
-        
-        generated_text = []
-        for data in highlighted_text:
-            generated_text.extend([(data['token'], None if data['class_or_confidence'] is None else "'"), (' ', None)])
-    else:
-        token_idx_list = [0]
-        generated_text = []
-        for text in state.output_ids_decoded:
-            generated_text.extend([(text, None), (' ', None)])
-        
 
-    if not os.path.exists(fn_attention):
-        gr.Error('Attention file not found. Please re-run query.')
-    else:
-        attentions = torch.load(fn_attention,weights_only=True)
-        logger.info(f'Loaded attention from {fn_attention}')
-        if len(attentions) == len(state.output_ids_decoded):
-            gr.Error('Mismatch between lengths of attentions and output tokens')
-        batch_size, num_heads, inp_seq_len, seq_len = attentions[0][0].shape
-        num_layers = len(attentions[0])
-        # cmap = plt.get_cmap('jet')
-        cmap = plt.get_cmap('coolwarm')
-        
-        img_attn_layers = dict()
-        img_attn_mean_layers = dict()
-        for layer_idx in range(num_layers):
-            img_attn_list = []
-            img_attn_mean = []
-            for head_idx in range(num_heads):
-                img_attn = None
-                for token_idx in token_idx_list:
-                    if token_idx >= len(attentions):
-                        logger.info(f'token index {token_idx} out of bounds')
-                        continue
-                    mh_attention = attentions[token_idx][layer_idx]
-                    batch_size, num_heads, inp_seq_len, seq_len = mh_attention.shape
-                    if inp_seq_len > 1:
-                        # if >1 that is attention of output token =0
-                        # so we select the query of the last input id token.
-                        mh_attention = mh_attention[:,:,-1,:]
-
-                    # else : multihead attention of the output token >0
-                    mh_attention = mh_attention.squeeze() # take out the batch dimension (here always 1)
-                    img_attn_token = mh_attention[head_idx, img_idx:img_idx+576].reshape(24,24).float().cpu().numpy()
-
-                    if img_attn is None:
-                        img_attn = img_attn_token
-                    else:
-                        img_attn += img_attn_token
-                img_attn /= len(token_idx_list)
-                img_overlay_attn = draw_heatmap_on_image(img_attn, recovered_image)
-
-                img_attn_list.append((img_overlay_attn, f'Layer_{layer_idx}_Head_{head_idx}'))
-
-                # Calculate mean attention per head
-                # img_attn = mh_attention[head_idx, img_idx:img_idx+576].reshape(24,24).cpu().numpy()
-
-                img_attn /= img_attn.max()
-                img_attn_mean.append(img_attn.mean())
-            img_attn_list = [x for _, x in sorted(zip(img_attn_mean, img_attn_list), key=lambda pair: pair[0], reverse=True)]
-            img_attn_layers[layer_idx] = img_attn_list
-            img_attn_mean_layers[layer_idx] = img_attn_mean
-            logger.info(f"Calculated for layer: {layer_idx}")
-
-
-        fig, ax = plt.subplots(num_layers,1,figsize=(15,2*num_layers))
-        fig.suptitle("Mean (per layer) scores for all layers ",fontsize=15,y=0,x=0)
-        for layer_id in range(num_layers):
-                seaborn.heatmap([img_attn_mean_layers[layer_id]], 
-                    cmap="coolwarm",linewidths=.3,annot=True,
-                    cbar_kws={"orientation": "vertical", "shrink":0.3},
-                    ax=ax[layer_id]
-                )
-                ax[layer_id].set_ylabel(f'Layer "{layer_id}')
-        fig.tight_layout()
-        plt.savefig(state.attention_key + 'mean_per_layer_scores_for_all_layers.png')
+    token_idx_list, generated_text = selected_tokens(state, highlighted_text)
+    if token_idx_list is None:
+        return None, None, [], None, gr.update()
+
+    head_attention = head_image_attention(state.attention_key, img_idx, token_idx_list)
+    if head_attention is None:
+        if load_attention_summary(state.attention_key) is not None:
+            gr.Warning('Raw attentions need the attention tensors, re-run the query with the capture policy mode=attentions')
+            return generated_text, recovered_image, [], None, gr.update()
+        raise gr.Error('Attention file not found. Please re-run query.')
+    logger.info(f'Loaded attention cube for {state.attention_key}')
+    img_attns, scores = head_attention
+    num_layers, num_heads, _ = img_attns.shape
+    import matplotlib.pyplot as plt
+    import seaborn
+
+    fig, ax = plt.subplots(figsize=(15, max(4, 0.5*num_layers)))
+    seaborn.heatmap(scores, cmap="coolwarm", linewidths=.3, annot=num_heads <= 32, fmt='.2f',
+                    cbar_kws={"orientation": "vertical", "shrink":0.3}, ax=ax)
+    ax.set_title("Mean (per layer) scores for all layers", fontsize=15)
+    ax.set_xlabel('Head')
+    ax.set_ylabel('Layer')
+    fig.tight_layout()
+    save_figure(plt.gcf(), state.attention_key, 'mean_per_layer_scores_for_all_layers.png')
 
-        all_attn_list = [item for sublist in img_attn_layers.values() for item in sublist]
-        logger.info(f"length attention images: {len(all_attn_list)}")
-        logger.info(f"Mean Attention between the image and the token {[state.output_ids_decoded[tok] for tok in token_idx_list]}")
+    gallery, num_pages = head_gallery_page(img_attns, scores, recovered_image, page, heads_per_page)
+    logger.info(f"Attention images: page {page} of {num_pages}, {len(gallery)} of {num_layers*num_heads} heads")
+    logger.info(f"Mean Attention between the image and the token {[state.output_ids_decoded[tok] for tok in token_idx_list if tok < len(state.output_ids_decoded)]}")
 
-    return generated_text, recovered_image, all_attn_list[::-1], fig
+    return generated_text, recovered_image, gallery, fig, page_slider(page, num_pages)
 
+@holds_artifacts
+def handle_attentions_i2t_page(state, highlighted_text, page, heads_per_page=HEADS_PER_PAGE):
+    '''Another page of the head gallery of handle_attentions_i2t, from the cached head attention.'''
+    if not hasattr(state, 'attention_key'):
+        return [], gr.update()
+    token_idx_list, _ = selected_tokens(state, highlighted_text)
+    head_attention = None if token_idx_list is None else head_image_attention(state.attention_key, state.image_idx, token_idx_list)
+    if head_attention is None:
+        return [], gr.update()
+    gallery, num_pages = head_gallery_page(*head_attention, state.recovered_image, page, heads_per_page)
+    return gallery, page_slider(page, num_pages)
+
+@holds_artifacts
 def handle_relevancy(state, type_selector,incude_text_relevancy=False):
     incude_text_relevancy = True
     logger.debug(f'incude_text_relevancy: {incude_text_relevancy}')
@@ -213,17 +254,16 @@ def handle_relevancy(state, type_selector,incude_text_relevancy=False):
     if not hasattr(state, 'attention_key'):
         return []
     
-    fn_attention = state.attention_key + '_relevancy.pt'
     recovered_image = state.recovered_image
     img_idx = state.image_idx
     logger.info(f"Image Idx:{img_idx}")
 
-    word_rel_maps = torch.load(fn_attention)
-    if type_selector not in word_rel_maps:
-        logger.warning(f'{type_selector} not in keys: {word_rel_maps.keys()}')
+    rows = load_relevancy(state.attention_key, type_selector, range(len(state.output_ids_decoded)))
+    if all(row is None for row in rows):
+        logger.warning(f'No {type_selector} relevancy maps for {state.attention_key}')
         return []
 
-    word_rel_map = word_rel_maps[type_selector]
+    word_rel_map = word_relevancy(state.output_ids_decoded, rows)
     image_list = []
     i = 0
     for rel_key, rel_map in word_rel_map.items():
@@ -270,19 +310,24 @@ def fig2img(fig):
     img = Image.open(buf)
     return img
 
+@holds_artifacts
 def handle_text_relevancy(state, type_selector):
     if type_selector != "llama":
         return [], []
     else:
+        import matplotlib.pyplot as plt
+        from scipy import stats
         tokens = state.output_ids_decoded
-        fn_attention = state.attention_key + '_relevancy.pt'
         img_idx = state.image_idx
         input_text_tokenized = state.input_text_tokenized
-        word_rel_maps = torch.load(fn_attention)
+        rows = load_relevancy(state.attention_key, 'llama', range(len(tokens)))
+        if all(row is None for row in rows):
+            logger.warning(f'No relevancy maps for {state.attention_key}')
+            return [], []
         
         input_text_tokenized_all = input_text_tokenized.copy()
         # loop over all output tokens
-        word_rel_map = word_rel_maps["llama_token"]
+        word_rel_map = word_relevancy(tokens, rows, by_token=True)
         # grid_size_temp = grid_size(len(rel_scores))
         all_figs = []
         highlighted_tokens = []
@@ -384,6 +429,7 @@ def boxes_click_handler(image, box_grid, event: gr.SelectData):
         if x is not None and y is not None:
             return image,box_grid
 
+@holds_artifacts
 def plot_attention_analysis(state, attn_modality_select):
     """
     Img to response tokens
@@ -403,52 +449,60 @@ def plot_attention_analysis(state, attn_modality_select):
             but here we skip image tokens and only collect :
             mh_attns[img_idx+576:img_idx+576+len(question_tokens)]
     """
-    fn_attention = state.attention_key + '_attn.pt'
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn
+
     recovered_image = state.recovered_image
     img_idx = state.image_idx
     logger.info(f"From Plot attention analysis {img_idx=}")
 
-    if os.path.exists(fn_attention):
-        attentions = torch.load(fn_attention,weights_only=True)
-        logger.info(f'Loaded attention from {fn_attention}')
-        if len(attentions) == len(state.output_ids_decoded):
+    img_cube = load_attention_cube(state.attention_key, 'image', img_idx=img_idx)
+    summary = None
+    if img_cube is not None:
+        logger.info(f'Loaded attention cube for {state.attention_key}')
+        if len(img_cube) == len(state.output_ids_decoded):
             gr.Error('Mismatch between lengths of attentions and output tokens')
         
-        num_tokens = len(attentions)
-        num_layers = len(attentions[0])
-        # first tokens last mh attention
-        last_mh_attention = attentions[0][-1]
-        batch_size, num_heads, inp_seq_len, seq_len = attentions[0][0].shape
+        num_tokens, num_layers, num_heads, _ = img_cube.shape
         generated_text = state.output_ids_decoded
     
     else:
-        return state, None
+        # queries captured in summary mode keep the means over all tokens
+        summary = load_attention_summary(state.attention_key)
+        if summary is None:
+            return state, None
+        logger.info(f'Loaded attention summary for {state.attention_key}')
+        num_tokens, num_layers, num_heads = summary['image_mass'].shape
+        generated_text = state.output_ids_decoded
     
     # Img2TextAns Attention
     heatmap_mean = defaultdict(dict)
     raw_heatmap = defaultdict(dict)
     if attn_modality_select == "Image-to-Answer":
+        # (tokens, layers, heads, 576) -> means over tokens (and patches) for all layers and heads
+        if summary is not None:
+            img_attn_mean, img_attn_raw = image_to_answer(summary)
+        else:
+            img_attn = img_cube[:len(generated_text)].astype(np.float32)
+            img_attn_mean, img_attn_raw = img_attn.mean((0, 3)), img_attn.mean(0)
+        img_attn_raw = img_attn_raw.reshape(num_layers, num_heads, 24, 24)
         for layer_idx in range(num_layers):
-            mh_attentions = [attentions[i][layer_idx][:,:,-1,:].squeeze() for i in range(len(generated_text))]
             for head_idx in range(num_heads):
-                # mh_attentions = []
-                img_attn = torch.stack([mh_attention[head_idx, img_idx:img_idx+576].reshape(24,24) for mh_attention in mh_attentions]).float().cpu().numpy()
-                # img_attn /= img_attn.max()
-                heatmap_mean[layer_idx][head_idx] =  img_attn.mean() # img_attn.mean((1,2))
-                raw_heatmap[layer_idx][head_idx] = img_attn.mean(axis=0) #only over tokens
+                heatmap_mean[layer_idx][head_idx] = img_attn_mean[layer_idx, head_idx]
+                raw_heatmap[layer_idx][head_idx] = img_attn_raw[layer_idx, head_idx] #only over tokens
     elif attn_modality_select == "Question-to-Answer":
-        fn_input_ids = state.attention_key + '_input_ids.pt'
-        img_idx = state.image_idx
-        input_ids = torch.load(fn_input_ids,weights_only=True)
-        len_question_only = input_ids.shape[1] - img_idx - 1
+        # (tokens, layers, heads, question) attention to the prompt ids after the image
+        if summary is not None:
+            ques_attn_mean, ques_attn_max = question_to_answer(summary)
+        else:
+            ques_attn = load_attention_cube(state.attention_key, 'question', img_idx=img_idx)[:len(generated_text)].astype(np.float32)
+            ques_attn_mean = ques_attn.mean((0, 3))
+            ques_attn_max = ques_attn.max((0, 3))
         for layer_idx in range(num_layers):
             for head_idx in range(num_heads):
-                mh_attentions = []
-                mh_attentions = [attentions[i][layer_idx][:,:,-1,:].squeeze() for i in range(len(generated_text))]
-                ques_attn = torch.stack([mh_attention[head_idx, img_idx+576:img_idx+576+len_question_only] for mh_attention in mh_attentions]).float().cpu().numpy()
-                heatmap_mean[layer_idx][head_idx] = ques_attn.mean()
-                ques_attn /= ques_attn.max()
-                raw_heatmap[layer_idx][head_idx]= ques_attn.mean()
+                heatmap_mean[layer_idx][head_idx] = ques_attn_mean[layer_idx, head_idx]
+                raw_heatmap[layer_idx][head_idx] = ques_attn_mean[layer_idx, head_idx] / ques_attn_max[layer_idx, head_idx]
 
     logger.info(f"raw : {raw_heatmap[0][0].shape}")
     # logger.info(f"raw : {raw_heatmap}")
@@ -461,7 +515,7 @@ def plot_attention_analysis(state, attn_modality_select):
     ax.set_ylabel("Heads")
     ax.set_title(f"{attn_modality_select} Mean Attention")
     fig.tight_layout()
-    fig.savefig(state.attention_key + 'mean_image_to_answer.png')
+    save_figure(fig, state.attention_key, 'mean_image_to_answer.png')
 
     if attn_modality_select == "Image-to-Answer":
         fig2,ax2 = plt.subplots(nrows=num_heads, ncols=num_layers, figsize=(num_layers,num_heads))
@@ -476,7 +530,7 @@ def plot_attention_analysis(state, attn_modality_select):
         for i in range(num_heads):
             ax2[i][0].set_ylabel(f"Head {i}", fontsize=10, rotation=0, labelpad=30, ha='right')  # Add labels to the first column
         fig2.tight_layout()
-        fig2.savefig(state.attention_key + 'image_to_answer_raw.png')
+        save_figure(fig2, state.attention_key, 'image_to_answer_raw.png')
     elif attn_modality_select == "Question-to-Answer":
         raw_normalized_df = pd.DataFrame(raw_heatmap)
         fig2 = plt.figure(figsize=(num_layers,num_heads)) 
@@ -486,14 +540,18 @@ def plot_attention_analysis(state, attn_modality_select):
         ax.set_title(f"{attn_modality_select} Max Normalized mean Attention")
         fig.tight_layout()
         fig2.tight_layout()
-        fig.savefig(state.attention_key + 'question_to_answer1.png')
-        fig2.savefig(state.attention_key + 'question_to_answer2.png')
+        save_figure(fig, state.attention_key, 'question_to_answer1.png')
+        save_figure(fig2, state.attention_key, 'question_to_answer2.png')
 
     return state, fig,fig2
 
+@holds_artifacts
 def plot_text_to_image_analysis(state, layer_idx, boxes, head_idx):
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+    from matplotlib.colors import to_rgba
+    import seaborn
 
-    fn_attention = state.attention_key + '_attn.pt'
     img_recover = state.recovered_image
     img_idx = state.image_idx
     generated_text = state.output_ids_decoded
@@ -503,40 +561,24 @@ def plot_text_to_image_analysis(state, layer_idx, boxes, head_idx):
     if len(img_patches) == 0:
         img_patches = [(12,12)]
         logger.info(f"No Patch given used middle point {img_patches}")
-    if os.path.exists(fn_attention):
-        attentions = torch.load(fn_attention,weights_only=True)
-        logger.info(f'Loaded attention from {fn_attention}')
-        if len(attentions) == len(state.output_ids_decoded):
+    img_cube = load_attention_cube(state.attention_key, 'image', img_idx=img_idx)
+    if img_cube is not None:
+        logger.info(f'Loaded attention cube for {state.attention_key}')
+        if len(img_cube) == len(state.output_ids_decoded):
             gr.Error('Mismatch between lengths of attentions and output tokens')
         
-        # num_tokens = len(attentions)
-        num_layers = len(attentions[0])
-        # last_mh_attention = attentions[0][-1]
-        batch_size, num_heads, inp_seq_len, seq_len = attentions[0][0].shape
+        num_tokens, num_layers, num_heads, _ = img_cube.shape
         generated_text = state.output_ids_decoded
     
     else:
+        if load_attention_summary(state.attention_key) is not None:
+            gr.Warning('Patch to response needs the attention tensors, re-run the query with the capture policy mode=attentions')
         return state, None
 
-    layer_mh_attns = defaultdict(dict)
-    for j in range(num_layers):
-        mh_attentions = []
-        for head_id in range(num_heads):
-            att_per_head = []
-            for i, out_att in enumerate(attentions):
-                mh_attention = out_att[j]
-                mh_attention = mh_attention[:, :, -1, :].unsqueeze(2)
-                att_img = mh_attention.squeeze()[head_id, img_idx:img_idx+576].reshape(24,24)
-                att_per_head.append(att_img)
-            att_per_head = torch.stack(att_per_head)
-            mh_attentions.append(att_per_head)
-        mh_attentions = torch.stack(mh_attentions)
-        layer_mh_attns[j]=mh_attentions
-
-    mh_attentions = layer_mh_attns[layer_idx]
-
-    logger.info(layer_mh_attns.keys())
-    logger.info(layer_mh_attns[0].shape)
+    # gather the selected patches (row major 24x24) and average them: (tokens, layers, heads)
+    patch_ids = [x*24 + y for x, y in img_patches]
+    patch_attns = torch.from_numpy(img_cube[..., patch_ids].astype(np.float32).mean(-1))
+    logger.debug(patch_attns.shape)
 
     img_mask = np.zeros((24, 24))
     for img_patch in img_patches:
@@ -549,7 +591,7 @@ def plot_text_to_image_analysis(state, layer_idx, boxes, head_idx):
     img_patch_recovered
 
     words = generated_text
-    float_values = torch.mean(torch.stack([mh_attentions[head_idx, :, x, y] for x, y in img_patches]), dim=0).float().cpu()    
+    float_values = patch_attns[:, layer_idx, head_idx]
     normalized_values = (float_values - float_values.min()) / (float_values.max() - float_values.min())
 
     fig = plt.figure(figsize=(15, 8))
@@ -577,44 +619,40 @@ def plot_text_to_image_analysis(state, layer_idx, boxes, head_idx):
 
     ax_words.axis('off')
     plt.suptitle(f"Attention to the selected image patch(es) of head #{head_idx} and layer #{layer_idx}", fontsize=16, y=0.8, x=0.6)    
-    plt.savefig(state.attention_key + 'attention_to_the_selected_patches.png')
+    save_figure(plt.gcf(), state.attention_key, 'attention_to_the_selected_patches.png')
     
-    def stacked_patch(mh):
-        return torch.stack([mh[:, :, x, y] for x, y in img_patches]).mean(0).float().cpu().mean(-1)
-
-    # attn_heatmap = plt.figure(figsize=(10, 3))
-    # attn_image_patch =  mh_attentions[:, :, img_patch[0], img_patch[1]].cpu().mean(-1)
-    attn_image_patch = torch.stack([mh_attentions[:, :, x, y] for x, y in img_patches]).mean(0).float().cpu().mean(-1)
-    logger.debug(torch.stack([mh_attentions[:, :, x, y] for x, y in img_patches]).shape)
-    logger.debug(torch.stack([mh_attentions[:, :, x, y] for x, y in img_patches]).mean(0).shape)
+    # mean over tokens of the attention to the selected patches: (layers, heads)
+    attn_image_patch = patch_attns.mean(0)
     logger.debug(attn_image_patch.shape)
     
     fig2,ax2 = plt.subplots(nrows= num_layers,figsize=(num_heads*2, num_layers*2))
     for j in range(num_layers):
-        seaborn.heatmap([stacked_patch(layer_mh_attns[j])], 
+        seaborn.heatmap([attn_image_patch[j].numpy()], 
             linewidths=.3,annot=True, cmap="coolwarm",ax=ax2[j],cbar_kws={"orientation": "vertical", "shrink":0.3}
         )
         ax2[j].set_ylabel(f'Layer "{j}')
     ax2[-1].set_xlabel('Head number')
     ax2[-1].set_title(f"Mean Head Attention between the image patches selected and the answer for all layers")
     fig2.tight_layout()
-    fig2.savefig(state.attention_key + 'mean_head_attn_all_layers.png')
+    save_figure(fig2, state.attention_key, 'mean_head_attn_all_layers.png')
     return state, fig, fig2
 
+@holds_artifacts
 def attention_rollout(state,fusion_method="min",cls_idx=0,topk=0.0,start_roll=0):
     """
     Experimental Implementation
     """
-    fn_attention = state.attention_key + '_attn.pt'
+    import matplotlib.pyplot as plt
+
     img_recover = state.recovered_image
     token_idx=0
     img_idx = state.image_idx
     discard_ratio=topk
     # generated_text = state.output_ids_decoded
 
-    if os.path.exists(fn_attention):
-        attentions = torch.load(fn_attention,weights_only=True)
-        logger.info(f'Loaded attention from {fn_attention}')
+    attentions = load_attentions(state.attention_key)
+    if attentions is not None:
+        logger.info(f'Loaded attention for {state.attention_key}')
         if len(attentions) == len(state.output_ids_decoded):
             gr.Error('Mismatch between lengths of attentions and output tokens')
         
@@ -626,31 +664,15 @@ def attention_rollout(state,fusion_method="min",cls_idx=0,topk=0.0,start_roll=0)
 
     assert start_roll < num_layers , f"{start_roll=} should be less than {num_layers=}"
 
-    attn = attentions[token_idx]
+    # the replayed full attention has every prompt row whatever the capture policy kept
+    attn = load_full_attention(state.attention_key) or attentions[token_idx]
+    if attn[0].shape[2] < cls_idx+img_idx+576:
+        gr.Warning("Attention rollout needs every query row of the prompt, re-run the query with the capture policy rows=all")
+        return None, None
     # _,_,q_size,k_size = attn[0].shape
     # assert q_size == k_size , "we will calculate only for first token"
 
-    I = torch.eye(cls_idx + img_idx+576)
-    roll_map = torch.eye(cls_idx+img_idx+576)
-
-    for layer_idx in range(start_roll,num_layers):
-        layer_map = einops.rearrange(attn[layer_idx],
-                                    "1 h q k -> h q k")
-        fused_map = einops.reduce(layer_map,
-                                  "h q k -> q k",fusion_method)
-        fused_map = fused_map[cls_idx:cls_idx+img_idx+576,
-                              cls_idx:cls_idx+img_idx+576].float()
-
-        _, indices = fused_map.topk(int(fused_map.size(-1)*discard_ratio), -1, False)
-        #indices = indices[indices != 0]
-        fused_map[0, indices] = 0
-
-        roll_map = roll_map @ (fused_map+I)/2
-        # this makes a lower triangular matrix (use sum dim as 1)
-        roll_map = roll_map/roll_map.sum(dim=-1,keepdim=True)
-
-    # fetch the img_features
-    roll_map = roll_map[img_idx:img_idx+576, img_idx:img_idx+576] 
+    roll_map = rollout_map(attn, img_idx, fusion_method, cls_idx, discard_ratio, start_roll)
     column_major_map = roll_map[:,0].view(24,-1)
     column_major_map = column_major_map/column_major_map.max()
 
@@ -672,21 +694,23 @@ def attention_rollout(state,fusion_method="min",cls_idx=0,topk=0.0,start_roll=0)
 
     return fig,img_overlay_attn2
 
+@holds_artifacts
 def attention_flow(state,fusion_method= "min",cls_idx=0,topk=0.2,start_flow=0):
     """
     Experimental Implementation
     Computes Attention Flow to determine the strongest path between the class token and image tokens.
     """
+    import einops
+    import matplotlib.pyplot as plt
 
-    fn_attention = state.attention_key + '_attn.pt'
     img_recover = state.recovered_image
     token_idx=0
     img_idx = state.image_idx
     discard_ratio=topk
 
-    if os.path.exists(fn_attention):
-        attentions = torch.load(fn_attention,weights_only=True)
-        logger.info(f'Loaded attention from {fn_attention}')
+    attentions = load_attentions(state.attention_key)
+    if attentions is not None:
+        logger.info(f'Loaded attention for {state.attention_key}')
         if len(attentions) == len(state.output_ids_decoded):
             gr.Error('Mismatch between lengths of attentions and output tokens')
         
@@ -696,21 +720,21 @@ def attention_flow(state,fusion_method= "min",cls_idx=0,topk=0.2,start_flow=0):
         gr.Error("did not find attention")
         return
 
-    attn = attentions[token_idx]
+    attn = load_full_attention(state.attention_key) or attentions[token_idx]
     num_layers = len(attn)
     img_idx_end = cls_idx + img_idx + 576 
     assert start_flow < num_layers , f"{start_flow=} should be less than {num_layers=}"
+    if attn[0].shape[2] < img_idx_end:
+        gr.Warning("Attention flow needs every query row of the prompt, re-run the query with the capture policy rows=all")
+        return None, None
 
     # Initialize flow map as identity matrix
     flow_map = torch.eye(img_idx_end)
     
     # Compute attention flow across layers
     for layer_idx in range(start_flow,num_layers):
-        layer_map = einops.rearrange(attn[layer_idx], "1 h q k -> h q k")
+        layer_map = attn[layer_idx][0, :, cls_idx:img_idx_end, cls_idx:img_idx_end]
         fused_map = einops.reduce(layer_map, "h q k -> q k", fusion_method)
-        
-        fused_map = fused_map[cls_idx:img_idx_end,
-                              cls_idx:img_idx_end]
 
         # discard less salient patches (similar to what we did in rollout)
         # does not work !!
@@ -740,7 +764,7 @@ def attention_flow(state,fusion_method= "min",cls_idx=0,topk=0.2,start_flow=0):
 
     ax[1].imshow(flow_columnar,cmap="coolwarm")
     ax[1].set_ylabel("Attention Flow")
-    fig.savefig(state.attention_key + '_flow.png')
+    save_figure(fig, state.attention_key, '_flow.png')
 
     flow_img = draw_heatmap_on_image(flow_columnar, img_recover)
     return fig,flow_img
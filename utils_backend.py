@@ -0,0 +1,124 @@
+import os
+import time
+import logging
+import functools
+
+import torch
+from PIL import Image
+
+from utils_capture import parse_index_list
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('default', 'cpu-optimized')
+
+
+def bf16_supported():
+    '''Whether the cpu has native bf16 matmuls (AVX512-BF16 / AMX), bf16 is emulated and slow otherwise.'''
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def pin_process(cores):
+    '''Restrict every thread of the process, and the threads it starts later, to `cores`.'''
+    cores = set(cores)
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            pass
+    os.sched_setaffinity(0, cores)
+
+
+def configure_threads(num_threads=None, num_interop_threads=None, pin_cores=None):
+    '''
+        Intra-op / inter-op threads and core pinning. `pin_cores` is an index list such as "0-27"
+        (the physical cores of one socket), the intra-op threads default to one per pinned core.
+    '''
+    cores = parse_index_list(pin_cores) if pin_cores else None
+    if cores is not None:
+        pin_process(cores)
+        num_threads = num_threads or len(cores)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # only possible before the first inter-op parallel work
+            logger.warning(f"Cannot set the inter-op threads: {e}")
+    logger.info(f"Threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op, "
+                f"cores: {sorted(os.sched_getaffinity(0))}")
+    return cores
+
+
+def model_dtype(args):
+    '''Weights dtype of the backend: bf16, or float32 on cpus without native bf16 in cpu-optimized mode.'''
+    if getattr(args, 'backend', 'default') == 'cpu-optimized' and not bf16_supported():
+        return torch.float32
+    return torch.bfloat16
+
+
+def _autocast_forward(model):
+    forward = model.forward
+
+    @functools.wraps(forward)
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return forward(*args, **kwargs)
+
+    model.forward = autocast_forward
+
+
+def optimize_model(model):
+    '''
+        cpu-optimized backend, after the attention hooks are registered. The attention modules stay
+        eager so the hooks still see every attention map: IPEX only prepacks the weights of the
+        linear layers, without IPEX the MLP blocks (most of the decode flops) are torch.compile'd.
+        Forward runs under bf16 autocast when the cpu supports bf16.
+    '''
+    try:
+        import intel_extension_for_pytorch as ipex
+    except ModuleNotFoundError:
+        ipex = None
+
+    model.eval()
+    if ipex is not None:
+        dtype = torch.bfloat16 if model.dtype == torch.bfloat16 else None
+        ipex.optimize(model, dtype=dtype, inplace=True, weights_prepack=True, auto_kernel_selection=True, graph_mode=False)
+        method = f'ipex {ipex.__version__} weight prepacking'
+    else:
+        for layer in model.language_model.model.layers:
+            layer.mlp.compile(dynamic=True)
+        method = 'torch.compile of the language model MLPs'
+    if bf16_supported():
+        _autocast_forward(model)
+        method += ', bf16 autocast'
+    logger.info(f"cpu-optimized backend: {method}, weights in {model.dtype}")
+    return method
+
+
+@torch.inference_mode()
+def decode_throughput(processor, model, max_new_tokens=32, repeats=2):
+    '''Greedy decode tokens / s on a blank image, the first run is a warmup.'''
+    image = Image.new('RGB', (336, 336), (255, 255, 255))
+    if processor.tokenizer.chat_template is not None:
+        prompt = processor.tokenizer.apply_chat_template(
+            [{"role": "user", "content": "<image>\nDescribe the image in detail."}], tokenize=False, add_generation_prompt=True)
+    else:
+        prompt = "USER: <image>\nDescribe the image in detail.\nASSISTANT:"
+    inputs = processor(text=prompt, images=image, return_tensors="pt").to(model.device)
+    rates = []
+    try:
+        for _ in range(repeats + 1):
+            start = time.time()
+            outputs = model.generate(**inputs, do_sample=False, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                     output_attentions=True, return_dict_in_generate=True)
+            num_tokens = outputs.sequences.shape[-1] - inputs.input_ids.shape[-1]
+            rates.append(num_tokens / (time.time() - start))
+    finally:
+        model.enc_attn_weights = []
+        model.enc_attn_weights_vit = []
+    return max(rates[1:])
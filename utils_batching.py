@@ -0,0 +1,143 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    def __init__(self, item, key):
+        self.item = item
+        self.key = key
+        self.future = Future()
+        self.arrival = time.time()
+
+
+class MicroBatcher:
+    '''
+        Coalesces concurrent calls into batches. Requests arriving within `max_wait` seconds
+        of the oldest pending one are grouped, up to `max_batch` requests with the same
+        `key(item)`, and handed to `run_batch(items)` on a scheduler thread. `run_batch` returns
+        one result per item, `__call__` blocks until the result of its item is available.
+    '''
+    def __init__(self, run_batch, max_batch=4, max_wait=0.05, key=None, name='micro-batcher'):
+        self.run_batch = run_batch
+        self.max_batch = max(int(max_batch), 1)
+        self.max_wait = max_wait
+        self.key = key or (lambda item: None)
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {'requests': 0, 'batches': 0, 'failed_batches': 0, 'wait_time': 0.0, 'run_time': 0.0}
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        request = _Request(item, self.key(item))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Micro-batcher is closed")
+            self._pending.append(request)
+            self._cond.notify()
+        return request.future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            first = self._pending[0]
+            deadline = first.arrival + self.max_wait
+            while True:
+                batch = [r for r in self._pending if r.key == first.key][:self.max_batch]
+                remaining = deadline - time.time()
+                if len(batch) >= self.max_batch or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+            for request in batch:
+                self._pending.remove(request)
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.time()
+            try:
+                results = self.run_batch([r.item for r in batch])
+                assert len(results) == len(batch), f"{len(results)} results for a batch of {len(batch)}"
+            except Exception as e:
+                logger.exception(f"Batch of {len(batch)} requests failed")
+                for request in batch:
+                    request.future.set_exception(e)
+                self._stats['failed_batches'] += 1
+            else:
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+            end = time.time()
+            self._stats['requests'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['wait_time'] += sum(start - r.arrival for r in batch)
+            self._stats['run_time'] += end - start
+            logger.info(f"Ran a batch of {len(batch)} in {end - start:.2f}s, micro-batcher: {self.stats()}")
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        stats = dict(self._stats)
+        requests, batches = stats['requests'], stats['batches']
+        stats['mean_batch_size'] = requests / batches if batches else 0.0
+        stats['mean_wait'] = stats['wait_time'] / requests if requests else 0.0
+        stats['requests_per_busy_second'] = requests / stats['run_time'] if stats['run_time'] else 0.0
+        stats['requests_per_second'] = requests / (time.time() - self._started)
+        return stats
+
+
+def _unpad(attn, sample, pad):
+    '''Attention of `sample` of a left padded batch without the `pad` padding rows and keys.'''
+    if attn is None:
+        return None
+    attn = attn[sample:sample+1]
+    if attn.shape[2] > 1:
+        attn = attn[:, :, pad:]
+    return attn[..., pad:]
+
+
+def split_batch_outputs(outputs, input_ids, attention_mask, max_new_tokens, eos_token_id):
+    '''
+        Split the outputs of a batched (left padded) generate call into per sample outputs
+        shaped as if the sample was generated alone: `sequences` without padding, and
+        `attentions` / `scores` cut after the first eos or the sample's `max_new_tokens`.
+        Returns a list of namespaces with sequences, attentions, scores and pad (number of padding ids).
+    '''
+    batch_size, prompt_len = input_ids.shape
+    generated = outputs.sequences[:, prompt_len:]
+    pads = (attention_mask == 0).sum(-1).tolist()
+    samples = []
+    for b in range(batch_size):
+        ids = generated[b, :max_new_tokens[b]].tolist()
+        num_tokens = ids.index(eos_token_id) + 1 if eos_token_id in ids else len(ids)
+        pad = pads[b]
+        attentions = tuple(
+            tuple(_unpad(attn, b, pad) for attn in outputs.attentions[step])
+            for step in range(num_tokens)
+        )
+        scores = tuple(s[b:b+1] for s in outputs.scores[:num_tokens]) if outputs.scores is not None else None
+        sequences = torch.cat([input_ids[b:b+1, pad:], generated[b:b+1, :num_tokens]], dim=-1)
+        samples.append(SimpleNamespace(sequences=sequences, attentions=attentions, scores=scores, pad=pad))
+    return samples
@@ -0,0 +1,193 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import utils_archive
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = int(os.getenv('LVLM_CACHE_BYTES', 2 * 2**30))
+
+
+def nbytes_of(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.memmap):
+        # backed by the page cache, not by the heap
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes_of(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes_of(v) for v in value.values())
+    return 0
+
+
+class ArtifactCache:
+    '''
+        Byte-bounded LRU cache of decoded artifacts shared by all handlers.
+        Keys are tuples starting with the attention key of the query they belong to,
+        so everything of one session can be evicted at once.
+        Cached values are shared between callers and must be treated as read-only.
+    '''
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+        value = loader()
+        if value is None:
+            return value
+        return self.put(key, value)
+
+    def put(self, key, value):
+        nbytes = nbytes_of(value)
+        if nbytes > self.max_bytes:
+            logger.debug(f"Not caching {key[:2]}: {nbytes} bytes exceed the cache size")
+            return value
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and self._items:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+        return value
+
+    def evict(self, attention_key):
+        with self._lock:
+            keys = [k for k in self._items if k[0] == attention_key]
+            for k in keys:
+                self.nbytes -= self._items.pop(k)[1]
+        if keys:
+            logger.info(f"Evicted {len(keys)} cached artifacts of {attention_key}")
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._items),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+artifact_cache = ArtifactCache()
+
+
+def load_attentions(attention_key):
+    '''
+        Cached version of utils_archive.load_attentions. Slices of archive blocks are
+        cached individually, the legacy `_attn.pt` pickle is cached as a whole.
+    '''
+    attentions = artifact_cache.get((attention_key, 'attn'),
+                                    lambda: utils_archive.load_attentions(attention_key, cache=artifact_cache))
+    logger.debug(f"Artifact cache: {artifact_cache.stats()}")
+    return attentions
+
+
+def load_full_attention(attention_key):
+    '''Cached version of utils_archive.load_full_attention.'''
+    return artifact_cache.get((attention_key, 'full_attn'),
+                              lambda: utils_archive.load_full_attention(attention_key, cache=artifact_cache))
+
+
+def causal_attention_matrix(attention_key, layer=-1):
+    '''
+        (heads, N, N) float64 attention of `layer` over prompt + answer (N keys). Read from the
+        replay archive when the query was replayed, otherwise stitched from the per step
+        attentions: the rows of step 0 (possibly only the trailing ones kept by the capture
+        policy) and the single query row of every later step. None if nothing was saved.
+    '''
+    full = load_full_attention(attention_key)
+    if full is not None and full[layer] is not None:
+        return full[layer][0].double().numpy()
+
+    attentions = load_attentions(attention_key)
+    if attentions is None:
+        return None
+    num_heads, _, attention_len = attentions[-1][layer][0].shape
+    full_attention = np.zeros((num_heads, attention_len, attention_len))
+
+    attention_vals = attentions[0][layer][0].detach().float().cpu().numpy()  # 0 is the index for the sample in the batch.
+    d1 = attention_vals.shape[-1]
+    full_attention[:, d1-attention_vals.shape[1]:d1, :d1] = attention_vals
+    for gen_idx in range(1, len(attentions)):
+        att_np = attentions[gen_idx][layer][0].detach().float().cpu().numpy()
+        full_attention[:, d1, :att_np.shape[-1]] = att_np[:, 0, :]
+        d1 += 1
+    return full_attention
+
+
+def load_input_ids(attention_key):
+    fn_input_ids = attention_key + '_input_ids.pt'
+    return artifact_cache.get((attention_key, 'input_ids'), lambda: torch.load(fn_input_ids, weights_only=True))
+
+
+def load_output_ids(attention_key):
+    fn_output_ids = attention_key + '_output_ids.pt'
+    return artifact_cache.get((attention_key, 'output_ids'), lambda: torch.load(fn_output_ids, weights_only=True))
+
+
+def load_pixel_values(attention_key):
+    fn_pixel_values = attention_key + '_pixel_values.pt'
+    if not os.path.exists(fn_pixel_values):
+        return None
+    return artifact_cache.get((attention_key, 'pixel_values'), lambda: torch.load(fn_pixel_values, weights_only=True))
+
+
+def relevancy_path(attention_key, map_type):
+    return f'{attention_key}_relevancy_{map_type}.pt'
+
+
+def load_relevancy(attention_key, map_type, token_indices):
+    '''
+        Relevancy rows of `map_type` of the generated tokens `token_indices`, None for the tokens not computed
+        yet (see utils_relevancy_service). Every row is cached on its own under (key, 'relevancy', type, token).
+    '''
+    fn_relevancy = relevancy_path(attention_key, map_type)
+    stored = []
+
+    def load_row(token_idx):
+        if not stored:
+            stored.append(torch.load(fn_relevancy, weights_only=True) if os.path.exists(fn_relevancy) else {})
+        return stored[0].get(token_idx)
+
+    return [artifact_cache.get((attention_key, 'relevancy', map_type, t), lambda t=t: load_row(t)) for t in token_indices]
+
+
+def save_relevancy(attention_key, map_type, rows):
+    '''Add the {token index: (1, N) row} `rows` to the stored rows of `map_type`, as float16.'''
+    fn_relevancy = relevancy_path(attention_key, map_type)
+    stored = torch.load(fn_relevancy, weights_only=True) if os.path.exists(fn_relevancy) else {}
+    for token_idx, row in rows.items():
+        stored[token_idx] = row.detach().to('cpu', torch.float16)
+    torch.save(stored, fn_relevancy + '.tmp')
+    os.replace(fn_relevancy + '.tmp', fn_relevancy)
+    for token_idx in rows:
+        artifact_cache.put((attention_key, 'relevancy', map_type, token_idx), stored[token_idx])
+    return len(stored)
@@ -0,0 +1,230 @@
+import queue
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+NUM_IMAGE_TOKENS = 576
+KEY_RANGE_NAMES = ('prompt', 'image', 'text')
+ROW_MODES = ('all', 'last')
+# 'attentions' keeps (part of) the attention tensors, 'summary' only per step statistics (see utils_summary)
+CAPTURE_MODES = ('attentions', 'summary')
+STORAGE_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+}
+
+
+def parse_index_list(spec):
+    '''"all" -> None, "0-3,7" -> [0, 1, 2, 3, 7]'''
+    spec = (spec or 'all').strip()
+    if spec == 'all':
+        return None
+    indices = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            indices.extend(range(int(start), int(end) + 1))
+        else:
+            indices.append(int(part))
+    return sorted(set(indices))
+
+
+def format_index_list(indices):
+    return 'all' if indices is None else ','.join(str(i) for i in indices)
+
+
+@dataclass
+class CapturePolicy:
+    '''
+        What part of the language model attention is kept at capture time.
+        layers / heads: indices to keep (None keeps all)
+        rows: 'all' query rows or only the 'last' one (the one the UI reads)
+        keys: 'all' or a subset of 'prompt' (before the image), 'image', 'text' (after the image)
+        dtype: storage dtype, None keeps the model dtype
+        mode: 'attentions' or 'summary' (reduce every step to statistics in the hooks, the fields above are ignored)
+    '''
+    layers: Optional[List[int]] = None
+    heads: Optional[List[int]] = None
+    rows: str = 'all'
+    keys: List[str] = field(default_factory=lambda: ['all'])
+    dtype: Optional[str] = None
+    mode: str = 'attentions'
+
+    def __post_init__(self):
+        if self.mode not in CAPTURE_MODES:
+            raise ValueError(f"Invalid capture mode: {self.mode}, expected one of {CAPTURE_MODES}")
+        if self.rows not in ROW_MODES:
+            raise ValueError(f"Invalid capture rows: {self.rows}, expected one of {ROW_MODES}")
+        for key in self.keys:
+            if key != 'all' and key not in KEY_RANGE_NAMES:
+                raise ValueError(f"Invalid capture key range: {key}, expected 'all' or one of {KEY_RANGE_NAMES}")
+        if self.dtype is not None and self.dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Invalid capture dtype: {self.dtype}, expected one of {list(STORAGE_DTYPES)}")
+
+    @property
+    def is_full(self):
+        return (self.mode == 'attentions' and self.layers is None and self.heads is None and self.rows == 'all'
+                and 'all' in self.keys and self.dtype is None)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            layers=parse_index_list(getattr(args, 'capture_layers', 'all')),
+            heads=parse_index_list(getattr(args, 'capture_heads', 'all')),
+            rows=getattr(args, 'capture_rows', 'all'),
+            keys=[k.strip() for k in getattr(args, 'capture_keys', 'all').split(',')],
+            dtype=getattr(args, 'capture_dtype', None),
+            mode=getattr(args, 'capture_mode', 'attentions'),
+        )
+
+    @classmethod
+    def from_string(cls, spec, default=None):
+        '''
+            Parse "layers=0-7,31;heads=all;rows=last;keys=image,text;dtype=float16" or "mode=summary".
+            Fields that are not given are taken from `default`.
+        '''
+        policy = default if default is not None else cls()
+        fields = dict(layers=policy.layers, heads=policy.heads, rows=policy.rows,
+                      keys=list(policy.keys), dtype=policy.dtype, mode=policy.mode)
+        for item in (spec or '').split(';'):
+            item = item.strip()
+            if not item:
+                continue
+            name, _, value = item.partition('=')
+            name, value = name.strip(), value.strip()
+            if name in ('layers', 'heads'):
+                fields[name] = parse_index_list(value)
+            elif name in ('rows', 'mode'):
+                fields[name] = value
+            elif name == 'keys':
+                fields[name] = [k.strip() for k in value.split(',')]
+            elif name == 'dtype':
+                fields[name] = None if value in ('', 'model') else value
+            else:
+                raise ValueError(f"Unknown capture policy field: {name}")
+        return cls(**fields)
+
+    def to_string(self):
+        return ';'.join([
+            f'layers={format_index_list(self.layers)}',
+            f'heads={format_index_list(self.heads)}',
+            f'rows={self.rows}',
+            f"keys={','.join(self.keys)}",
+            f"dtype={self.dtype or 'model'}",
+            f'mode={self.mode}',
+        ])
+
+    def key_ranges(self, seq_len, img_idx):
+        '''Absolute [start, end) key ranges kept for a sequence of `seq_len` keys, None keeps all.'''
+        if 'all' in self.keys:
+            return None
+        bounds = {
+            'prompt': (0, img_idx),
+            'image': (img_idx, img_idx + NUM_IMAGE_TOKENS),
+            'text': (img_idx + NUM_IMAGE_TOKENS, seq_len),
+        }
+        ranges = []
+        for start, end in sorted(bounds[k] for k in set(self.keys)):
+            end = min(end, seq_len)
+            if end <= start:
+                continue
+            if ranges and ranges[-1][1] >= start:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return ranges
+
+
+class AttentionCapture:
+    '''
+        Applies a CapturePolicy inside the language model attention hooks for one
+        generate call. The hooks hand every layer's weights to `reduce`, which returns
+        what is passed on to `outputs.attentions` (None for dropped layers).
+    '''
+    # the hooks keep the weights for the relevancy maps
+    retain = True
+
+    def __init__(self, policy, img_idx):
+        self.policy = policy
+        self.img_idx = img_idx
+        self.dtype = STORAGE_DTYPES[policy.dtype] if policy.dtype else None
+        # full (batch, heads, q, k) shape of every generation step
+        self.step_shapes = []
+
+    def reduce(self, layer_idx, attn, full_shape=None):
+        '''`full_shape` overrides the recorded shape when `attn` is only part of the step's block.'''
+        if layer_idx == 0:
+            self.step_shapes.append(tuple(full_shape or attn.shape))
+        policy = self.policy
+        if policy.is_full:
+            return attn
+        if policy.layers is not None and layer_idx not in policy.layers:
+            return None
+        if policy.heads is not None:
+            attn = attn[:, policy.heads]
+        if policy.rows == 'last':
+            attn = attn[:, :, -1:]
+        ranges = policy.key_ranges(attn.shape[-1], self.img_idx)
+        if ranges is not None:
+            attn = torch.cat([attn[..., start:end] for start, end in ranges], dim=-1)
+        if self.dtype is not None:
+            attn = attn.to(self.dtype)
+        return attn
+
+    def for_sample(self, pad, img_idx):
+        '''Capture of one sample of a left padded batch, without its `pad` padding rows and keys.'''
+        capture = AttentionCapture(self.policy, img_idx)
+        capture.step_shapes = [(1, num_heads, q_len - pad if q_len > 1 else q_len, k_len - pad)
+                               for _, num_heads, q_len, k_len in self.step_shapes]
+        return capture
+
+    def block_layout(self, step):
+        '''Archive metadata needed to expand a reduced block of `step` back to full coordinates.'''
+        batch_size, num_heads, q_len, k_len = self.step_shapes[step]
+        policy = self.policy
+        return {
+            'full_shape': [batch_size, num_heads, 1 if policy.rows == 'last' else q_len, k_len],
+            'heads': policy.heads,
+            'key_ranges': policy.key_ranges(k_len, self.img_idx),
+        }
+
+    def meta(self):
+        return {'capture_policy': self.policy.to_string(), 'img_idx': self.img_idx}
+
+
+class ImageAttentionListener:
+    '''
+        Per step hook target for streaming generation. Averages the image attention of the
+        last query row over the heads and layers of every step and queues it as a 24x24 map,
+        the consumer picks the maps up while the answer is generated.
+    '''
+    def __init__(self, img_idx, num_layers):
+        self.img_idx = img_idx
+        self.num_layers = num_layers
+        self.maps = queue.Queue()
+        self._sum = None
+
+    @torch.no_grad()
+    def __call__(self, layer_idx, attn):
+        image = attn[0, :, -1, self.img_idx:self.img_idx + NUM_IMAGE_TOKENS].float().mean(0)
+        self._sum = image if layer_idx == 0 or self._sum is None else self._sum + image
+        if layer_idx == self.num_layers - 1:
+            self.maps.put((self._sum / self.num_layers).reshape(24, 24).cpu().numpy())
+            self._sum = None
+
+    def latest(self):
+        '''Most recent map that was not picked up yet, None if there is none.'''
+        latest = None
+        while True:
+            try:
+                latest = self.maps.get_nowait()
+            except queue.Empty:
+                return latest
@@ -2,32 +2,21 @@ import sys
 sys.path.append('causality_lab')
 
 import logging
-import os
-import numpy as np
 import gradio as gr
-import torch
 from PIL import ImageDraw, Image
-from matplotlib import pyplot as plt
-from plot_utils import draw_graph, draw_pds_tree
-from causal_discovery_utils.cond_indep_tests import CondIndepParCorr
+
+from utils_cache import causal_attention_matrix
+from utils_artifacts import holds_artifacts
 
 logger = logging.getLogger(__name__)
 
-from utils_causal_discovery_fn import (
-    get_relevant_image_tokens,
-    tokens_analysis,
-    create_explanation,
-    copy_sub_graph,
-    show_tokens_on_image,
-    calculate_explanation_pvals,
-    get_relevant_prompt_tokens,
-    get_relevant_text_tokens,
-    crop_token,
-    get_expla_set_per_rad
-)
+# matplotlib and the causality_lab modules (plot_utils, graphical_models, causal_reasoning through
+# utils_causal_discovery_fn) are imported by the handlers, they stay out of the startup of the app
 
 
 def create_im_tokens_marks(orig_img, tokens_to_mark, weights=None, txt=None, txt_pos=None):
+    from utils_causal_discovery_fn import show_tokens_on_image
+
     im_1 = orig_img.copy()
     if weights is not None:
         im_heat = show_tokens_on_image(tokens_to_mark, im_1, weights)
@@ -49,6 +38,10 @@ def causality_update_dropdown(state):
 
 
 def handle_causal_head(state, explainers_data, head_selection, class_token_txt):
+    from matplotlib import pyplot as plt
+    from plot_utils import draw_pds_tree
+    from utils_causal_discovery_fn import crop_token, get_expla_set_per_rad
+
     recovered_image = state.recovered_image
     first_im_token_idx = state.image_idx
 
@@ -106,7 +99,19 @@ def handle_causal_head(state, explainers_data, head_selection, class_token_txt):
     return im_heat_list, im_graph
 
 
+@holds_artifacts
 def handle_causality(state, state_causal_explainers, token_to_explain, alpha_ext=None, att_th_ext=None):
+    from matplotlib import pyplot as plt
+    from plot_utils import draw_graph, draw_pds_tree
+    from utils_causal_discovery_fn import (
+        get_relevant_image_tokens,
+        tokens_analysis,
+        copy_sub_graph,
+        show_tokens_on_image,
+        get_relevant_text_tokens,
+        crop_token,
+    )
+
     # ---***------***------***------***------***------***------***------***------***------***------***------***---
     # ---***--- Results' containers ---***---
     gallery_image_list = []
@@ -120,31 +125,16 @@ def handle_causality(state, state_causal_explainers, token_to_explain, alpha_ext
     
     # ---***------***------***------***------***------***------***------***------***------***------***------***---
     # ---***--- Load attention matrix ---***---
-    fn_attention = state.attention_key + '_attn.pt'
     recovered_image = state.recovered_image
     first_im_token_idx = state.image_idx
     generated_text = state.output_ids_decoded
 
-    if not os.path.exists(fn_attention):
+    # (heads, N, N) attention of the last layer over prompt + answer
+    full_attention = causal_attention_matrix(state.attention_key, layer=-1)
+    if full_attention is None:
         gr.Error('Attention file not found. Please re-run query.')
-    else:
-        attentions = torch.load(fn_attention)  # attentions is a tuple of length as the number of generated tokens.
-
-    last_mh_attention = attentions[-1][-1]  # last generated token, last layer
-    num_heads, _, attention_len = last_mh_attention[-1].shape
-    full_attention = np.zeros((num_heads, attention_len, attention_len))
-
-    last_mh_attention = attentions[0][-1]  # last layer's attention matrices before output generation
-    attention_vals = last_mh_attention[0].detach().cpu().numpy()  # 0 is the index for the sample in the batch.
-    d1 = attention_vals.shape[-1]
-    full_attention[:, :d1, :d1] = attention_vals
-
-    # create one full attention matrix that includes attention to generated tokens
-    for gen_idx in range(1, len(generated_text)):
-        last_mh_attention = attentions[gen_idx][-1]
-        att_np = last_mh_attention[0].detach().cpu().numpy()
-        full_attention[:, d1, :att_np.shape[-1]] = att_np[:,0,:]
-        d1 += 1
+        return []
+    num_heads, _, attention_len = full_attention.shape
 
     # Sizes:
     # Number of heads: {num_heads}, attention size: {attention_len}x{attention_len}
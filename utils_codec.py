@@ -0,0 +1,162 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# block encodings of the attention archive, rows are the (batch, head, query) rows of a block
+#   dense:  rows as captured
+#   q8:     uint8 rows with one float32 scale per row
+#   csr:    rows sparsified to their top-p mass, values as captured
+#   csr-q8: sparsified rows with uint8 values and one float32 scale per row
+ENCODINGS = ('dense', 'q8', 'csr', 'csr-q8')
+QUANT_LEVELS = 255
+
+
+@dataclass
+class AttentionEncoding:
+    '''
+        How attention blocks are encoded in the archive.
+        method: one of ENCODINGS
+        top_p: fraction of the mass of every row kept by the csr encodings
+        max_error: bound on the absolute error of any attention value. Entries larger than it
+            are never dropped, and blocks whose quantization error exceeds it keep unquantized values.
+            None leaves the error unbounded.
+    '''
+    method: str = 'dense'
+    top_p: float = 0.99
+    max_error: Optional[float] = None
+
+    def __post_init__(self):
+        if self.method not in ENCODINGS:
+            raise ValueError(f"Invalid attention encoding: {self.method}, expected one of {ENCODINGS}")
+        if not 0.0 <= self.top_p <= 1.0:
+            raise ValueError(f"top_p must be in [0, 1], got {self.top_p}")
+
+    @property
+    def is_dense(self):
+        return self.method == 'dense'
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            method=getattr(args, 'attn_encoding', 'dense'),
+            top_p=getattr(args, 'attn_top_p', 0.99),
+            max_error=getattr(args, 'attn_max_error', None),
+        )
+
+    def to_string(self):
+        if self.is_dense:
+            return self.method
+        spec = self.method
+        if self.method.startswith('csr'):
+            spec += f' top_p={self.top_p}'
+        if self.max_error is not None:
+            spec += f' max_error={self.max_error}'
+        return spec
+
+    def encode(self, attn):
+        '''
+            Encode a (batch, heads, q, k) block. Returns (encoding, arrays, max_abs_error) where
+            `arrays` maps segment names to tensors / arrays to store. The encoding can fall back
+            to a less lossy one if the error bound would be exceeded.
+        '''
+        if self.is_dense:
+            return 'dense', {'data': attn}, 0.0
+        rows = attn.detach().reshape(-1, attn.shape[-1]).float()
+        sparse = self.method.startswith('csr')
+        quantize = self.method.endswith('q8')
+
+        keep = None
+        drop_error = 0.0
+        if sparse:
+            keep = self._top_p_mask(rows)
+            if not keep.all():
+                drop_error = rows.masked_fill(keep, 0).abs().max().item()
+
+        scales = None
+        quant_error = 0.0
+        if quantize:
+            row_max = rows.abs().amax(dim=-1)
+            scales = torch.where(row_max > 0, row_max / QUANT_LEVELS, torch.ones_like(row_max))
+            quantized = torch.round(rows / scales[:, None]).clamp_(0, QUANT_LEVELS)
+            error = (quantized * scales[:, None] - rows).abs()
+            if keep is not None:
+                error = error.masked_fill(~keep, 0)
+            quant_error = error.max().item() if error.numel() else 0.0
+            if self.max_error is not None and quant_error > self.max_error:
+                logger.debug(f"Quantization error {quant_error:.2e} exceeds {self.max_error}, keeping values unquantized")
+                quantize = False
+                quant_error = 0.0
+            else:
+                values = quantized.to(torch.uint8)
+
+        if not sparse and not quantize:
+            return 'dense', {'data': attn}, 0.0
+        if not sparse:
+            return 'q8', {'data': values.reshape(attn.shape), 'scales': scales}, quant_error
+
+        counts = keep.sum(dim=-1)
+        indptr = torch.zeros(len(rows) + 1, dtype=torch.int64, device=rows.device)
+        indptr[1:] = torch.cumsum(counts, dim=0)
+        # nonzero is row major, in the same order as boolean mask indexing
+        indices = keep.nonzero()[:, 1].to(torch.int32)
+        arrays = {'indptr': indptr, 'indices': indices}
+        if quantize:
+            arrays['values'] = values[keep]
+            arrays['scales'] = scales
+            return 'csr-q8', arrays, max(drop_error, quant_error)
+        arrays['values'] = attn.detach().reshape(rows.shape)[keep]
+        return 'csr', arrays, drop_error
+
+    def _top_p_mask(self, rows):
+        '''Smallest set of entries per row holding `top_p` of its mass, plus every entry above max_error.'''
+        values, order = torch.sort(rows, dim=-1, descending=True)
+        mass_before = torch.cumsum(values, dim=-1) - values
+        keep_sorted = mass_before < self.top_p * values.sum(dim=-1, keepdim=True)
+        if self.max_error is not None:
+            keep_sorted |= values.abs() > self.max_error
+        keep_sorted &= values != 0
+        keep = torch.zeros_like(keep_sorted)
+        keep.scatter_(-1, order, keep_sorted)
+        return keep
+
+
+def decode_rows(encoding, segments, row_ids, num_keys):
+    '''
+        Rows `row_ids` (stored row numbers) of a block encoded as `encoding`, as a
+        (len(row_ids), num_keys) array. `segments` maps segment names to (memory-mapped) arrays.
+        Quantized encodings decode to float32, the others keep the stored dtype.
+    '''
+    if encoding == 'dense':
+        data = segments['data']
+        return data.reshape(-1, data.shape[-1])[row_ids]
+    if encoding == 'q8':
+        data = segments['data']
+        rows = data.reshape(-1, data.shape[-1])[row_ids].astype(np.float32)
+        return rows * segments['scales'][row_ids, None]
+
+    indptr = segments['indptr']
+    values = segments['values']
+    starts = indptr[row_ids]
+    lengths = indptr[row_ids + 1] - starts
+    total = int(lengths.sum())
+    # flat positions of the stored entries of every requested row
+    offsets = np.cumsum(lengths) - lengths
+    flat = np.arange(total) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    out_rows = np.repeat(np.arange(len(row_ids)), lengths)
+    cols = segments['indices'][flat]
+    if encoding == 'csr-q8':
+        rows = np.zeros((len(row_ids), num_keys), dtype=np.float32)
+        rows[out_rows, cols] = values[flat] * segments['scales'][np.repeat(row_ids, lengths)]
+    else:
+        rows = np.zeros((len(row_ids), num_keys), dtype=values.dtype)
+        rows[out_rows, cols] = values[flat]
+    return rows
+
+
+def decoded_dtype(encoding, dtype_name):
+    return 'float32' if encoding.endswith('q8') else dtype_name
@@ -0,0 +1,88 @@
+import os
+import logging
+
+import numpy as np
+
+from utils_cache import artifact_cache, load_attentions, load_input_ids
+
+logger = logging.getLogger(__name__)
+
+NUM_IMAGE_TOKENS = 576
+# 'image': keys of the 24x24 image patches
+# 'question': keys of the prompt ids after the image token
+# 'generated': keys of the generated tokens (zero for tokens that are not generated yet)
+CUBE_KINDS = ('image', 'question', 'generated')
+# attention values are in [0, 1], float16 keeps more mantissa than the bf16 model output
+CUBE_DTYPE = np.float16
+
+
+def cube_path(attention_key, kind):
+    return f'{attention_key}_cube_{kind}.npy'
+
+
+def build_attention_cubes(attentions, img_idx, num_prompt_ids):
+    '''
+        Gather the last query row of every generation step into contiguous
+        (tokens, layers, heads, keys) cubes, one per key range in CUBE_KINDS.
+        `attentions` is anything indexable as [step][layer] -> (batch, heads, q, k),
+        `num_prompt_ids` is the length of the (unexpanded) input_ids.
+    '''
+    num_tokens = len(attentions)
+    num_layers = len(attentions[0])
+    num_heads = attentions[0][0].shape[1]
+    len_question = num_prompt_ids - img_idx - 1
+    question_start = img_idx + NUM_IMAGE_TOKENS
+    prompt_len = question_start + len_question
+
+    cubes = {
+        'image': np.zeros((num_tokens, num_layers, num_heads, NUM_IMAGE_TOKENS), dtype=CUBE_DTYPE),
+        'question': np.zeros((num_tokens, num_layers, num_heads, len_question), dtype=CUBE_DTYPE),
+        'generated': np.zeros((num_tokens, num_layers, num_heads, num_tokens), dtype=CUBE_DTYPE),
+    }
+    for token_idx in range(num_tokens):
+        for layer_idx in range(num_layers):
+            mh_attention = attentions[token_idx][layer_idx]
+            if mh_attention is None:
+                continue
+            # for output token 0 this is the query of the last input id
+            last_row = mh_attention[0, :, -1, :].float().cpu().numpy()
+            cubes['image'][token_idx, layer_idx] = last_row[:, img_idx:img_idx+NUM_IMAGE_TOKENS]
+            cubes['question'][token_idx, layer_idx] = last_row[:, question_start:prompt_len]
+            generated = last_row[:, prompt_len:prompt_len+token_idx]
+            cubes['generated'][token_idx, layer_idx, :, :generated.shape[-1]] = generated
+    return cubes
+
+
+def write_attention_cubes(attention_key, attentions, img_idx, num_prompt_ids):
+    cubes = build_attention_cubes(attentions, img_idx, num_prompt_ids)
+    for kind, cube in cubes.items():
+        fn_cube = cube_path(attention_key, kind)
+        np.save(fn_cube + '.tmp.npy', cube)
+        os.replace(fn_cube + '.tmp.npy', fn_cube)
+    logger.info(f"Attention cubes saved to {cube_path(attention_key, '*')} {cubes['image'].shape}")
+    return cubes
+
+
+def load_attention_cube(attention_key, kind, img_idx=None):
+    '''
+        Memory-mapped (tokens, layers, heads, keys) cube of `kind`. Queries without a
+        sidecar get their cubes built once from the attention archive and cached.
+    '''
+    assert kind in CUBE_KINDS, f"Unknown cube kind {kind}"
+
+    def loader():
+        fn_cube = cube_path(attention_key, kind)
+        if os.path.exists(fn_cube):
+            return np.load(fn_cube, mmap_mode='r')
+        attentions = load_attentions(attention_key)
+        if attentions is None or img_idx is None:
+            return None
+        logger.info(f"No attention cube sidecar for {attention_key}, building it from the attentions")
+        num_prompt_ids = load_input_ids(attention_key).shape[-1]
+        cubes = build_attention_cubes(attentions, img_idx, num_prompt_ids)
+        for other_kind, cube in cubes.items():
+            if other_kind != kind:
+                artifact_cache.get((attention_key, 'cube', other_kind), lambda cube=cube: cube)
+        return cubes[kind]
+
+    return artifact_cache.get((attention_key, 'cube', kind), loader)
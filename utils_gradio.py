@@ -1,10 +1,11 @@
 import os
-import tempfile
+import time
+import atexit
+import threading
+from types import SimpleNamespace
+from dataclasses import replace
 import logging
 
-from gradio.external import re
-from matplotlib import interactive
-from numpy.ma import maximum, minimum
 import torch
 
 from PIL import Image
@@ -12,17 +13,29 @@ import numpy as np
 import gradio as gr
 import spaces
 
-from torchvision.transforms.functional import to_pil_image
-
-from utils_model import get_processor_model, move_to_device, to_gradio_chatbot, process_image
+# torchvision, transformers and the plotting libraries are imported where they are used,
+# the server binds while the model loads in the background
+from utils_model import ModelLoader, get_processor_model, warmup_forward, move_to_device, to_gradio_chatbot, process_image
 
 from utils_attn import (
-    attention_rollout, handle_attentions_i2t, plot_attention_analysis, handle_relevancy, handle_text_relevancy, reset_tokens,select_all_tokens,
-    plot_text_to_image_analysis, handle_box_reset, boxes_click_handler, attn_update_slider,
+    attention_rollout, handle_attentions_i2t, handle_attentions_i2t_page, HEADS_PER_PAGE, plot_attention_analysis, handle_relevancy, handle_text_relevancy, reset_tokens,select_all_tokens,
+    plot_text_to_image_analysis, handle_box_reset, boxes_click_handler, attn_update_slider, draw_heatmap_on_image,
     attention_rollout, attention_flow
 )
 
-from utils_relevancy import construct_relevancy_map
+from utils_archive import archive_path, full_archive_path, write_attention_archive, AttentionArchive
+from utils_cube import write_attention_cubes
+from utils_capture import CapturePolicy, AttentionCapture, ImageAttentionListener, parse_index_list
+from utils_codec import AttentionEncoding
+from utils_summary import AttentionSummary, write_attention_summary
+from utils_batching import MicroBatcher, split_batch_outputs
+from utils_vision_cache import VisionFeatureCache, tensor_digest
+from utils_prefix_cache import PrefixCache, generate_with_prefix
+from utils_replay import compute_relevancy, replay_full_attention
+from utils_relevancy_service import RelevancyService
+from utils_cache import artifact_cache
+from utils_artifacts import artifact_store, holds_artifacts
+from utils_workers import ModelWorkerPool, notify
 
 from utils_causal_discovery import (
     handle_causality, handle_causal_head, causality_update_dropdown
@@ -37,6 +50,19 @@ ROLE1 = "ASSISTANT"
 
 processor = None
 model = None
+model_loader = None
+# the hooks keep per call state on the model (capture, listener, retained weights), one pass runs at a time
+model_lock = threading.RLock()
+capture_policy = CapturePolicy()
+# 'generate' keeps the attention captured while decoding, 'replay' also recomputes the full
+# prompt + answer attention with one teacher-forced forward after every query
+attention_source = 'generate'
+attn_encoding = AttentionEncoding()
+micro_batcher = None
+prefix_cache = None
+# forked model workers serving lvlm_bot (--num_workers), and the writes they have not reported yet
+worker_pool = None
+pending_writes = {}
 
 system_prompt = """You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe.  Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Please ensure that your responses are socially unbiased and positive in nature.
 If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
@@ -75,17 +101,82 @@ block_css = """
 }
 """
 
-def clear_history(request: gr.Request):
+def clear_history(state, request: gr.Request):
     logger.info(f"clear_history. ip: {request.client.host}")
+    if hasattr(state, 'attention_key'):
+        artifact_cache.evict(state.attention_key)
+    # the files of every query of this session go with it
+    artifact_store.release_session(request.session_hash)
+    logger.info(f"Artifact cache: {artifact_cache.stats()}, artifact store: {artifact_store.stats()}")
     state = gr.State()
     state.messages = []
     return (state, [], "", None, None, None, None)
 
+def require_model():
+    '''Refuse queries while the model is loading.'''
+    if model is not None:
+        return
+    if model_loader is None:
+        raise gr.Error("No model loaded")
+    raise gr.Error(model_loader.status())
+
+
+def model_status():
+    if model_loader is None:
+        return ""
+    return f"**{model_loader.status()}**"
+
+
+def refresh_model_status():
+    # the timer stops polling once loading is over
+    done = model_loader is None or model_loader.ready.is_set()
+    return model_status(), gr.Timer(active=not done)
+
+
+def install_vision_cache(args, loaded_model):
+    vision_cache_mb = getattr(args, 'vision_cache_mb', 0)
+    if vision_cache_mb > 0:
+        # repeated images skip the image processor and the vision tower
+        VisionFeatureCache(args.model_name_or_path, max_bytes=int(vision_cache_mb * 2**20),
+                           disk_dir=getattr(args, 'vision_cache_dir', None)).install(loaded_model)
+
+
+def on_model_loaded(args, loaded_processor, loaded_model):
+    global processor
+    global model
+    install_vision_cache(args, loaded_model)
+    processor = loaded_processor
+    start_worker_pool(args, loaded_model)
+    # set last, queries are accepted from here on
+    model = loaded_model
+
+
+def continue_conversation(state, text):
+    '''Add a follow-up question about the image of the previous turns to the conversation.'''
+    answer = state.messages[-1][-1] or ''
+    if processor.tokenizer.chat_template is not None:
+        conversation = []
+        for question, response in zip(state.messages[::2], state.messages[1::2]):
+            question = question[1]
+            if isinstance(question, tuple):
+                question = "<image>\n" + question[0]
+            conversation.append({"role": "user", "content": question})
+            conversation.append({"role": "assistant", "content": response[1] or ''})
+        conversation.append({"role": "user", "content": text})
+        prompt = processor.tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+    else:
+        # the previous prompt is kept verbatim so the prefix cache covers the earlier turns
+        prompt = state.prompt + answer + f"\n{ROLE0}: {text}\n{ROLE1}:"
+
+    state.messages.append([ROLE0, text])
+    state.messages.append([ROLE1, None])
+    state.prompt_len = len(prompt)
+    state.prompt = prompt
+    return (state, to_gradio_chatbot(state), "", None)
+
+
 def add_text(state, text, image, image_process_mode):
-    if True: # state is None:
-        state = gr.State()
-        state.messages = []
-        
+    require_model()
     if isinstance(image, dict):
         image = image['composite']
         background = Image.new('RGBA', image.size, (255, 255, 255))
@@ -98,6 +189,12 @@ def add_text(state, text, image, image_process_mode):
     text = text[:1536]  # Hard cut-off
     logger.info(text)
 
+    # a question without a new image continues the conversation about the previous image
+    if image is None and getattr(state, 'image', None) is not None and getattr(state, 'messages', None):
+        return continue_conversation(state, text)
+    state = gr.State()
+    state.messages = []
+
     prompt_len = 0
     # prompt=f"[INST] {system_prompt} [/INST]\n\n" if system_prompt else ""
     if processor.tokenizer.chat_template is not None:
@@ -127,27 +224,83 @@ def add_text(state, text, image, image_process_mode):
     return (state, to_gradio_chatbot(state), "", None)
 
 
-@spaces.GPU
-def lvlm_bot(state, temperature, top_p, max_new_tokens):   
+def release_session(request: gr.Request):
+    logger.info(f"Session {request.session_hash} closed")
+    artifact_store.release_session(request.session_hash)
+
+
+def save_artifacts(attention_key, input_ids, attentions, output_ids, capture, img_idx, summary=None, pixel_values=None,
+                   full_attentions=None, full_capture=None):
+    '''Write the artifacts of one query, runs on the artifact store writer threads.'''
+    fn_input_ids = f'{attention_key}_input_ids.pt'
+    torch.save(input_ids, fn_input_ids)
+    logger.info(f"Input ids saved to {fn_input_ids}")
+
+    if pixel_values is not None:
+        # the relevancy replay runs the query again from its ids and pixels
+        fn_pixel_values = f'{attention_key}_pixel_values.pt'
+        torch.save(pixel_values, fn_pixel_values)
+
+    fn_output_ids = f'{attention_key}_output_ids.pt'
+    torch.save(torch.tensor(output_ids),fn_output_ids)
+    logger.info(f"Output ids saved to {fn_output_ids}")
+
+    if summary is not None:
+        write_attention_summary(attention_key, summary)
+        return
+
+    fn_attention = archive_path(attention_key)
+    write_attention_archive(fn_attention, attentions, capture=capture, encoding=attn_encoding)
+    logger.info(f"Attention saved to : {fn_attention}")
+    # per token image / question / generated attention cubes the analysis tabs reduce over
+    write_attention_cubes(attention_key, AttentionArchive(fn_attention), img_idx, input_ids.shape[-1])
+
+    if full_attentions is not None:
+        fn_full_attention = full_archive_path(attention_key)
+        write_attention_archive(fn_full_attention, (full_attentions,), capture=full_capture,
+                                meta={'source': 'replay'}, encoding=attn_encoding)
+
+
+def prepare_generation(state, temperature, top_p, max_new_tokens, capture_spec=None):
+    '''Processor inputs, image index, attention capture and generate kwargs of the pending query.'''
+    require_model()
     prompt = state.prompt
-    prompt_len = state.prompt_len
     image = state.image
+
+    # per request capture policy, fields not given fall back to the CLI policy
+    try:
+        policy = CapturePolicy.from_string(capture_spec, default=capture_policy)
+    except ValueError as e:
+        raise gr.Error(str(e))
     
-    inputs = processor(text=prompt,images= image,
-                       return_tensors="pt").to(model.device)
+    vision_cache = getattr(model, 'vision_cache', None)
+    if vision_cache is not None and image is not None and getattr(processor, 'patch_size', None) is None:
+        # the image token is expanded in the model, the prompt can be tokenized without the image
+        inputs = processor(text=prompt, images=None, return_tensors="pt")
+        inputs['pixel_values'] = vision_cache.pixel_values(
+            image, lambda: processor.image_processor(image, return_tensors="pt").pixel_values)
+        inputs = inputs.to(model.device)
+    else:
+        inputs = processor(text=prompt,images= image,
+                           return_tensors="pt").to(model.device)
     input_ids = inputs.input_ids
     img_idx = torch.where(input_ids==model.config.image_token_index)[1][0].item()
     do_sample = True if temperature > 0.001 else False
-    # Generate
     model.enc_attn_weights = []
     model.enc_attn_weights_vit = []
+    if policy.mode == 'summary':
+        # constant memory: the hooks reduce every step into preallocated buffers
+        capture = AttentionSummary(policy, img_idx, input_ids.shape[-1],
+                                   len(model.language_model.model.layers), max_new_tokens)
+    else:
+        capture = AttentionCapture(policy, img_idx)
 
     if model.language_model.config.model_type == "gemma":
         eos_token_id = processor.tokenizer('<end_of_turn>', add_special_tokens=False).input_ids[0]
     else:
         eos_token_id = processor.tokenizer.eos_token_id
 
-    outputs = model.generate(
+    generate_kwargs = dict(
             **inputs, 
             do_sample=do_sample,
             temperature=temperature,
@@ -159,7 +312,37 @@ def lvlm_bot(state, temperature, top_p, max_new_tokens):
             output_scores=True,
             eos_token_id=eos_token_id
         )
+    return inputs, img_idx, capture, generate_kwargs
+
 
+def recover_image(pixel_values):
+    from torchvision.transforms.functional import to_pil_image
+    img_std = torch.tensor(processor.image_processor.image_std).view(3,1,1)
+    img_mean = torch.tensor(processor.image_processor.image_mean).view(3,1,1)
+    img_recover = pixel_values[0].cpu().float() * img_std + img_mean
+    return to_pil_image(img_recover)
+
+
+def replay_attention(inputs, img_idx, output_ids, policy):
+    '''
+        Full attention over prompt + answer from one teacher-forced forward, the canonical input
+        of the causality, rollout and flow tabs. The layers, heads and dtype of `policy` apply,
+        every row and key is kept. Returns (per layer blocks on the cpu, capture).
+    '''
+    capture = AttentionCapture(replace(policy, rows='all', keys=['all']), img_idx)
+    start = time.time()
+    with model_lock:
+        full_attentions = replay_full_attention(model, inputs.input_ids, output_ids, inputs.pixel_values, capture)
+    logger.info(f"Replayed the full attention of {len(output_ids)} tokens in {time.time() - start:.2f}s")
+    return move_to_device(full_attentions, device='cpu'), capture
+
+
+def finish_generation(state, inputs, img_idx, outputs, capture, request=None, attention_key=None):
+    '''
+        Decode the answer, hand the artifacts to the writer threads and fill in the session state.
+        `attention_key` is the key reserved by the parent when running in a model worker.
+    '''
+    input_ids = inputs.input_ids
     input_ids_list = input_ids.reshape(-1).tolist()
     input_ids_list[img_idx] = 0
     input_text = processor.tokenizer.decode(input_ids_list) # eg. "<s> You are a helpful ..."
@@ -180,64 +363,429 @@ def lvlm_bot(state, temperature, top_p, max_new_tokens):
 
     state.messages[-1][-1] = generated_text[:-len('</s>')] if generated_text.endswith('</s>') else generated_text
 
-    tempdir = os.getenv('TMPDIR', '/tmp/')
-    tempfilename = tempfile.NamedTemporaryFile(dir=tempdir)
-    tempfilename.close()
-
-    # Save input_ids and attentions
-    fn_input_ids = f'{tempfilename.name}_input_ids.pt'
-    logger.info(f"Input ids saved to {fn_input_ids}")
-    torch.save(move_to_device(input_ids, device='cpu'), fn_input_ids)
+    session_id = request.session_hash if request is not None else None
+    if attention_key is None:
+        attention_key = artifact_store.new_key(session_id)
 
-    fn_attention = f'{tempfilename.name}_attn.pt'
-    torch.save(move_to_device(outputs.attentions, device='cpu'), fn_attention)
-    logger.info(f"Attention saved to : {fn_attention}")
-
-    fn_output_ids = f'{tempfilename.name}_output_ids.pt'
-    logger.info(f"Saved attention to {fn_attention}")
-    torch.save(torch.tensor(output_ids),fn_output_ids)
+    # Save input_ids and attentions in the background, the handlers reading them wait for the write.
+    # Only the copy off the device happens here, it frees the device memory for the next query.
+    if isinstance(capture, AttentionSummary):
+        attentions, summary = None, capture.finalize(len(output_ids))
+    else:
+        attentions, summary = move_to_device(outputs.attentions, device='cpu'), None
+    full_attentions, full_capture = None, None
+    if attention_source == 'replay' and summary is None and len(output_ids) > 0:
+        full_attentions, full_capture = replay_attention(inputs, img_idx, output_ids, capture.policy)
+    artifact_store.submit(
+        attention_key, save_artifacts,
+        attention_key, move_to_device(input_ids, device='cpu'), attentions,
+        output_ids, capture, img_idx, summary,
+        pixel_values=move_to_device(inputs.pixel_values, device='cpu'),
+        full_attentions=full_attentions, full_capture=full_capture,
+        session_id=session_id,
+    )
 
     model.enc_attn_weights = []
     model.enc_attn_weights_vit = []
     # enc_attn_weights_vit = []
     # rel_maps = []
 
-    # Reconstruct processed image
-    img_std = torch.tensor(processor.image_processor.image_std).view(3,1,1)
-    img_mean = torch.tensor(processor.image_processor.image_mean).view(3,1,1)
-    img_recover = inputs.pixel_values[0].cpu() * img_std + img_mean
-    img_recover = to_pil_image(img_recover)
-
-    state.recovered_image = img_recover
+    state.recovered_image = recover_image(inputs.pixel_values)
     state.input_text_tokenized = input_text_tokenized
     state.output_ids_decoded = output_ids_decoded 
-    state.attention_key = tempfilename.name
+    state.attention_key = attention_key
     state.image_idx = img_idx
+    return state
+
+
+@torch.inference_mode()
+def run_generate(inputs, img_idx, capture, generate_kwargs):
+    '''
+        model.generate with `capture` in the attention hooks, reusing cached prompt prefixes when enabled.
+        Generation builds no autograd graph, the relevancy maps come from a replay (utils_replay).
+    '''
+    with model_lock:
+        if prefix_cache is not None and isinstance(capture, AttentionCapture):
+            return generate_with_prefix(model, prefix_cache, tensor_digest(inputs.pixel_values), img_idx, capture,
+                                        generate_kwargs, need_rows=capture.policy.rows == 'all')
+        model.attn_capture = capture
+        try:
+            return model.generate(**generate_kwargs)
+        finally:
+            model.attn_capture = None
+
+
+@spaces.GPU
+def run_relevancy_job(job):
+    '''Replay of a query with grad for the relevancy rows of `job`, in the thread of the relevancy service.'''
+    require_model()
+    artifact_store.wait(job.attention_key)
+    with artifact_store.reading(job.attention_key), model_lock:
+        compute_relevancy(model, job.attention_key, job.img_idx, job.map_types, job.token_indices, progress=job.report)
+
+
+# relevancy rows computed on demand, only the map types and tokens asked for
+relevancy_service = RelevancyService(run_relevancy_job)
+
+
+@holds_artifacts
+def ensure_relevancy(state, map_types=('llama',), token_indices=None, progress=None):
+    '''
+        Relevancy rows of `map_types` of the last query (of every generated token by default), computed by the
+        relevancy service on the first request. `progress(job)` is called while waiting for the job.
+    '''
+    if token_indices is None:
+        token_indices = range(len(state.output_ids_decoded))
+    job = relevancy_service.request(state.attention_key, state.image_idx, map_types, token_indices)
+    if job is not None:
+        relevancy_service.wait(job, progress)
+    return state
+
+
+def plot_relevancy(state, type_selector, progress=gr.Progress()):
+    if not hasattr(state, 'attention_key'):
+        return [], [], []
+    try:
+        ensure_relevancy(state, (type_selector,), progress=lambda job: progress(job.fraction(), desc=job.progress[2]))
+    except ValueError as e:
+        raise gr.Error(str(e))
+    figs, highlighted_tokens = handle_text_relevancy(state, type_selector)
+    return handle_relevancy(state, type_selector), figs, highlighted_tokens
 
+
+@spaces.GPU
+def lvlm_bot(state, temperature, top_p, max_new_tokens, capture_spec=None, request: gr.Request = None):   
+    inputs, img_idx, capture, generate_kwargs = prepare_generation(state, temperature, top_p, max_new_tokens, capture_spec)
+
+    # Generate
+    outputs = run_generate(inputs, img_idx, capture, generate_kwargs)
+
+    state = finish_generation(state, inputs, img_idx, outputs, capture, request)
     return state, to_gradio_chatbot(state) 
 
 
-def build_demo(args, embed_mode=False):
-    global model
+def run_worker_job(job):
+    '''
+        One query in a model worker process. The artifacts are written by the worker, the parent
+        gets the attention key and the small fields of the session state back.
+    '''
+    state = SimpleNamespace(prompt=job['prompt'], image=job['image'], messages=[[ROLE1, None]])
+    inputs, img_idx, capture, generate_kwargs = prepare_generation(
+        state, job['temperature'], job['top_p'], job['max_new_tokens'], job['capture_spec'])
+    outputs = run_generate(inputs, img_idx, capture, generate_kwargs)
+    attention_key = job['attention_key']
+    state = finish_generation(state, inputs, img_idx, outputs, capture, attention_key=attention_key)
+    artifact_store.when_written(attention_key, lambda error: notify(
+        ('written', attention_key, None if error is None else f'{type(error).__name__}: {error}')))
+    return dict(
+        answer=state.messages[-1][-1],
+        attention_key=attention_key,
+        image_idx=state.image_idx,
+        input_text_tokenized=state.input_text_tokenized,
+        output_ids_decoded=state.output_ids_decoded,
+        recovered_image=state.recovered_image,
+    )
+
+
+def on_worker_event(event):
+    kind, attention_key, error = event
+    if kind != 'written':
+        return
+    written = pending_writes.pop(attention_key, None)
+    if written is None:
+        return
+    if error is None:
+        written.set_result(None)
+    else:
+        written.set_exception(RuntimeError(f"Writing the artifacts of {attention_key} failed: {error}"))
+
+
+def lvlm_bot_pooled(state, temperature, top_p, max_new_tokens, capture_spec=None, request: gr.Request = None):
+    '''lvlm_bot on an idle model worker, the answer comes back with the key of the artifacts it wrote.'''
+    require_model()
+    if worker_pool is None:
+        return lvlm_bot(state, temperature, top_p, max_new_tokens, capture_spec, request)
+    session_id = request.session_hash if request is not None else None
+    attention_key = artifact_store.new_key(session_id)
+    # readers of the key wait until the worker reports the write
+    pending_writes[attention_key] = artifact_store.expect(attention_key, session_id)
+    try:
+        result = worker_pool(dict(
+            prompt=state.prompt, image=state.image, temperature=temperature, top_p=top_p,
+            max_new_tokens=max_new_tokens, capture_spec=capture_spec, attention_key=attention_key,
+        ))
+    except Exception as e:
+        written = pending_writes.pop(attention_key, None)
+        if written is not None:
+            written.set_exception(e)
+        artifact_store.delete(attention_key)
+        raise gr.Error(str(e))
+
+    state.messages[-1][-1] = result['answer']
+    state.recovered_image = result['recovered_image']
+    state.input_text_tokenized = result['input_text_tokenized']
+    state.output_ids_decoded = result['output_ids_decoded']
+    state.attention_key = attention_key
+    state.image_idx = result['image_idx']
+    return state, to_gradio_chatbot(state)
+
+
+def init_model_worker(args):
+    '''Start of a spawned model worker: the settings of `args` and the model with the weights the parent shared.'''
     global processor
+    global model
+    # the parent owns the artifact store root and its instance directory, the worker writes the keys it is given
+    configure(args, owns_artifacts=False)
+    processor, model = get_processor_model(args, worker=True)
+    if not getattr(args, 'no_warmup', False):
+        warmup_forward(processor, model)
+    install_vision_cache(args, model)
+
+
+def start_worker_pool(args, loaded_model):
+    '''Spawn the model workers once the parent wrote the weights they memory-map.'''
+    global worker_pool
+    num_workers = getattr(args, 'num_workers', 0)
+    if num_workers < 2 or worker_pool is not None:
+        return
+    if loaded_model.device.type != 'cpu':
+        logger.warning(f"Model workers need the model on the cpu, not {loaded_model.device}: queries run in process")
+        return
+    worker_pool = ModelWorkerPool(run_worker_job, num_workers=num_workers,
+                                  threads_per_worker=getattr(args, 'threads_per_worker', None),
+                                  on_event=on_worker_event, initializer=init_model_worker, initargs=(args,),
+                                  cores=parse_index_list(getattr(args, 'pin_cores', None)))
+    atexit.register(worker_pool.close)
+
+
+def batch_key(item):
+    '''
+        Requests are batched when they share the sampling parameters and capture policy.
+        Summary captures and key reduced captures depend on the image position of a single
+        sample, such requests run alone.
+    '''
+    state, temperature, top_p, max_new_tokens, capture_spec = item
+    try:
+        policy = CapturePolicy.from_string(capture_spec, default=capture_policy)
+    except ValueError:
+        return id(item)
+    if policy.mode == 'summary' or 'all' not in policy.keys or state.image is None:
+        return id(item)
+    return (temperature, top_p, policy.to_string())
+
+
+@spaces.GPU
+def generate_batch(items):
+    '''
+        Run the queries of `items` (lvlm_bot arguments) in one left padded generate call.
+        Returns per query (inputs, img_idx, outputs, capture) as finish_generation expects them.
+    '''
+    if len(items) == 1:
+        state, temperature, top_p, max_new_tokens, capture_spec = items[0]
+        inputs, img_idx, capture, generate_kwargs = prepare_generation(state, temperature, top_p, max_new_tokens, capture_spec)
+        outputs = run_generate(inputs, img_idx, capture, generate_kwargs)
+        return [(inputs, img_idx, outputs, capture)]
+
+    states = [item[0] for item in items]
+    _, temperature, top_p, _, capture_spec = items[0]
+    max_new_tokens = [int(item[3]) for item in items]
+    policy = CapturePolicy.from_string(capture_spec, default=capture_policy)
+
+    # the processor is shared with every other path, its padding side is only changed for this call
+    padding_side = processor.tokenizer.padding_side
+    processor.tokenizer.padding_side = 'left'
+    try:
+        inputs = processor(text=[state.prompt for state in states], images=[state.image for state in states],
+                           padding=True, return_tensors="pt").to(model.device)
+    finally:
+        processor.tokenizer.padding_side = padding_side
+    input_ids = inputs.input_ids
+    # position of the image token in the padded ids
+    img_ids = (input_ids == model.config.image_token_index).int().argmax(-1).tolist()
+    model.enc_attn_weights = []
+    model.enc_attn_weights_vit = []
+    capture = AttentionCapture(policy, img_ids[0])
+
+    if model.language_model.config.model_type == "gemma":
+        eos_token_id = processor.tokenizer('<end_of_turn>', add_special_tokens=False).input_ids[0]
+    else:
+        eos_token_id = processor.tokenizer.eos_token_id
+
+    start = time.time()
+    model_lock.acquire()
+    model.attn_capture = capture
+    try:
+        with torch.inference_mode():
+            outputs = model.generate(
+                    **inputs,
+                    do_sample=True if temperature > 0.001 else False,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max(max_new_tokens),
+                    use_cache=True,
+                    output_attentions=True,
+                    return_dict_in_generate=True,
+                    output_scores=True,
+                    eos_token_id=eos_token_id,
+                    pad_token_id=processor.tokenizer.pad_token_id,
+                )
+    finally:
+        model.attn_capture = None
+        model_lock.release()
+    elapsed = time.time() - start
+
+    samples = split_batch_outputs(outputs, input_ids, inputs.attention_mask, max_new_tokens, eos_token_id)
+    num_tokens = sum(len(sample.attentions) for sample in samples)
+    logger.info(f"Generated {num_tokens} tokens for a batch of {len(items)} in {elapsed:.2f}s ({num_tokens/elapsed:.1f} tokens/s)")
+
+    results = []
+    for b, sample in enumerate(samples):
+        sample_inputs = SimpleNamespace(input_ids=sample.sequences[:, :input_ids.shape[-1] - sample.pad],
+                                        pixel_values=inputs.pixel_values[b:b+1])
+        img_idx = img_ids[b] - sample.pad
+        results.append((sample_inputs, img_idx, sample, capture.for_sample(sample.pad, img_idx)))
+    return results
+
+
+def lvlm_bot_batched(state, temperature, top_p, max_new_tokens, capture_spec=None, request: gr.Request = None):
+    '''lvlm_bot through the micro-batcher: concurrent queries share one generate call.'''
+    require_model()
+    inputs, img_idx, outputs, capture = micro_batcher((state, temperature, top_p, max_new_tokens, capture_spec))
+    state = finish_generation(state, inputs, img_idx, outputs, capture, request)
+    return state, to_gradio_chatbot(state)
+
+
+@spaces.GPU
+def lvlm_bot_stream(state, temperature, top_p, max_new_tokens, capture_spec=None, request: gr.Request = None):
+    '''
+        Streaming version of lvlm_bot: generate runs on a thread and every decoded piece of the
+        answer is yielded to the chatbot together with the image attention of the latest step
+        (mean over layers and heads) drawn on the preprocessed image.
+    '''
+    from transformers import TextIteratorStreamer
+
+    inputs, img_idx, capture, generate_kwargs = prepare_generation(state, temperature, top_p, max_new_tokens, capture_spec)
+    img_recover = recover_image(inputs.pixel_values)
+    listener = ImageAttentionListener(img_idx, len(model.language_model.model.layers))
+    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    result = {}
+
+    def run_generate():
+        model_lock.acquire()
+        model.attn_capture = capture
+        model.attn_listener = listener
+        try:
+            with torch.inference_mode():
+                result['outputs'] = model.generate(**generate_kwargs, streamer=streamer)
+        except Exception as e:
+            result['error'] = e
+            # unblock the consumer
+            streamer.end()
+        finally:
+            model.attn_capture = None
+            model.attn_listener = None
+            model_lock.release()
+
+    thread = threading.Thread(target=run_generate, name='lvlm-generate')
+    thread.start()
+
+    partial_text = ''
+    heatmap = None
+    for new_text in streamer:
+        partial_text += new_text
+        state.messages[-1][-1] = partial_text
+        attn_map = listener.latest()
+        if attn_map is not None:
+            heatmap = draw_heatmap_on_image(attn_map, img_recover)
+        yield state, to_gradio_chatbot(state), heatmap
+    thread.join()
+    if 'error' in result:
+        logger.error(f"Generation failed: {result['error']}")
+        raise gr.Error(str(result['error']))
+
+    state = finish_generation(state, inputs, img_idx, result['outputs'], capture, request)
+    attn_map = listener.latest()
+    if attn_map is not None:
+        heatmap = draw_heatmap_on_image(attn_map, img_recover)
+    yield state, to_gradio_chatbot(state), heatmap
+
+
+def configure(args, owns_artifacts=True):
+    '''
+        Capture, encoding, artifact store and prefix cache settings of `args`, shared by the UI, batch_cli and
+        the model workers. With `owns_artifacts` the artifact store purges orphans, evicts and cleans up at exit,
+        without it (model workers) it only writes.
+    '''
     global system_prompt
     global ROLE0
     global ROLE1
-
-    if model is None:
-        processor, model = get_processor_model(args)
+    global capture_policy
+    global attn_encoding
+    global prefix_cache
+    global attention_source
+
+    capture_policy = CapturePolicy.from_args(args)
+    attention_source = getattr(args, 'attention_source', 'generate')
+    if attention_source == 'replay' and capture_policy.mode == 'attentions' and capture_policy.rows == 'all':
+        # the replay provides every row, decoding only needs to keep the last one
+        capture_policy = replace(capture_policy, rows='last')
+        logger.info("Attention source is the replay, decoding captures the last query rows only")
+    logger.info(f"Attention capture policy: {capture_policy.to_string()}")
+    attn_encoding = AttentionEncoding.from_args(args)
+    logger.info(f"Attention archive encoding: {attn_encoding.to_string()}")
+
+    artifact_store.configure(
+        root=getattr(args, 'artifact_dir', None),
+        quota_bytes=int(getattr(args, 'artifact_quota_gb', 20) * 2**30),
+        max_age=getattr(args, 'artifact_max_age_hours', 24) * 3600,
+        num_writers=getattr(args, 'artifact_writers', None),
+        # a model worker writes the keys the parent store owns, tracks and evicts
+        write_only=not owns_artifacts,
+    )
+    if owns_artifacts:
+        artifact_store.purge_orphans()
+        atexit.register(artifact_store.shutdown)
+    atexit.register(relevancy_service.shutdown)
 
     if 'gemma' in args.model_name_or_path:
         system_prompt = ''
         ROLE0 = 'user'
         ROLE1 = 'model'
 
+    prefix_cache_mb = getattr(args, 'prefix_cache_mb', 0)
+    if prefix_cache is None and prefix_cache_mb > 0:
+        # questions and turns about the same image only prefill their new ids
+        prefix_cache = PrefixCache(max_bytes=int(prefix_cache_mb * 2**20))
+
+
+def start_model_loader(args):
+    '''Load the model in the background, queries are refused until it is ready.'''
+    global model_loader
+    if model is None and model_loader is None:
+        model_loader = ModelLoader(args, warmup=not getattr(args, 'no_warmup', False),
+                                   on_loaded=lambda p, m: on_model_loaded(args, p, m)).start()
+    return model_loader
+
+
+def build_demo(args, embed_mode=False):
+    global micro_batcher
+
+    # the UI reports the loading progress meanwhile
+    start_model_loader(args)
+    configure(args)
+
+    # stream the answer token by token with a live image attention heatmap
+    stream = getattr(args, 'stream', False)
+
     textbox = gr.Textbox(show_label=False, placeholder="Enter text and press ENTER", container=False)
     with gr.Blocks(title="Sailency Inspector Experimental", theme=gr.themes.Default(), css=block_css) as demo:
         state = gr.State()
 
         if not embed_mode:
             gr.Markdown(title_markdown)
+        model_status_md = gr.Markdown(model_status())
+        model_status_timer = gr.Timer(1.0, active=model is None)
+        model_status_timer.tick(refresh_model_status, None, [model_status_md, model_status_timer], queue=False)
 
         with gr.Tab("Generation"):
             with gr.Row():
@@ -252,10 +800,18 @@ def build_demo(args, embed_mode=False):
                         temperature = gr.Slider(minimum=0.0, maximum=1.0, value=0.2, step=0.1, interactive=True, label="Temperature",)
                         top_p = gr.Slider(minimum=0.0, maximum=1.0, value=0.7, step=0.1, interactive=True, label="Top P",)
                         max_output_tokens = gr.Slider(minimum=0, maximum=512, value=64, step=64, interactive=True, label="Max new output tokens",)
+                        capture_spec = gr.Textbox(
+                            value="", label="Attention capture policy",
+                            placeholder=f"default: {capture_policy.to_string()}",
+                            info="e.g. layers=0-7,31;heads=all;rows=last;keys=image,text;dtype=float16 (rollout, flow and causality need rows=all), "
+                                 "or mode=summary for constant memory statistics that only feed the Mean Token tabs",
+                        )
 
 
                 with gr.Column(scale=6):
                     chatbot = gr.Chatbot(elem_id="chatbot", label="Chatbot", height=400)
+                    live_heatmap = gr.Image(type="pil", label="Image attention of the latest token (mean over layers and heads)",
+                                            height=200, interactive=False, visible=stream)
                     with gr.Row():
                         with gr.Column(scale=8):
                             textbox.render()
@@ -337,11 +893,9 @@ def build_demo(args, embed_mode=False):
                 fetch img_attn
                 img_attn = mha[img_idx:img_idx+576]
                 
-                for layer: for head:
-                cummuatively add img_attn over all heads in a layer
-                average the attn over number of selected tokens
-
-                sort on head with highest response
+                average img_attn over the selected tokens, every layer and head at once
+                sort the heads of all layers on highest response
+                show one page of the ranking
             ```
             """)
             # for more details refer : handle_attentions_i2t,
@@ -369,8 +923,12 @@ def build_demo(args, embed_mode=False):
                 # i2t_attn_head_mean_plot = gr.Plot(label="Image-to-Text attention average per head")
                 i2t_attn_head_mean_plot = gr.Plot(label="Raw attention per head for all layers")
             with gr.Row():
-                # saliency over all heads and all layers
-                i2t_attn_gallery = gr.Gallery(type="pil", label='Attention heatmaps', columns=8, interactive=False)
+                # one page of the heads of all layers, ranked by mean attention
+                i2t_heads_per_page = gr.Dropdown(choices=[16, 32, 64, 128], value=HEADS_PER_PAGE, label="Heads per page")
+                i2t_page = gr.Slider(1, 1, value=1, step=1, label="Page (heads ranked by mean attention)")
+            with gr.Row():
+                # saliency over the heads of the page, encoded as webp
+                i2t_attn_gallery = gr.Gallery(type="pil", format="webp", label='Attention heatmaps', columns=8, interactive=False)
 
         with gr.Tab("Attention Rollout [Experimental]"):
             with gr.Row():
@@ -475,6 +1033,32 @@ def build_demo(args, embed_mode=False):
             with gr.Row():
                 attn_ana_plot_2 = gr.Plot(label="Attention plot")
 
+        with gr.Tab("Relevancy"):
+            gr.Markdown("""
+            ### How To Use Relevancy:
+            ```
+            Generation runs without gradients. The first request of a map type replays
+            the query (prompt + generated tokens, teacher forced) with gradients in the
+            background and computes that type only, later requests reuse the stored maps.
+            ```
+            """)
+            with gr.Row():
+                relevancy_type = gr.Dropdown(choices=["llama", "vit", "all", "all_v2"], value="llama", label="Relevancy map")
+                relevancy_submit = gr.Button(value="Plot relevancy", interactive=True)
+            with gr.Row():
+                relevancy_gallery = gr.Gallery(type="pil", label='Relevancy maps', columns=8, interactive=False)
+            with gr.Row():
+                relevancy_highlighted = gr.HighlightedText(label="Image relevancy of the generated words (percentile among the most relevant input words)",
+                                                           combine_adjacent=False, interactive=False)
+            with gr.Row():
+                relevancy_txt_gallery = gr.Gallery(type="pil", label='Most relevant input words', columns=4, interactive=False)
+
+        relevancy_submit.click(
+            plot_relevancy,
+            [state, relevancy_type],
+            [relevancy_gallery, relevancy_txt_gallery, relevancy_highlighted],
+        )
+
         
         reset_boxes_btn.click(
             handle_box_reset, 
@@ -506,8 +1090,18 @@ def build_demo(args, embed_mode=False):
 
         attn_submit.click(
             handle_attentions_i2t,
-            [state, generated_text],
-            [generated_text, imagebox_recover, i2t_attn_gallery, i2t_attn_head_mean_plot]
+            [state, generated_text, i2t_heads_per_page],
+            [generated_text, imagebox_recover, i2t_attn_gallery, i2t_attn_head_mean_plot, i2t_page]
+        )
+        i2t_page.release(
+            handle_attentions_i2t_page,
+            [state, generated_text, i2t_page, i2t_heads_per_page],
+            [i2t_attn_gallery, i2t_page]
+        )
+        i2t_heads_per_page.change(
+            handle_attentions_i2t_page,
+            [state, generated_text, i2t_page, i2t_heads_per_page],
+            [i2t_attn_gallery, i2t_page]
         )
 
 
@@ -518,20 +1112,38 @@ def build_demo(args, embed_mode=False):
 
         clear_btn.click(
             clear_history,
-            None,
+            [state],
             [state, chatbot, textbox, imagebox, imagebox_recover, generated_text, i2t_attn_gallery ] ,
             queue=False
         )
 
+        bot_fn = lvlm_bot_stream if stream else lvlm_bot
+        bot_outputs = [state, chatbot, live_heatmap] if stream else [state, chatbot]
+        # concurrent queries are coalesced into batched generate calls (not with streaming)
+        max_batch = getattr(args, 'max_batch', 1)
+        if max_batch > 1 and not stream:
+            if micro_batcher is None:
+                micro_batcher = MicroBatcher(generate_batch, max_batch=max_batch,
+                                             max_wait=getattr(args, 'max_wait', 0.05), key=batch_key)
+                atexit.register(micro_batcher.close)
+            bot_fn = lvlm_bot_batched
+        # or every query runs on one of the forked model workers
+        num_workers = getattr(args, 'num_workers', 0)
+        if num_workers > 1 and not stream and bot_fn is lvlm_bot:
+            bot_fn = lvlm_bot_pooled
+        concurrency_limit = {lvlm_bot_batched: max_batch, lvlm_bot_pooled: num_workers}.get(bot_fn, 1)
+
         textbox.submit(
             add_text,
             [state, textbox, imagebox, image_process_mode],
             [state, chatbot, textbox, imagebox],
             queue=False
-        ).then(
-            lvlm_bot,
-            [state, temperature, top_p, max_output_tokens],
-            [state, chatbot] ,
+        ).success(
+            bot_fn,
+            [state, temperature, top_p, max_output_tokens, capture_spec],
+            bot_outputs,
+            concurrency_limit=concurrency_limit,
+            concurrency_id="generate",
         ).then(
             attn_update_slider,
             [state],
@@ -543,16 +1155,19 @@ def build_demo(args, embed_mode=False):
             [state, textbox, imagebox, image_process_mode],
             [state, chatbot, textbox, imagebox],
             queue=False
-        ).then(
-            lvlm_bot,
-            [state, temperature, top_p, max_output_tokens],
-            [state, chatbot],
+        ).success(
+            bot_fn,
+            [state, temperature, top_p, max_output_tokens, capture_spec],
+            bot_outputs,
+            concurrency_limit=concurrency_limit,
+            concurrency_id="generate",
         ).then(
             attn_update_slider,
             [state],
             [state, attn_select_layer]
         )
 
+        demo.unload(release_session)
 
     return demo
 
@@ -1,26 +1,85 @@
 
+import os
+import time
+import hashlib
 import logging
 import base64
+import threading
 from io import BytesIO
+from contextlib import contextmanager
 from PIL import Image
 import torch
+
+from utils_backend import decode_throughput, model_dtype, optimize_model
+from utils_quant import load_quantized_model
+from utils_offload import AttentionOffload
 # from torchvision.transforms.functional import to_pil_image
-from transformers import LlavaForConditionalGeneration, AutoProcessor
-from transformers import BitsAndBytesConfig
 
-func_to_enable_grad = '_sample'
-setattr(LlavaForConditionalGeneration, func_to_enable_grad, torch.enable_grad(getattr(LlavaForConditionalGeneration, func_to_enable_grad)))
+logger = logging.getLogger(__name__)
 
-try:
-    import intel_extension_for_pytorch as ipex
-except ModuleNotFoundError:
-    pass
+DEFAULT_SHARED_WEIGHTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lvlm-interpret', 'shared')
 
-logger = logging.getLogger(__name__)
 
-def get_processor_model(args):
-    #outputs: attn_output, attn_weights, past_key_value
-    processor = AutoProcessor.from_pretrained(args.model_name_or_path)
+@contextmanager
+def startup_phase(name, phases=None):
+    '''Time and log a phase of the startup, the seconds are recorded in `phases` under `name`.'''
+    start = time.time()
+    yield
+    elapsed = time.time() - start
+    if phases is not None:
+        phases[name] = elapsed
+    logger.info(f"Startup phase {name}: {elapsed:.2f}s")
+
+
+def shared_weights_path(args, dtype):
+    '''State dict file the model workers memory-map, written once by the parent for the float model.'''
+    spec = f'{args.model_name_or_path}|{dtype}'
+    name = os.path.basename(args.model_name_or_path.rstrip('/'))
+    return os.path.join(DEFAULT_SHARED_WEIGHTS_DIR, f'{name}-{hashlib.sha256(spec.encode()).hexdigest()[:16]}.pt')
+
+
+def save_shared_weights(args, model):
+    fn_weights = shared_weights_path(args, model_dtype(args))
+    if os.path.exists(fn_weights):
+        return fn_weights
+    os.makedirs(os.path.dirname(fn_weights), exist_ok=True)
+    torch.save(model.state_dict(), fn_weights + '.tmp')
+    os.replace(fn_weights + '.tmp', fn_weights)
+    logger.info(f"Weights shared with the model workers through {fn_weights}")
+    return fn_weights
+
+
+def load_shared_model(args, dtype):
+    '''
+        The float model of a model worker: built on the meta device and assigned the memory-mapped state dict
+        the parent wrote, the workers share its pages instead of holding a copy each.
+    '''
+    from transformers import AutoConfig, GenerationConfig, LlavaForConditionalGeneration
+    from accelerate import init_empty_weights
+
+    fn_weights = shared_weights_path(args, dtype)
+    config = AutoConfig.from_pretrained(args.model_name_or_path, return_dict_in_generate=True, output_attentions=True)
+    with init_empty_weights():
+        model = LlavaForConditionalGeneration._from_config(config, attn_implementation="eager", torch_dtype=dtype)
+    model.load_state_dict(torch.load(fn_weights, weights_only=True, mmap=True), assign=True, strict=True)
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(args.model_name_or_path)
+    except OSError:
+        pass
+    return model.eval()
+
+
+def get_processor_model(args, phases=None, worker=False):
+    '''
+        With `worker` the model of a model worker process: the weights are memory-mapped from the file the
+        parent wrote (the quantized ones from the quantization cache).
+    '''
+    # transformers is only imported here, the server can bind while it loads
+    with startup_phase('processor', phases):
+        from transformers import LlavaForConditionalGeneration, AutoProcessor
+        from transformers import BitsAndBytesConfig
+        #outputs: attn_output, attn_weights, past_key_value
+        processor = AutoProcessor.from_pretrained(args.model_name_or_path)
 
     if args.load_4bit:
         quant_config = BitsAndBytesConfig(
@@ -38,35 +97,101 @@ def get_processor_model(args):
     
     # we will try to use eager implementation. flash attn does not support
     # output_attentions=True
-    model = LlavaForConditionalGeneration.from_pretrained(
-        args.model_name_or_path, torch_dtype=torch.bfloat16, 
-        quantization_config=quant_config, low_cpu_mem_usage=True, device_map="auto",
-        attn_implementation="eager",
-        return_dict_in_generate=True,
-        output_attentions=True
-    )
+    backend = getattr(args, 'backend', 'default')
+    quantize = getattr(args, 'quantize', 'none')
+
+    def load_model():
+        return LlavaForConditionalGeneration.from_pretrained(
+            args.model_name_or_path, torch_dtype=model_dtype(args), 
+            quantization_config=quant_config, low_cpu_mem_usage=True,
+            device_map="cpu" if backend == 'cpu-optimized' or quantize != 'none' else "auto",
+            attn_implementation="eager",
+            return_dict_in_generate=True,
+            output_attentions=True
+        )
+
+    with startup_phase('weights', phases):
+        if quantize != 'none':
+            # cpu int8 linears instead of bitsandbytes, cached on disk after the first start
+            model = load_quantized_model(args, model_dtype(args), load_model)
+        elif worker:
+            model = load_shared_model(args, model_dtype(args))
+        else:
+            model = load_model()
+    if not worker and quantize == 'none' and getattr(args, 'num_workers', 0) > 1 and model.device.type == 'cpu':
+        # before the backend prepacks them
+        with startup_phase('share weights', phases):
+            save_shared_weights(args, model)
     model.vision_tower.config.output_attentions = True
+    # generation runs without grad, the relevancy replay takes its gradients at the embeddings
+    model.requires_grad_(False)
+    with startup_phase('hooks', phases):
+        register_attention_hooks(model)
+    if getattr(args, 'offload_attention', False):
+        # the relevancy replay keeps the attention of every layer and step for the backward
+        model.attention_offload = AttentionOffload(model)
+    if backend == 'cpu-optimized':
+        optimize_backend(args, processor, model, phases)
+    return processor, model
+
 
+def optimize_backend(args, processor, model, phases=None):
+    '''Apply the cpu-optimized backend, with --benchmark_backend the decode tokens / s before and after.'''
+    benchmark = getattr(args, 'benchmark_backend', False)
+    if benchmark:
+        with startup_phase('benchmark eager', phases):
+            eager_rate = decode_throughput(processor, model)
+    with startup_phase('optimize', phases):
+        method = optimize_model(model)
+    model.backend_report = f"cpu-optimized ({method})"
+    if benchmark:
+        with startup_phase('benchmark optimized', phases):
+            optimized_rate = decode_throughput(processor, model)
+        model.backend_report += (f": {optimized_rate:.2f} tokens/s vs {eager_rate:.2f} tokens/s eager "
+                                 f"({optimized_rate / eager_rate:.2f}x)")
+    logger.info(f"Backend {model.backend_report}")
+
+
+def register_attention_hooks(model):
+    '''Hooks on the language model and vision tower attentions for the relevancy maps and the attention capture.'''
     # Relevancy map
     # set hooks to get attention weights
     model.enc_attn_weights = []
+    # set per generate call to an AttentionCapture to reduce what ends up in outputs.attentions
+    model.attn_capture = None
+    # set per generate call to a callable(layer_idx, attn_weights) that watches every step
+    model.attn_listener = None
+    # towers ('llama', 'vit') whose weights the hooks keep for the relevancy, set by the replay only
+    model.attn_retain = ()
+    # an AttentionOffload moving the retained weights to host memory (--offload_attention)
+    model.attention_offload = None
     #outputs: attn_output, attn_weights, past_key_value
-    def forward_hook(module, inputs, output): 
-        if output[1] is None:
-            logger.error(
-                ("Attention weights were not returned for the encoder. "
-                "To enable, set output_attentions=True in the forward pass of the model. ")
-            )
+    def make_forward_hook(layer_idx):
+        def forward_hook(module, inputs, output): 
+            if output[1] is None:
+                logger.error(
+                    ("Attention weights were not returned for the encoder. "
+                    "To enable, set output_attentions=True in the forward pass of the model. ")
+                )
+                return output
+
+            if model.attn_listener is not None:
+                model.attn_listener(layer_idx, output[1])
+            capture = model.attn_capture
+            # only the relevancy replay keeps the weights and their gradients, generation never holds them
+            if 'llama' in model.attn_retain and torch.is_grad_enabled() and (capture is None or capture.retain):
+                output[1].retain_grad()
+                if model.attention_offload is not None:
+                    model.attention_offload.offload(output[1])
+                model.enc_attn_weights.append(output[1])
+            if capture is not None:
+                output = (output[0], capture.reduce(layer_idx, output[1])) + tuple(output[2:])
             return output
-        
-        output[1].requires_grad_(True)
-        output[1].retain_grad()
-        model.enc_attn_weights.append(output[1])
-        return output
+        return forward_hook
 
     hooks_pre_encoder, hooks_encoder = [], []
-    for layer in model.language_model.model.layers:
-        hook_encoder_layer = layer.self_attn.register_forward_hook(forward_hook)
+    for layer_idx, layer in enumerate(model.language_model.model.layers):
+        hook_encoder_layer = layer.self_attn.register_forward_hook(make_forward_hook(layer_idx))
         hooks_pre_encoder.append(hook_encoder_layer)
 
     model.enc_attn_weights_vit = []
@@ -81,8 +206,12 @@ def get_processor_model(args):
             )
             return output
 
-        output[1].requires_grad_(True)
+        if ('vit' not in model.attn_retain or not torch.is_grad_enabled()
+                or (model.attn_capture is not None and not model.attn_capture.retain)):
+            return output
         output[1].retain_grad()
+        if model.attention_offload is not None:
+            model.attention_offload.offload(output[1])
         model.enc_attn_weights_vit.append(output[1])
         return output
 
@@ -90,8 +219,86 @@ def get_processor_model(args):
     for layer in model.vision_tower.vision_model.encoder.layers:
         hook_encoder_layer_vit = layer.self_attn.register_forward_hook(forward_hook_image_processor)
         hooks_pre_encoder_vit.append(hook_encoder_layer_vit)
-    
-    return processor, model
+
+
+@torch.no_grad()
+def warmup_forward(processor, model):
+    '''One forward pass on a blank image, the first query does not pay for the lazy CUDA / kernel setup.'''
+    image = Image.new('RGB', (336, 336), (255, 255, 255))
+    if processor.tokenizer.chat_template is not None:
+        prompt = processor.tokenizer.apply_chat_template(
+            [{"role": "user", "content": "<image>\nWhat is in the image?"}], tokenize=False, add_generation_prompt=True)
+    else:
+        prompt = "USER: <image>\nWhat is in the image?\nASSISTANT:"
+    inputs = processor(text=prompt, images=image, return_tensors="pt").to(model.device)
+    try:
+        model(**inputs, use_cache=False)
+    finally:
+        model.enc_attn_weights = []
+        model.enc_attn_weights_vit = []
+
+
+class ModelLoader:
+    '''
+        Loads the processor and model of `args` on a background thread so the server can
+        bind and report the progress meanwhile. The startup phases (processor, weights, hooks,
+        warmup forward) are timed in `phases`. `on_loaded(processor, model)` runs on the
+        loader thread once the model is ready.
+    '''
+    def __init__(self, args, warmup=True, on_loaded=None):
+        self.args = args
+        self.warmup = warmup
+        self.on_loaded = on_loaded
+        self.phases = {}
+        self.phase = None
+        self.error = None
+        self.backend_report = None
+        self.ready = threading.Event()
+        self._started = None
+        self._thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+
+    def start(self):
+        self._started = time.time()
+        self._thread.start()
+        return self
+
+    def _load(self):
+        try:
+            self.phase = 'processor, weights and hooks'
+            processor, model = get_processor_model(self.args, phases=self.phases)
+            self.backend_report = getattr(model, 'backend_report', None)
+            if self.warmup:
+                self.phase = 'warmup forward'
+                with startup_phase('warmup', self.phases):
+                    warmup_forward(processor, model)
+            if self.on_loaded is not None:
+                self.on_loaded(processor, model)
+        except Exception as e:
+            logger.exception(f"Loading {self.args.model_name_or_path} failed")
+            self.error = e
+        else:
+            logger.info(f"Model {self.args.model_name_or_path} ready in {time.time() - self._started:.2f}s, "
+                        f"startup phases: {dict((k, round(v, 2)) for k, v in self.phases.items())}")
+        finally:
+            self.phase = None
+            self.ready.set()
+
+    def wait(self, timeout=None):
+        '''Block until the model is loaded, returns False on timeout. Raises if loading failed.'''
+        if not self.ready.wait(timeout):
+            return False
+        if self.error is not None:
+            raise RuntimeError(f"Loading {self.args.model_name_or_path} failed: {self.error}")
+        return True
+
+    def status(self):
+        if self.error is not None:
+            return f"Model failed to load: {self.error}"
+        if self.ready.is_set():
+            backend = f", {self.backend_report}" if self.backend_report else ""
+            return f"Model ready ({self.args.model_name_or_path}, loaded in {sum(self.phases.values()):.1f}s{backend})"
+        return (f"Loading {self.args.model_name_or_path}: {self.phase or 'starting'} "
+                f"({time.time() - self._started:.0f}s)")
 
 def process_image(image, image_process_mode, return_pil=False, image_format='PNG', max_len=1344, min_len=672):
     logger.info("this is buggy in the new version is it?")
@@ -159,6 +366,9 @@ def move_to_device(input, device='cpu'):
 
     if isinstance(input, torch.Tensor):
         return input.to(device).detach()
+    elif input is None:
+        # layers dropped by the attention capture policy
+        return None
     elif isinstance(input, list):
         return [move_to_device(inp) for inp in input]
     elif isinstance(input, tuple):
@@ -0,0 +1,108 @@
+import logging
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# smaller saved tensors stay on the device, the copy would cost more than it frees
+MIN_OFFLOAD_BYTES = 2**20
+
+
+class AttentionOffload:
+    '''
+        Layer-wise offload of the relevancy replay (--offload_attention). The attention weights the hooks retain
+        move to pinned host memory as soon as their layer is done, and so do the tensors autograd saves for the
+        backward. The device then holds the working set of one layer, not the attention of every layer and step.
+        The copies run on a side stream. A retained weight keeps its autograd identity, as a graph input of the
+        gradients, with an empty device storage; `attention_values` pages its values back for the relevancy.
+        Without cuda nothing is offloaded.
+    '''
+    def __init__(self, model):
+        self.enabled = torch.cuda.is_available() and any(p.device.type == 'cuda' for p in model.parameters())
+        # the weights are saved for the backward too, they are on the device anyway
+        self._parameters = set(t.data_ptr() for t in list(model.parameters()) + list(model.buffers()))
+        self._streams = {}
+        self.offloaded_bytes = 0
+        if not self.enabled:
+            logger.warning("--offload_attention needs the model on a cuda device, the attention stays where it is")
+
+    def _stream(self, device):
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device)
+        return self._streams[device]
+
+    def _to_host(self, tensor):
+        '''Pinned host copy of `tensor` on the side stream, returns (host copy, event of the copy).'''
+        stream = self._stream(tensor.device)
+        stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        with torch.cuda.stream(stream):
+            host.copy_(tensor, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(stream)
+        # the allocator does not reuse the device memory before the copy is done
+        tensor.record_stream(stream)
+        self.offloaded_bytes += host.numel() * host.element_size()
+        return host, ready
+
+    def offload(self, tensor):
+        '''Move the values of the retained attention `tensor` to the host, in place.'''
+        if not self.enabled or tensor.device.type != 'cuda':
+            return tensor
+        tensor._host_values = self._to_host(tensor.detach())
+        tensor.data = torch.empty(0, dtype=tensor.dtype, device=tensor.device)
+        return tensor
+
+    @contextmanager
+    def saved_tensors(self):
+        '''Tensors saved for the backward in pinned host memory, copied back to the device when the backward uses them.'''
+        if not self.enabled:
+            yield
+            return
+
+        def pack(tensor):
+            if (tensor.device.type != 'cuda' or tensor.numel() * tensor.element_size() < MIN_OFFLOAD_BYTES
+                    or tensor.data_ptr() in self._parameters):
+                return tensor
+            return tensor.device, self._to_host(tensor)
+
+        def unpack(packed):
+            if isinstance(packed, torch.Tensor):
+                return packed
+            device, (host, ready) = packed
+            torch.cuda.current_stream(device).wait_event(ready)
+            return host.to(device, non_blocking=True)
+
+        self.offloaded_bytes = 0
+        with torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+            yield
+        logger.info(f"Offloaded {self.offloaded_bytes / 2**30:.2f} GiB of attention and saved tensors to host memory")
+
+
+def attention_shape(tensor):
+    '''Shape of a retained attention tensor, offloaded or not.'''
+    offloaded = getattr(tensor, '_host_values', None)
+    return tensor.shape if offloaded is None else offloaded[0].shape
+
+
+def attention_values(tensor):
+    '''Values of a retained attention tensor on its device, paged back from the host when offloaded.'''
+    offloaded = getattr(tensor, '_host_values', None)
+    if offloaded is None:
+        return tensor
+    host, ready = offloaded
+    torch.cuda.current_stream(tensor.device).wait_event(ready)
+    return host.to(tensor.device, non_blocking=True)
+
+
+def paged_values(tensors):
+    '''Values of `tensors` in order, the copy of the next one is issued before the current one is used.'''
+    pending = None
+    for tensor in tensors:
+        values = attention_values(tensor)
+        if pending is not None:
+            yield pending
+        pending = values
+    if pending is not None:
+        yield pending
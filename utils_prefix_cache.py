@@ -0,0 +1,243 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import torch
+
+from utils_cache import nbytes_of
+
+logger = logging.getLogger(__name__)
+
+NUM_IMAGE_TOKENS = 576
+DEFAULT_PREFIX_CACHE_BYTES = 4 * 2**30
+# generate kwargs that describe the multimodal inputs, the rest is passed on to the language model
+_INPUT_KWARGS = ('input_ids', 'attention_mask', 'pixel_values')
+
+
+def expanded_length(num_ids, img_idx):
+    '''Length in the language model (image token expanded to its patches) of the first `num_ids` ids.'''
+    return num_ids + NUM_IMAGE_TOKENS - 1 if num_ids > img_idx else num_ids
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class _Prefix:
+    def __init__(self, image_digest, ids, img_idx, past_key_values, rows):
+        self.image_digest = image_digest
+        # unexpanded ids the cache covers, including the image token
+        self.ids = ids
+        self.img_idx = img_idx
+        # per layer (key, value) of the expanded ids
+        self.past_key_values = past_key_values
+        # per layer list of (1, heads, q, k) row blocks of the attention of the expanded ids, or None
+        self.rows = rows
+        self.nbytes = nbytes_of(past_key_values) + (nbytes_of(rows) if rows is not None else 0)
+
+    def cache(self, length):
+        '''DynamicCache of the first `length` expanded positions, the stored tensors are not modified.'''
+        from transformers import DynamicCache
+        return DynamicCache.from_legacy_cache(
+            tuple((k[:, :, :length], v[:, :, :length]) for k, v in self.past_key_values))
+
+    def attention_rows(self, layer, length):
+        '''(1, heads, length, length) attention of the first `length` expanded queries of `layer`.'''
+        blocks = self.rows[layer]
+        batch_size, num_heads = blocks[0].shape[:2]
+        rows = torch.zeros((batch_size, num_heads, length, length), dtype=blocks[0].dtype)
+        start = 0
+        for block in blocks:
+            if start >= length:
+                break
+            q_len = min(block.shape[2], length - start)
+            k_len = min(block.shape[3], length)
+            rows[:, :, start:start + q_len, :k_len] = block[:, :, :q_len, :k_len].cpu()
+            start += q_len
+        return rows
+
+
+class PrefixCache:
+    '''
+        KV cache of prompt prefixes that include the image, shared across questions and turns.
+        After every generation the key / values of the whole conversation so far are kept,
+        with its prefill attention rows when the capture needs every query row. A new query
+        reuses the longest prefix it shares with a cached one (same image) and only prefills
+        the ids after it. Entries are evicted least recently used beyond `max_bytes`.
+    '''
+    def __init__(self, max_bytes=DEFAULT_PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_ids = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, image_digest, ids, img_idx):
+        '''(prefix, number of shared ids) of the longest usable cached prefix of `ids`, (None, 0) if none.'''
+        best, best_len = None, 0
+        with self._lock:
+            for key, prefix in self._entries.items():
+                if prefix.image_digest != image_digest or prefix.img_idx != img_idx:
+                    continue
+                # at least the last id has to be fed to generate
+                shared = min(_common_prefix(prefix.ids, ids), len(ids) - 1)
+                if shared > img_idx and shared > best_len:
+                    best, best_len = key, shared
+            if best is None:
+                self.misses += 1
+                return None, 0
+            self._entries.move_to_end(best)
+            self.hits += 1
+            self.reused_ids += best_len
+            return self._entries[best], best_len
+
+    def store(self, image_digest, ids, img_idx, past_key_values, rows):
+        prefix = _Prefix(image_digest, tuple(ids), img_idx, past_key_values, rows)
+        if prefix.nbytes > self.max_bytes:
+            logger.debug(f"Not caching a prefix of {len(ids)} ids: {prefix.nbytes} bytes exceed the cache size")
+            return
+        with self._lock:
+            key = (image_digest, prefix.ids)
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = prefix
+            self.nbytes += prefix.nbytes
+            while self.nbytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reused_ids': self.reused_ids,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def _legacy_cache(past_key_values):
+    from transformers import DynamicCache
+    if isinstance(past_key_values, DynamicCache):
+        return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return tuple((k, v) for k, v in past_key_values)
+
+
+class _SplicedCapture:
+    '''
+        Capture of generate_with_prefix, applied in the hooks like the AttentionCapture it wraps. On a hit the
+        step 0 block of a layer only holds the rows of the last id: the cached prefix rows and the suffix rows
+        are spliced in front of it, one layer at a time, before `capture` reduces it. With `keep_rows` the full
+        rows of every step are copied to the host for the next prefix, the device only ever holds one layer.
+    '''
+    def __init__(self, capture, full_len, prefix=None, prefill_len=0, suffix_rows=None, keep_rows=False):
+        self.capture = capture
+        self.retain = capture.retain
+        self.full_len = full_len
+        self.prefix = prefix
+        self.prefill_len = prefill_len
+        self.suffix_rows = suffix_rows
+        self.rows = [] if keep_rows else None
+        self.step = -1
+
+    def _step0_block(self, layer_idx, last_row):
+        blocks = [self.prefix.attention_rows(layer_idx, self.prefill_len).to(last_row.device, last_row.dtype)]
+        if self.suffix_rows is not None:
+            blocks.append(self.suffix_rows[layer_idx])
+        blocks.append(last_row)
+        blocks = [torch.nn.functional.pad(b, (0, self.full_len - b.shape[-1])) for b in blocks]
+        return torch.cat(blocks, dim=2)
+
+    def reduce(self, layer_idx, attn, full_shape=None):
+        if layer_idx == 0:
+            self.step += 1
+        if self.step == 0:
+            if self.prefix is not None and self.rows is not None:
+                # the full step 0 block, as if the whole prompt was prefilled
+                attn = self._step0_block(layer_idx, attn)
+            full_shape = (attn.shape[0], attn.shape[1], self.full_len, self.full_len)
+        if self.rows is not None:
+            if self.step == 0:
+                self.rows.append([])
+            self.rows[layer_idx].append(attn.detach().cpu())
+        return self.capture.reduce(layer_idx, attn, full_shape=full_shape)
+
+
+def generate_with_prefix(model, prefix_cache, image_digest, img_idx, capture, generate_kwargs, need_rows):
+    '''
+        model.generate with prefix reuse. `capture` is applied in the hooks as during model.generate, step 0 is
+        reduced from the full prefill block (assembled from the cached rows when `need_rows`, only the last
+        row otherwise). Returns an outputs namespace shaped like the one of model.generate.
+    '''
+    input_ids = generate_kwargs['input_ids']
+    ids = input_ids[0].tolist()
+    num_ids = len(ids)
+    full_len = expanded_length(num_ids, img_idx)
+    prefix, shared = prefix_cache.lookup(image_digest, ids, img_idx)
+    if prefix is not None and need_rows and prefix.rows is None:
+        prefix, shared = None, 0
+
+    start = time.time()
+    model.attn_capture = None
+    try:
+        if prefix is None:
+            spliced = _SplicedCapture(capture, full_len, keep_rows=need_rows)
+            model.attn_capture = spliced
+            outputs = model.generate(**generate_kwargs)
+            sequences = outputs.sequences
+        else:
+            prefill_len = expanded_length(shared, img_idx)
+            past_key_values = prefix.cache(prefill_len)
+            # prefill the ids between the cached prefix and the last id, the hooks pass its rows on unreduced
+            suffix = input_ids[:, shared:num_ids - 1]
+            suffix_rows = None
+            if suffix.shape[-1]:
+                inputs_embeds = model.get_input_embeddings()(suffix)
+                cache_position = torch.arange(prefill_len, prefill_len + suffix.shape[-1], device=input_ids.device)
+                suffix_outputs = model.language_model(
+                    inputs_embeds=inputs_embeds, past_key_values=past_key_values, cache_position=cache_position,
+                    use_cache=True, output_attentions=need_rows, return_dict=True,
+                )
+                suffix_rows = suffix_outputs.attentions if need_rows else None
+            # the cached positions only need placeholder ids, generate feeds the last id
+            dummy_ids = torch.zeros((1, full_len), dtype=input_ids.dtype, device=input_ids.device)
+            dummy_ids[0, -1] = ids[-1]
+            language_kwargs = dict((k, v) for k, v in generate_kwargs.items() if k not in _INPUT_KWARGS)
+            spliced = _SplicedCapture(capture, full_len, prefix=prefix, prefill_len=prefill_len,
+                                      suffix_rows=suffix_rows, keep_rows=need_rows)
+            model.attn_capture = spliced
+            outputs = model.language_model.generate(
+                input_ids=dummy_ids,
+                attention_mask=torch.ones_like(dummy_ids),
+                past_key_values=past_key_values,
+                **language_kwargs,
+            )
+            generated = outputs.sequences[:, full_len:]
+            sequences = torch.cat([input_ids, generated], dim=-1)
+    finally:
+        model.attn_capture = None
+
+    logger.info(f"Generated {len(outputs.scores)} tokens in {time.time() - start:.2f}s, "
+                f"reused a prefix of {shared}/{num_ids} ids, prefix cache: {prefix_cache.stats()}")
+
+    # keep the whole conversation so far for the next question / turn
+    generated_ids = sequences[0, num_ids:].tolist()
+    prefix_cache.store(image_digest, ids + generated_ids[:-1], img_idx, _legacy_cache(outputs.past_key_values), spliced.rows)
+
+    return SimpleNamespace(sequences=sequences, attentions=outputs.attentions, scores=outputs.scores,
+                           past_key_values=outputs.past_key_values)
@@ -0,0 +1,145 @@
+import os
+import time
+import hashlib
+import logging
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+QUANTIZE_MODES = ('none', 'int8-weight-only', 'int8-dynamic')
+DEFAULT_QUANT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lvlm-interpret', 'quantized')
+# bumped when the layout of the cached state dict changes
+_CACHE_VERSION = 1
+# the query / key projections give the attention scores, kept in float unless asked for
+_SCORE_PROJECTIONS = ('q_proj', 'k_proj')
+
+
+class Int8Linear(torch.nn.Module):
+    '''
+        Linear layer with int8 weights and a float scale per output channel (symmetric). Without grad
+        'weight-only' multiplies the float activations with the int8 weights (_weight_int8pack_mm),
+        'dynamic' also quantizes the activations per row and runs an int8 x int8 matmul (_int_mm).
+        Passes with grad (the relevancy replay) and cpus without the kernels use the dequantized weights.
+    '''
+    def __init__(self, in_features, out_features, bias=True, mode='weight-only', device=None, dtype=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.register_buffer('weight', torch.zeros((out_features, in_features), dtype=torch.int8, device=device))
+        self.register_buffer('scale', torch.ones(out_features, dtype=torch.float32, device=device))
+        self.register_buffer('bias', torch.zeros(out_features, dtype=dtype, device=device) if bias else None)
+        self._fast = True
+
+    @classmethod
+    def from_linear(cls, linear, mode):
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp_min(1e-8) / 127
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, mode=mode,
+                     dtype=linear.weight.dtype)
+        module.weight = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        module.scale = scale
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().clone()
+        return module
+
+    def dequantize(self, dtype):
+        return (self.weight.to(torch.float32) * self.scale[:, None]).to(dtype)
+
+    def _fast_forward(self, x):
+        x2 = x.reshape(-1, self.in_features)
+        if self.mode == 'dynamic':
+            x_scale = x2.abs().amax(dim=-1, keepdim=True).float().clamp_min(1e-8) / 127
+            x_q = torch.round(x2.float() / x_scale).clamp(-127, 127).to(torch.int8)
+            y = torch._int_mm(x_q, self.weight.t()).float() * x_scale * self.scale
+            y = y.to(x.dtype)
+        else:
+            y = torch.ops.aten._weight_int8pack_mm(x2.contiguous(), self.weight, self.scale.to(x.dtype))
+        return y.reshape(x.shape[:-1] + (self.out_features,))
+
+    def forward(self, x):
+        if self._fast and not torch.is_grad_enabled():
+            try:
+                y = self._fast_forward(x)
+                return y + self.bias if self.bias is not None else y
+            except (RuntimeError, AttributeError) as e:
+                logger.warning(f"No int8 {self.mode} kernel for {tuple(x.shape)} {x.dtype} ({e}), using dequantized weights")
+                self._fast = False
+        return F.linear(x, self.dequantize(x.dtype), self.bias)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}'
+
+
+def _targets(model, include_qk=False):
+    '''(parent, name, linear) of the language model decoder linears, the lm head stays in float for exact logits.'''
+    for layer in model.language_model.model.layers:
+        for parent in (layer.self_attn, layer.mlp):
+            for name, child in parent.named_children():
+                if isinstance(child, (torch.nn.Linear, Int8Linear)) and (include_qk or name not in _SCORE_PROJECTIONS):
+                    yield parent, name, child
+
+
+def quantize_linears(model, mode, include_qk=False):
+    '''Replace the decoder linears of the language model by Int8Linear in place, returns the number replaced.'''
+    mode = mode.replace('int8-', '')
+    count = 0
+    for parent, name, linear in list(_targets(model, include_qk)):
+        setattr(parent, name, Int8Linear.from_linear(linear, mode))
+        count += 1
+    return count
+
+
+def _empty_int8_linears(model, mode, include_qk=False):
+    for parent, name, linear in list(_targets(model, include_qk)):
+        setattr(parent, name, Int8Linear(linear.in_features, linear.out_features, bias=linear.bias is not None,
+                                         mode=mode.replace('int8-', ''), device='meta', dtype=linear.weight.dtype))
+
+
+def quant_cache_path(args, dtype):
+    cache_dir = getattr(args, 'quantize_cache_dir', None) or DEFAULT_QUANT_CACHE_DIR
+    spec = f'{args.model_name_or_path}|{args.quantize}|qk={getattr(args, "quantize_qk", False)}|{dtype}|v{_CACHE_VERSION}'
+    name = os.path.basename(args.model_name_or_path.rstrip('/'))
+    return os.path.join(cache_dir, f'{name}-{args.quantize}-{hashlib.sha256(spec.encode()).hexdigest()[:16]}.pt')
+
+
+def load_quantized_model(args, dtype, load_float_model):
+    '''
+        Language model decoder linears in int8 (--quantize). The first start loads the float model with
+        `load_float_model()`, quantizes it and saves the state dict to the cache; later starts build the
+        model on the meta device and memory-map the cached state dict, without the float weights.
+    '''
+    from transformers import AutoConfig, GenerationConfig, LlavaForConditionalGeneration
+    from accelerate import init_empty_weights
+
+    include_qk = getattr(args, 'quantize_qk', False)
+    fn_cache = quant_cache_path(args, dtype)
+    if os.path.exists(fn_cache):
+        start = time.time()
+        config = AutoConfig.from_pretrained(args.model_name_or_path, return_dict_in_generate=True, output_attentions=True)
+        with init_empty_weights():
+            model = LlavaForConditionalGeneration._from_config(config, attn_implementation="eager", torch_dtype=dtype)
+        _empty_int8_linears(model, args.quantize, include_qk)
+        model.load_state_dict(torch.load(fn_cache, weights_only=True, mmap=True), assign=True, strict=True)
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(args.model_name_or_path)
+        except OSError:
+            pass
+        model.eval()
+        logger.info(f"Loaded the {args.quantize} model from {fn_cache} in {time.time() - start:.2f}s")
+        return model
+
+    model = load_float_model()
+    float_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    start = time.time()
+    count = quantize_linears(model, args.quantize, include_qk)
+    quant_bytes = sum(t.numel() * t.element_size() for t in model.state_dict().values())
+    logger.info(f"Quantized {count} linears to {args.quantize} in {time.time() - start:.2f}s: "
+                f"{float_bytes/2**30:.2f} GiB -> {quant_bytes/2**30:.2f} GiB")
+    os.makedirs(os.path.dirname(fn_cache), exist_ok=True)
+    torch.save(model.state_dict(), fn_cache + '.tmp')
+    os.replace(fn_cache + '.tmp', fn_cache)
+    logger.info(f"Quantized weights cached to {fn_cache}")
+    return model
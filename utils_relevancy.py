@@ -7,7 +7,6 @@ from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Un
 import torch
 import torch.distributed as dist
 from torch import nn
-import torch.nn.functional as F
 
 from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
 from transformers.utils import  logging
@@ -23,8 +22,15 @@ from transformers.generation.utils import GenerateOutput
 
 from tqdm import tqdm
 
+from utils_analytics import word_relevancy
+from utils_offload import attention_shape, paged_values
+
 logger = logging.get_logger(__name__)
 
+RELEVANCY_TYPES = ('llama', 'vit', 'all', 'all_v2')
+# bound on the batched gradients of the relevancy maps, beyond it tokens are processed in smaller chunks
+DEFAULT_GRAD_MEMORY_BYTES = 2 * 2**30
+
 SEPARATORS_LIST = ['.',',','?','!', ':', ';', '</s>', '/', '!', '(', ')', '[', ']', '{', '}', '<', '>', '|', '\\', '-', '_', '+', '=', '*', '&', '^', '%', '$', '#', '@', '!', '~', '`', ' ', '\t', '\n', '\r', '\x0b', '\x0c']
 
 
@@ -36,58 +42,149 @@ def avg_heads(cam, grad):
     cam = cam.clamp(min=0).mean(dim=0)
     return cam
 
+class CamHistory:
+    '''
+        Causal (N, N) cam of every llama layer over the steps so far. The rows of a decode step are written in
+        place into preallocated buffers, which double their capacity when full, where concatenating a row and a
+        column per layer and step copied the whole cam every step.
+    '''
+    def __init__(self, num_layers, device=None):
+        self.buffers = [None] * num_layers
+        self.sizes = [0] * num_layers
+        self.device = device
+
+    def append(self, layer, cam):
+        '''Add the (q, N) rows of one step, returns the (N, N) cam of the layer (a view of the buffer).'''
+        if self.device is None:
+            self.device = cam.device
+        num_rows, size = cam.shape
+        buffer = self.buffers[layer]
+        if buffer is None or buffer.shape[0] < size:
+            capacity = size if buffer is None else max(size, 2 * buffer.shape[0])
+            grown = torch.zeros((capacity, capacity), dtype=cam.dtype, device=self.device)
+            if buffer is not None:
+                old = self.sizes[layer]
+                grown[:old, :old] = buffer[:old, :old]
+            self.buffers[layer] = buffer = grown
+        # the columns of the new keys are still zero in the earlier rows (causal attention)
+        buffer[size - num_rows:size, :size] = cam.to(self.device)
+        self.sizes[layer] = size
+        return buffer[:size, :size]
+
+
+def propagate_rows(rows, cams):
+    '''
+        `rows` of the relevancy map R = (I + cam_L) ... (I + cam_1) that rule 6 accumulates over the layers
+        (R += cam @ R), as vector-matrix products from the last layer on: O(N^2) per row and layer instead of
+        the O(N^3) of the full map.
+    '''
+    for cam in reversed(cams):
+        rows = rows + rows @ cam.to(rows.device)
+    return rows
+
+
 # rule 6 from paper
-def handle_self_attention_image(R_i_i, enc_attn_weights, privious_cam=[]):
-    if privious_cam :
-        device = privious_cam[-1].device
-    else:
-        device = None
-    for i, blk in enumerate(enc_attn_weights):
-        grad = blk.grad.float().detach()
+def handle_self_attention_image(rows, enc_attn_weights, cam_history, grads=None):
+    cams = []
+    # paged back from the host one layer at a time when offloaded
+    for i, (blk, values) in enumerate(zip(enc_attn_weights, paged_values(enc_attn_weights))):
+        grad = (grads[i] if grads is not None else blk.grad).float().detach()
         # if model.use_lrp: # not used
         #     cam = blk[batch_no].detach()
         # else:
-        cam = blk.float().detach() # the attention of one layer
-        if device is None:
-            device = cam.device
+        cam = values.float().detach() # the attention of one layer
+        device = cam_history.device or cam.device
         cam = avg_heads(cam.to(device), grad.to(device))
-        # rebuild the privious attenions to the same size as the current attention
-        if len(privious_cam) != 0 and cam.shape[0] == 1:
-            len_seq, all_len_seq = privious_cam[i].shape
-            assert len_seq == all_len_seq, "The privious CAMs are not square"
-            new_column = torch.zeros(len_seq, 1).to(cam.device)
-            privious_cam[i] = torch.cat((privious_cam[i], new_column), dim=1)
-            privious_cam[i] = torch.cat((privious_cam[i], cam), dim=0)
-            cam = privious_cam[i]
-        elif cam.shape[0] != 1:
-            privious_cam.append(cam)
-        assert cam.shape == R_i_i.shape, "The attention weights and the relevancy map are not the same size"
-        R_i_i += torch.matmul(cam, R_i_i)
+        # the rows of this step extend the cam of the privious steps
+        cams.append(cam_history.append(i, cam))
         del grad, cam
-        # torch.cuda.empty_cache()
-
-    return R_i_i, privious_cam
-
-def handle_self_attention_image_vit(R_i_i_init, enc_attn_weights_vit, img_idx=None, add_skip=False, normalize=False):
-    if img_idx:
-        R_i_i = R_i_i_init[img_idx:img_idx+576, img_idx:img_idx+576] 
-        if add_skip:
-            R_i_i = R_i_i + torch.eye(R_i_i.shape[-1]).to(R_i_i.device)
-        # add a first column and first row of zeros to R_i_i - option #1
-        R_i_i = torch.cat((torch.zeros(1, R_i_i.shape[1]).to(R_i_i.device), R_i_i), dim=0)
-        R_i_i = torch.cat((torch.zeros(R_i_i.shape[0], 1).to(R_i_i.device), R_i_i), dim=1)
-        R_i_i[0,0] = 1
-    else:
-        R_i_i = R_i_i_init
-    if normalize:
-        R_i_i = handle_residual(R_i_i)
-    for j, blk_vit in enumerate(enc_attn_weights_vit): #577x577, 1x576
-        grad_vit = blk_vit.grad.float().detach()
-        cam_vit = blk_vit.float().detach()
-        cam_vit = avg_heads(cam_vit, grad_vit)
-        assert cam_vit.shape == R_i_i.shape, "The vit relevancy map and the llama relevancy map are not the same size"
-        R_i_i += torch.matmul(cam_vit, R_i_i)
-    return R_i_i
+    if rows is None:
+        return None
+    return propagate_rows(rows.to(cam_history.device), cams)
+
+def handle_self_attention_image_vit(rows, enc_attn_weights_vit, grads=None):
+    rows = rows.to(enc_attn_weights_vit[-1].device)
+    layers = list(reversed(range(len(enc_attn_weights_vit))))
+    values_vit = paged_values(enc_attn_weights_vit[j] for j in layers)
+    for j, blk_values in zip(layers, values_vit): #577x577, 1x576
+        blk_vit = enc_attn_weights_vit[j]
+        grad_vit = (grads[j] if grads is not None else blk_vit.grad).float().detach()
+        cam_vit = avg_heads(blk_values.float().detach(), grad_vit)
+        assert cam_vit.shape[-1] == rows.shape[-1], "The vit relevancy rows and the vit attention are not the same size"
+        rows = rows + rows @ cam_vit
+    return rows
+
+def _nbytes(tensors):
+    return sum(attention_shape(t).numel() * t.element_size() for t in tensors)
+
+
+def batched_attention_grads(outputs, output_ids, enc_attn_weights, enc_attn_weights_vit=(),
+                            memory_bytes=DEFAULT_GRAD_MEMORY_BYTES, token_indices=None):
+    '''
+        Gradients of the logit of generated tokens w.r.t. the attention weights, the same as one backward
+        per token leaves in `.grad`: for token t the blocks of step t (later steps do not reach its logit)
+        and the ViT blocks, whose retained grads accumulate over tokens 0..t. Consecutive tokens share one
+        batched vector-Jacobian product (is_grads_batched), chunked so the batched grads stay under
+        `memory_bytes`. Yields (token index, step grads, vit grads) for `token_indices` (default all),
+        the vit grads are updated in place by the next iteration.
+    '''
+    num_tokens = len(outputs.scores)
+    wanted = set(range(num_tokens) if token_indices is None else token_indices)
+    if not wanted:
+        return
+    enc_attn_weights_vit = list(enc_attn_weights_vit)
+    # the accumulated vit grads need every token up to the last wanted one
+    tokens = list(range(max(wanted) + 1)) if enc_attn_weights_vit else sorted(wanted)
+    targets = torch.stack([outputs.scores[t][0, output_ids[t]] for t in range(num_tokens)])
+    vit_bytes = _nbytes(enc_attn_weights_vit)
+    step_bytes = [_nbytes(blocks) for blocks in enc_attn_weights]
+    vit_sum = [torch.zeros(attention_shape(blk), dtype=blk.dtype, device=blk.device) for blk in enc_attn_weights_vit]
+
+    def fits(chunk):
+        # the vmapped backward holds about as much again as the batched grads
+        return 2 * len(chunk) * (vit_bytes + sum(step_bytes[t] for t in chunk)) <= memory_bytes
+
+    batched = True
+    position = 0
+    while position < len(tokens):
+        chunk = tokens[position:position + 1]
+        while batched and position + len(chunk) < len(tokens) and fits(tokens[position:position + len(chunk) + 1]):
+            chunk = tokens[position:position + len(chunk) + 1]
+
+        inputs = [blk for t in chunk for blk in enc_attn_weights[t]] + enc_attn_weights_vit
+        grad_outputs = torch.zeros((len(chunk), num_tokens), dtype=targets.dtype, device=targets.device)
+        grad_outputs[torch.arange(len(chunk)), torch.tensor(chunk)] = 1
+        try:
+            if len(chunk) > 1:
+                grads = torch.autograd.grad(targets, inputs, grad_outputs=grad_outputs, retain_graph=True,
+                                            allow_unused=True, is_grads_batched=True)
+            else:
+                grads = [None if g is None else g[None] for g in torch.autograd.grad(
+                    targets, inputs, grad_outputs=grad_outputs[0], retain_graph=True, allow_unused=True)]
+        except RuntimeError as e:
+            if len(chunk) == 1:
+                raise
+            # an op without a batching rule: one backward per token
+            logger.warning(f"Batched relevancy gradients failed ({e}), falling back to one token at a time")
+            batched = False
+            continue
+        grads = [torch.zeros((len(chunk),) + attention_shape(blk), dtype=blk.dtype, device=blk.device) if g is None else g
+                 for g, blk in zip(grads, inputs)]
+        num_step_grads = len(inputs) - len(enc_attn_weights_vit)
+        step_grads, vit_grads = grads[:num_step_grads], grads[num_step_grads:]
+        logger.debug(f"Relevancy gradients of tokens {chunk[0]}-{chunk[-1]} in one batch")
+
+        offset = 0
+        for k, t in enumerate(chunk):
+            num_layers = len(enc_attn_weights[t])
+            layers = [step_grads[offset + layer][k] for layer in range(num_layers)]
+            offset += num_layers
+            for acc, grad in zip(vit_sum, vit_grads):
+                acc += grad[k]
+            if t in wanted:
+                yield t, layers, vit_sum
+        position += len(chunk)
+
 
 def compute_rollout_attention(all_layer_matrices_raw, start_layer=0, average_positive=False, add_residual=False):
     all_layer_matrices = []
@@ -133,185 +230,124 @@ def handle_residual(orig_self_attention):
     self_attention += torch.eye(self_attention.shape[-1]).to(self_attention.device)
     return self_attention
 
-def compute_word_rel_map(tokens, target_index, R_i_i, separators_list, 
-                         current_rel_map, current_count, current_word, word_rel_maps):
-    if target_index == 0:
-        current_word = tokens[target_index]
-        current_rel_map = R_i_i
-        current_count = 1
-    # If the token is a part of the current word, add its relevancy map to the current word's relevancy map
-    else:
-        if not tokens[target_index].startswith('▁') and tokens[target_index] not in separators_list:
-            current_word += tokens[target_index]
-            # If current_rel_map is smaller, pad it with zeros
-            if current_rel_map.shape[0] < R_i_i.shape[0]:
-                # Calculate the padding sizes
-                padding = (0, R_i_i.shape[1] - current_rel_map.shape[1], 0, R_i_i.shape[0] - current_rel_map.shape[0])
-                # Pad rel_maps[1] with zeros
-                current_rel_map = F.pad(current_rel_map, padding, "constant", 0)
-            current_rel_map += R_i_i
-            current_count += 1
-        else:
-            # Otherwise, store the current word's relevancy map and start a new word
-            word_rel_maps[current_word] = current_rel_map / current_count
-            current_word = tokens[target_index]
-            current_rel_map = R_i_i
-            current_count = 1
-    return word_rel_maps, current_rel_map, current_count, current_word
-
-
-def construct_relevancy_map(tokenizer, model, input_ids, tokens, outputs, output_ids, img_idx, apply_normalization=True):
-    logger.debug('Tokens: %s', tokens)
-    enable_vit_relevancy = len(model.enc_attn_weights_vit) > 0
-    if enable_vit_relevancy:
-        enc_attn_weights_vit = model.enc_attn_weights_vit
-    enc_attn_weights = model.enc_attn_weights
-    device = outputs.attentions[-1][0][0].device
-
-    # compute rollout attention
-    # start_layer = len(enc_attn_weights_vit)-2 # the last layer is not considered for llava
-    # rollout_vit, layer_attn_avg = compute_rollout_attention(enc_attn_weights_vit, start_layer,average_positive=False, add_residual=False)
-
-    # compute relevancy maps
-    rel_maps = []
-    rel_maps_all = []
-    rel_maps_vit = []
-    rel_maps_all_generated_token = []
-
-    num_generated_tokens = len(outputs.attentions)
+# handle_residual of the `rows` of a map, `index` is the column of the diagonal of every row
+def handle_residual_rows(orig_rows, index):
+    rows = orig_rows.clone()
+    row_idx = range(rows.shape[0])
+    rows[row_idx, index] -= 1
+    assert rows[row_idx, index].min() >= 0
+    sum_rows = rows.sum(dim=-1, keepdim=True)
+    sum_rows[sum_rows == 0] = 1
+    rows = rows / sum_rows
+    rows[row_idx, index] += 1
+    return rows
+
+def token_relevancy_rows(model, outputs, output_ids, img_idx, map_types=RELEVANCY_TYPES, token_indices=None,
+                         apply_normalization=True, grad_memory_bytes=DEFAULT_GRAD_MEMORY_BYTES, progress=None):
+    '''
+        Relevancy of the generated tokens `token_indices` (default all) for the `map_types` only. Yields
+        (token index, {map type: row}) with the (1, N) last row of the llama map and the (1, 577) CLS row
+        of the vit maps. The llama cams accumulate over the steps, so the gradients of every token up to
+        the last one asked for are computed; the vit blocks are left out unless a vit map is asked for.
+        `progress(done, total)` is called after every token.
+    '''
+    num_generated_tokens = len(outputs.scores)
     num_self_att_layers = len(outputs.attentions[0])
-    assert num_generated_tokens == len(outputs.scores)
+    enc_attn_weights = model.enc_attn_weights
     assert num_generated_tokens*num_self_att_layers == len(enc_attn_weights), f'{num_generated_tokens}x{num_self_att_layers} != {len(enc_attn_weights)}'
     # rearenge the attention weights the same as outputs.attentions
     enc_attn_weights = [enc_attn_weights[i*num_self_att_layers : (i+1)*num_self_att_layers] for i in range(num_generated_tokens)]
-
-
-    assert len(tokens) == len(outputs.scores), f'Length of tokens {len(tokens)} is not equal to the length of outputs.scores {len(outputs.scores)}\ntokens: {tokens}'
-    clean_tokens = []
-
-    # Initialize dictionaries
-    word_rel_maps_llama, word_rel_maps_all, word_rel_maps_vit, word_rel_maps_all_generated_token = {}, {}, {}, {}
-    word_counts = {}
-
-    # Initialize the averaged attention map for the first token
-    privious_cam = []
-
-    # Initialize current_rel_map and current_word variables
-    current_rel_map, current_rel_map_all, current_rel_map_all_generated_token, current_rel_map_vit = None, None, None, None
-    current_word, current_word_all, current_word_vit, current_word_all_generated_token = None, None, None, None
-
-    # Initialize current_count variables
-    current_count, current_count_vit, current_count_all, current_count_all_generated_token = 0, 0, 0, 0
-
-    if enable_vit_relevancy:
-        enc_attn_weights_vit = enc_attn_weights_vit[:-1] # last layer is not considered for llava
+    for map_type in map_types:
+        assert map_type in RELEVANCY_TYPES, f"Unknown relevancy map {map_type}, choose from {RELEVANCY_TYPES}"
+    wanted = set(range(num_generated_tokens) if token_indices is None else token_indices)
+    if not wanted:
+        return
+
+    need_llama = any(map_type != 'vit' for map_type in map_types)
+    need_vit = any(map_type != 'llama' for map_type in map_types)
+    enc_attn_weights_vit = []
+    if need_vit:
+        # the replay bypasses the vision feature cache, the vision tower runs with grad when its weights are kept
+        if not (len(model.enc_attn_weights_vit) > 0 and model.enc_attn_weights_vit[0].requires_grad):
+            raise ValueError("No ViT relevancy for this query (the vision tower attention was not kept), "
+                             "only the llama map is available")
+        enc_attn_weights_vit = model.enc_attn_weights_vit[:-1] # last layer is not considered for llava
         assert len(enc_attn_weights_vit) > 0
-
-    rel_maps_dict = {}
-    logger.debug(f'Number of output scores: {len(outputs.scores)}')
-    for target_index in range(len(outputs.scores)): #the last token is </s>
-        clean_tokens.append(tokens[target_index])
-        token_logits = outputs.scores[target_index]
-        token_id = torch.tensor(output_ids[target_index]).to(device)
-
-        # print out the token and its predicted id
-        #print(f'Token: {tokens[target_index]}, Predicted ID: {token_id}')
-        if token_id != output_ids[target_index]:
-            logger.warning(f'The token_id_max_score is not the same as the output_id')
-            # print the decoded token
-            logger.warning(f'Decoded Token: {tokenizer.decode(token_id)}')
-            logger.warning(f'The generated output: {tokens[target_index]}')
-        # check if the output_id is the same as the token_id
-        assert token_id == output_ids[target_index], "The token_id_max_score is not the same as the output_id"
-        
-
-        token_id_one_hot = torch.nn.functional.one_hot(token_id, num_classes=token_logits.size(-1)).float()
-        token_id_one_hot = token_id_one_hot.view(1, -1)
-        token_id_one_hot.requires_grad_(True)
-
-        # Compute loss and backpropagate to get gradients on attention weights
-        model.zero_grad()
-        token_logits.backward(gradient=token_id_one_hot, retain_graph=True)
-    
-        # initialize relevancy map for llama
-        R_i_i_init = torch.eye(enc_attn_weights[target_index][0].shape[-1], enc_attn_weights[target_index][0].shape[-1]).to(token_logits.device).float()
-        # compute relevancy map accourding to rule #6
-        R_i_i, privious_cam = handle_self_attention_image(R_i_i_init, enc_attn_weights[target_index], privious_cam)
-
-        if enable_vit_relevancy:
-            # initialize the vit relevancy map with the llama relevancy map
-            R_i_i_all = handle_self_attention_image_vit(R_i_i, enc_attn_weights_vit, img_idx, add_skip=False, normalize=False)
-            
-            # initialize using the relevancy map of the generated token to the image - option #1
-            R_i_i_init_vit_all = torch.eye(enc_attn_weights_vit[0].shape[-1], enc_attn_weights_vit[0].shape[-1]).to(token_logits.device).float()
-            
-            # add R_i_i[-1,:][img_idx:img_idx+576] to the first row and column of R_i_i_init_vit - option #2
-            R_i_i_init_vit_all[0,1:] = R_i_i_init_vit_all[0,1:] + R_i_i[-1,:][img_idx:img_idx+576]
-            R_i_i_init_vit_all[1:,0] = R_i_i_init_vit_all[1:,0] + R_i_i[-1,:][img_idx:img_idx+576]
-            R_i_i_all_generated_token = handle_self_attention_image_vit(R_i_i_init_vit_all, enc_attn_weights_vit)
-            
+    device = outputs.scores[-1].device
+    cam_history = CamHistory(num_self_att_layers)
+
+    attention_grads = batched_attention_grads(
+        outputs, output_ids, enc_attn_weights if need_llama else [[] for _ in enc_attn_weights], enc_attn_weights_vit,
+        memory_bytes=grad_memory_bytes, token_indices=range(max(wanted) + 1) if need_llama else wanted)
+    done = 0
+    for target_index, step_grads, vit_grads in attention_grads:
+        if target_index not in wanted:
+            # only the cams of this step, for the later tokens
+            handle_self_attention_image(None, enc_attn_weights[target_index], cam_history, grads=step_grads)
+            continue
+
+        rel_maps = {}
+        num_keys = attention_shape(enc_attn_weights[target_index][0])[-1]
+        if need_vit:
             # compute ViT relevancy map
-            R_i_i_init_vit = torch.eye(enc_attn_weights_vit[0].shape[-1], enc_attn_weights_vit[0].shape[-1]).to(token_logits.device).float()
-            R_i_i_vit = handle_self_attention_image_vit(R_i_i_init_vit, enc_attn_weights_vit)
+            R_i_i_vit = torch.zeros((1, attention_shape(enc_attn_weights_vit[0])[-1]), device=device)
+            R_i_i_vit[0, 0] = 1
+            R_i_i_vit = handle_self_attention_image_vit(R_i_i_vit, enc_attn_weights_vit, grads=vit_grads).to(device)
+        if need_llama:
+            rows = torch.zeros((1, num_keys), device=device)
+            rows[0, -1] = 1
+            if 'all' in map_types:
+                # the vit map initialized with the image block of the llama map - option #1: its row 0 is the vit
+                # row times that block, i.e. the vit row at the image positions propagated through the llama layers
+                image_row = torch.zeros((1, num_keys), device=device)
+                image_row[0, img_idx:img_idx+576] = R_i_i_vit[0, 1:]
+                rows = torch.cat((rows, image_row))
+            # compute relevancy map accourding to rule #6
+            rows = handle_self_attention_image(rows, enc_attn_weights[target_index], cam_history, grads=step_grads).to(device)
+            R_i_i = rows[:1]
+            if 'llama' in map_types:
+                if apply_normalization:
+                    rel_maps['llama'] = handle_residual_rows(R_i_i, [num_keys - 1])
+                else:
+                    rel_maps['llama'] = R_i_i.clone()
+                    rel_maps['llama'][0, -1] -= 1
+            if 'all' in map_types:
+                rel_maps['all'] = torch.cat((R_i_i_vit[:, :1], rows[1:, img_idx:img_idx+576]), dim=1)
+            if 'all_v2' in map_types:
+                # initialize using the relevancy map of the generated token to the image - option #2: eye with
+                # R_i_i[-1,:][img_idx:img_idx+576] added to its first row and column
+                token_image_rel = R_i_i[:, img_idx:img_idx+576]
+                rel_maps['all_v2'] = R_i_i_vit.clone()
+                rel_maps['all_v2'][:, 1:] += R_i_i_vit[:, :1] * token_image_rel
+                rel_maps['all_v2'][:, 0] += (R_i_i_vit[:, 1:] * token_image_rel).sum(dim=-1)
+        if 'vit' in map_types:
+            rel_maps['vit'] = R_i_i_vit
         if apply_normalization:
-            R_i_i = handle_residual(R_i_i)
-            if enable_vit_relevancy:
-                R_i_i_all = handle_residual(R_i_i_all)
-                R_i_i_vit = handle_residual(R_i_i_vit)
-                R_i_i_all_generated_token = handle_residual(R_i_i_all_generated_token)
-        else:
-            R_i_i = R_i_i - torch.eye(enc_attn_weights[target_index][0].shape[-1], enc_attn_weights[target_index][0].shape[-1]).to(token_logits.device).float()
-        
-        rel_maps.append(R_i_i)
-        if enable_vit_relevancy:
-            rel_maps_all.append(R_i_i_all)
-            rel_maps_vit.append(R_i_i_vit)
-            rel_maps_all_generated_token.append(R_i_i_all_generated_token)
-
-        # values should be rel_maps, and the keys should be the tokens
-        # check if this token already exsits
-        if tokens[target_index] in rel_maps_dict.keys():
-            tokens[target_index] = tokens[target_index] + '_'
-        rel_maps_dict[tokens[target_index]] = R_i_i
-
-        # If the token is a part of the current word, add its relevancy map to the current word's relevancy map
-        word_rel_maps_llama, current_rel_map, current_count, current_word = compute_word_rel_map(
-            tokens, target_index, R_i_i, SEPARATORS_LIST, 
-            current_rel_map, current_count, current_word, word_rel_maps_llama)
-        
-        if enable_vit_relevancy:
-            word_rel_maps_all, current_rel_map_all, current_count_all, current_word_all = compute_word_rel_map(
-                tokens, target_index, R_i_i_all, SEPARATORS_LIST, 
-                current_rel_map_all, current_count_all, current_word_all, word_rel_maps_all)
-            
-            word_rel_maps_vit, current_rel_map_vit, current_count_vit, current_word_vit = compute_word_rel_map(
-                tokens, target_index, R_i_i_vit, SEPARATORS_LIST, 
-                current_rel_map_vit, current_count_vit, current_word_vit, word_rel_maps_vit)
-            
-            word_rel_maps_all_generated_token, current_rel_map_all_generated_token, \
-                current_count_all_generated_token, current_word_all_generated_token = compute_word_rel_map(
-                    tokens, target_index, R_i_i_all_generated_token, SEPARATORS_LIST, 
-                    current_rel_map_all_generated_token, current_count_all_generated_token, 
-                    current_word_all_generated_token, word_rel_maps_all_generated_token
-            )
-
-        logger.debug(f'Current word: {current_word}')
-        
-    # Store the last word's relevancy map
-    word_rel_maps_llama[current_word] = current_rel_map / current_count
-
-    if enable_vit_relevancy:
-        word_rel_maps_all[current_word_all] = current_rel_map_all / current_count_all
-        word_rel_maps_vit[current_word_vit] = current_rel_map_vit / current_count_vit
-        word_rel_maps_all_generated_token[current_word_all_generated_token] = current_rel_map_all_generated_token / current_count_all_generated_token
-
-
-    word_rel_maps = {
-        "llama": word_rel_maps_llama,
-        "llama_token":rel_maps_dict,
-        "vit": word_rel_maps_vit,
-        "all": word_rel_maps_all,
-        "all_v2": word_rel_maps_all_generated_token
-    }
+            for map_type in ('vit', 'all', 'all_v2'):
+                if map_type in rel_maps:
+                    rel_maps[map_type] = handle_residual_rows(rel_maps[map_type], [0])
+
+        yield target_index, rel_maps
+        done += 1
+        if progress is not None:
+            progress(done, len(wanted))
 
+
+def construct_relevancy_map(tokenizer, model, input_ids, tokens, outputs, output_ids, img_idx, apply_normalization=True,
+                            grad_memory_bytes=DEFAULT_GRAD_MEMORY_BYTES):
+    '''Relevancy maps of every map type by word (and by token for llama) of all the generated tokens.'''
+    logger.debug('Tokens: %s', tokens)
+    assert len(tokens) == len(outputs.scores), f'Length of tokens {len(tokens)} is not equal to the length of outputs.scores {len(outputs.scores)}\ntokens: {tokens}'
+    # only when the vision tower attention was kept with grad
+    enable_vit_relevancy = len(model.enc_attn_weights_vit) > 0 and model.enc_attn_weights_vit[0].requires_grad
+    map_types = RELEVANCY_TYPES if enable_vit_relevancy else ('llama',)
+    token_rows = dict(token_relevancy_rows(model, outputs, output_ids, img_idx, map_types,
+                                           apply_normalization=apply_normalization, grad_memory_bytes=grad_memory_bytes))
+
+    word_rel_maps = {}
+    for map_type in RELEVANCY_TYPES:
+        rows = [token_rows[i].get(map_type) for i in range(len(tokens))]
+        word_rel_maps[map_type] = word_relevancy(tokens, rows)
+        if map_type == 'llama':
+            word_rel_maps['llama_token'] = word_relevancy(tokens, rows, by_token=True)
     return word_rel_maps
@@ -0,0 +1,108 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError
+
+from utils_cache import load_relevancy
+
+logger = logging.getLogger(__name__)
+
+
+class RelevancyJob:
+    '''Relevancy rows of `map_types` for the generated tokens `token_indices` of one query.'''
+    def __init__(self, attention_key, img_idx, map_types, token_indices):
+        self.attention_key = attention_key
+        self.img_idx = img_idx
+        self.map_types = tuple(map_types)
+        self.token_indices = sorted(set(token_indices))
+        self.future = Future()
+        self.created = time.time()
+        # (done, total, description), updated by the job while it runs
+        self.progress = (0, 0, 'Waiting for the relevancy jobs ahead')
+
+    def report(self, done, total, description):
+        self.progress = (done, total, description)
+
+    def fraction(self):
+        done, total, _ = self.progress
+        return done / total if total else 0.0
+
+    def covers(self, attention_key, map_types, token_indices):
+        return (attention_key == self.attention_key and set(map_types) <= set(self.map_types)
+                and set(token_indices) <= set(self.token_indices))
+
+
+class RelevancyService:
+    '''
+        Relevancy computed on demand, after the answer was returned: a background thread runs the jobs one at a
+        time with `run_job(job)` (the replay holds the model). A request only computes the (map type, token) rows
+        not stored yet, and waits for a queued or running job that already covers them.
+    '''
+    def __init__(self, run_job):
+        self.run_job = run_job
+        self._queue = queue.Queue()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def missing(self, attention_key, map_types, token_indices):
+        '''Tokens of `token_indices` without a stored row for one of `map_types`.'''
+        missing = set()
+        for map_type in map_types:
+            rows = load_relevancy(attention_key, map_type, token_indices)
+            missing.update(t for t, row in zip(token_indices, rows) if row is None)
+        return sorted(missing)
+
+    def request(self, attention_key, img_idx, map_types, token_indices):
+        '''Job computing the rows of `map_types` for `token_indices` that are missing, None if all are stored.'''
+        missing = self.missing(attention_key, map_types, list(token_indices))
+        if not missing:
+            return None
+        with self._lock:
+            for job in self._pending:
+                if job.covers(attention_key, map_types, missing):
+                    return job
+            job = RelevancyJob(attention_key, img_idx, map_types, missing)
+            self._pending.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='relevancy', daemon=True)
+                self._thread.start()
+        logger.info(f"Relevancy job ({', '.join(job.map_types)}) of {len(missing)} tokens queued for {attention_key}")
+        self._queue.put(job)
+        return job
+
+    def wait(self, job, progress=None, interval=0.25):
+        '''Block until `job` is done, re-raising its error, and call `progress(job)` meanwhile.'''
+        while True:
+            try:
+                return job.future.result(timeout=interval)
+            except TimeoutError:
+                if progress is not None:
+                    progress(job)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                # rows stored by an earlier job meanwhile are not computed again
+                job.token_indices = self.missing(job.attention_key, job.map_types, job.token_indices)
+                if job.token_indices:
+                    self.run_job(job)
+                job.future.set_result(job)
+            except Exception as e:
+                logger.exception(f"Relevancy job of {job.attention_key} failed")
+                job.future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._pending.remove(job)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending)}
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._queue.put(None)
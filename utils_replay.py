@@ -0,0 +1,125 @@
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
+
+import torch
+
+from utils_cache import load_input_ids, load_output_ids, load_pixel_values, save_relevancy
+from utils_artifacts import artifact_store
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _grad_from_embeddings(model):
+    '''
+        The weights do not require grad, the graph of the replay starts at the token and patch
+        embeddings instead: no gradient is accumulated into the parameters.
+    '''
+    def mark(module, inputs, output):
+        output.requires_grad_(True)
+
+    handles = [model.get_input_embeddings().register_forward_hook(mark),
+               model.vision_tower.vision_model.embeddings.register_forward_hook(mark)]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def replay_with_grad(model, input_ids, output_ids, pixel_values, progress=None, retain=('llama', 'vit')):
+    '''
+        Teacher-forced replay of a generation with grad enabled. The prompt is prefilled and the
+        stored output ids are fed back one step at a time through the KV cache, so the hooks keep
+        the same per step attention weights as during generate, linked to the logits by the graph.
+        Returns a namespace with `attentions` and `scores` (per step logits) shaped like the outputs
+        of model.generate, as construct_relevancy_map expects them. `progress(steps done)` after every step.
+        Only the towers in `retain` ('llama', 'vit') keep their weights in model.enc_attn_weights(_vit).
+    '''
+    model.enc_attn_weights = []
+    model.enc_attn_weights_vit = []
+    model.attn_capture = None
+    attentions, scores = [], []
+    offload = getattr(model, 'attention_offload', None)
+    model.attn_retain = tuple(retain)
+    with torch.enable_grad(), _grad_from_embeddings(model), offload.saved_tensors() if offload is not None else nullcontext():
+        outputs = model(input_ids=input_ids, pixel_values=pixel_values, use_cache=True,
+                        output_attentions=True, return_dict=True)
+        for step, token_id in enumerate(output_ids):
+            attentions.append(outputs.attentions)
+            scores.append(outputs.logits[:, -1, :])
+            if progress is not None:
+                progress(step + 1)
+            if step == len(output_ids) - 1:
+                break
+            next_ids = torch.tensor([[token_id]], dtype=input_ids.dtype, device=input_ids.device)
+            outputs = model(input_ids=next_ids, past_key_values=outputs.past_key_values, use_cache=True,
+                            output_attentions=True, return_dict=True)
+    model.attn_retain = ()
+    return SimpleNamespace(attentions=tuple(attentions), scores=tuple(scores))
+
+
+@torch.inference_mode()
+def replay_full_attention(model, input_ids, output_ids, pixel_values, capture=None):
+    '''
+        Full attention of a query from one teacher-forced forward over prompt + answer (the stored
+        output ids but the last one, whose row generate never computed). Returns a tuple over layers
+        of (1, heads, N, N) lower triangular blocks with N = expanded prompt length + len(output_ids) - 1,
+        the keys every row of the incremental decode would have seen. `capture` reduces the blocks
+        in the hooks as during generate.
+    '''
+    answer_ids = torch.tensor([output_ids[:-1]], dtype=input_ids.dtype, device=input_ids.device)
+    ids = torch.cat([input_ids, answer_ids], dim=-1)
+    model.attn_capture = capture
+    try:
+        outputs = model(input_ids=ids, pixel_values=pixel_values, use_cache=False,
+                        output_attentions=True, return_dict=True)
+    finally:
+        model.attn_capture = None
+    return outputs.attentions
+
+
+def compute_relevancy(model, attention_key, img_idx, map_types, token_indices, progress=None):
+    '''
+        Relevancy rows of `map_types` for the generated tokens `token_indices` of a query generated without
+        grad: replay it with grad from its stored input ids, output ids and pixel values up to the last of
+        these tokens, and add the rows to `<attention_key>_relevancy_<type>.pt`. Returns {type: {token: row}}.
+        `progress(done, total, description)` reports the replay and the tokens done.
+    '''
+    from utils_relevancy import token_relevancy_rows
+
+    pixel_values = load_pixel_values(attention_key)
+    if pixel_values is None:
+        raise ValueError(f"No pixel values stored for {attention_key}, the relevancy replay needs them")
+    input_ids = load_input_ids(attention_key).to(model.device)
+    token_indices = sorted(set(token_indices))
+    # later tokens do not change the relevancy of earlier ones
+    output_ids = load_output_ids(attention_key).reshape(-1).tolist()[:token_indices[-1] + 1]
+    pixel_values = pixel_values.to(model.device, model.dtype)
+    if progress is None:
+        progress = lambda done, total, description: None
+
+    start = time.time()
+    rows = dict((map_type, {}) for map_type in map_types)
+    try:
+        # the llama weights index the steps of every map type, the vit ones are only kept when a map uses them
+        retain = ('llama', 'vit') if any(map_type != 'llama' for map_type in map_types) else ('llama',)
+        outputs = replay_with_grad(model, input_ids, output_ids, pixel_values, retain=retain,
+                                   progress=lambda step: progress(step, len(output_ids), 'Replaying the query with gradients'))
+        for token_idx, rel_maps in token_relevancy_rows(
+                model, outputs, output_ids, img_idx, map_types, token_indices,
+                progress=lambda done, total: progress(done, total, f"Relevancy ({', '.join(map_types)}) of the generated tokens")):
+            for map_type, row in rel_maps.items():
+                rows[map_type][token_idx] = row.detach().cpu()
+    finally:
+        model.attn_retain = ()
+        model.enc_attn_weights = []
+        model.enc_attn_weights_vit = []
+    logger.info(f"Relevancy ({', '.join(map_types)}) of {len(token_indices)}/{len(output_ids)} tokens took {time.time() - start:.2f}s")
+
+    for map_type, type_rows in rows.items():
+        save_relevancy(attention_key, map_type, type_rows)
+    artifact_store.rescan(attention_key)
+    return rows
@@ -0,0 +1,123 @@
+import os
+import logging
+
+import numpy as np
+import torch
+
+from utils_cache import artifact_cache
+
+logger = logging.getLogger(__name__)
+
+NUM_IMAGE_TOKENS = 576
+# per (token, layer, head) statistics of the last query row of every generation step
+SUMMARY_FIELDS = ('image_mass', 'question_mass', 'question_max', 'text_mass', 'entropy', 'argmax_patch')
+
+
+def summary_path(attention_key):
+    return f'{attention_key}_summary.npz'
+
+
+class AttentionSummary:
+    '''
+        Capture mode that reduces the language model attention inside the hooks instead of
+        keeping it. For the last query row of every generation step it records, per layer and head,
+        the attention mass on the image patches, on the question and on all text keys, the
+        entropy of the row and the most attended patch, and keeps a running sum of the image
+        attention over all steps. The buffers are allocated once for `max_new_tokens` steps,
+        `reduce` returns None so nothing ends up in `outputs.attentions`.
+    '''
+    # the hooks do not keep the weights for the relevancy maps
+    retain = False
+
+    def __init__(self, policy, img_idx, num_prompt_ids, num_layers, max_new_tokens):
+        self.policy = policy
+        self.img_idx = img_idx
+        self.len_question = num_prompt_ids - img_idx - 1
+        self.num_layers = num_layers
+        self.max_steps = max(int(max_new_tokens), 1)
+        self.num_steps = 0
+        self.buffers = None
+        self.image_sum = None
+
+    def _allocate(self, num_heads, device):
+        shape = (self.max_steps, self.num_layers, num_heads)
+        self.buffers = dict((name, torch.zeros(shape, dtype=torch.float32, device=device)) for name in SUMMARY_FIELDS)
+        self.buffers['argmax_patch'] = torch.full(shape, -1, dtype=torch.int16, device=device)
+        self.image_sum = torch.zeros((self.num_layers, num_heads, NUM_IMAGE_TOKENS), dtype=torch.float32, device=device)
+
+    @torch.no_grad()
+    def reduce(self, layer_idx, attn, full_shape=None):
+        if layer_idx == 0:
+            if self.buffers is None:
+                self._allocate(attn.shape[1], attn.device)
+            self.num_steps += 1
+        step = self.num_steps - 1
+        if step >= self.max_steps:
+            return None
+        # (heads, keys), for step 0 the query of the last input id
+        row = attn[0, :, -1, :].float()
+        image_start = self.img_idx
+        question_start = image_start + NUM_IMAGE_TOKENS
+        image = row[:, image_start:question_start]
+        question = row[:, question_start:question_start + self.len_question]
+
+        buffers = self.buffers
+        buffers['image_mass'][step, layer_idx] = image.sum(-1)
+        buffers['text_mass'][step, layer_idx] = row.sum(-1) - buffers['image_mass'][step, layer_idx]
+        if question.shape[-1]:
+            buffers['question_mass'][step, layer_idx] = question.sum(-1)
+            buffers['question_max'][step, layer_idx] = question.amax(-1)
+        buffers['entropy'][step, layer_idx] = -(row * torch.log(row.clamp_min(1e-12))).sum(-1)
+        buffers['argmax_patch'][step, layer_idx] = image.argmax(-1).to(torch.int16)
+        self.image_sum[layer_idx] += image
+        return None
+
+    def finalize(self, num_tokens):
+        '''Summary of the first `num_tokens` generated tokens as numpy arrays.'''
+        num_tokens = min(num_tokens, self.num_steps, self.max_steps)
+        summary = dict((name, buffer[:num_tokens].cpu().numpy()) for name, buffer in self.buffers.items())
+        summary['image_sum'] = self.image_sum.cpu().numpy()
+        summary['num_tokens'] = np.array(num_tokens)
+        summary['len_question'] = np.array(self.len_question)
+        summary['img_idx'] = np.array(self.img_idx)
+        return summary
+
+    def meta(self):
+        return {'capture_policy': self.policy.to_string(), 'img_idx': self.img_idx}
+
+
+def write_attention_summary(attention_key, summary):
+    fn_summary = summary_path(attention_key)
+    np.savez(fn_summary + '.tmp.npz', **summary)
+    os.replace(fn_summary + '.tmp.npz', fn_summary)
+    logger.info(f"Attention summary saved to {fn_summary} ({int(summary['num_tokens'])} tokens)")
+
+
+def load_attention_summary(attention_key):
+    '''Dict of the summary arrays of a query captured in summary mode, None otherwise.'''
+    fn_summary = summary_path(attention_key)
+    if not os.path.exists(fn_summary):
+        return None
+
+    def loader():
+        with np.load(fn_summary) as f:
+            return dict((name, f[name]) for name in f.files)
+
+    return artifact_cache.get((attention_key, 'summary'), loader)
+
+
+def image_to_answer(summary):
+    '''(layers, heads) mean attention on a patch and (layers, heads, 576) mean image attention, over all tokens.'''
+    num_tokens = max(int(summary['num_tokens']), 1)
+    img_attn_mean = summary['image_mass'].sum(0) / (num_tokens * NUM_IMAGE_TOKENS)
+    img_attn_raw = summary['image_sum'] / num_tokens
+    return img_attn_mean, img_attn_raw
+
+
+def question_to_answer(summary):
+    '''(layers, heads) mean and max attention on a question token, over all tokens.'''
+    num_tokens = max(int(summary['num_tokens']), 1)
+    len_question = max(int(summary['len_question']), 1)
+    ques_attn_mean = summary['question_mass'].sum(0) / (num_tokens * len_question)
+    ques_attn_max = summary['question_max'].max(0)
+    return ques_attn_mean, ques_attn_max
@@ -0,0 +1,120 @@
+import os
+import hashlib
+import logging
+
+import torch
+
+from utils_cache import ArtifactCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VISION_CACHE_BYTES = 1 * 2**30
+
+
+def tensor_digest(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    digest = hashlib.sha256(tensor.numpy().tobytes())
+    digest.update(f'{tuple(tensor.shape)}{tensor.dtype}'.encode())
+    return digest.hexdigest()
+
+
+def _image_digest(image):
+    digest = hashlib.sha256(image.tobytes())
+    digest.update(f'{image.mode}{image.size}'.encode())
+    return digest.hexdigest()
+
+
+class VisionFeatureCache:
+    '''
+        Content addressed cache of what the vision side computes for an image: the preprocessed
+        `pixel_values` (keyed by the image) and the projected image features (keyed by the pixels).
+        Keys include `model_id`. Entries live in a byte-bounded LRU memory tier and, with `disk_dir`,
+        in an on-disk tier that survives restarts. `install` makes a model use it. Passes with grad
+        (the relevancy replay) bypass it, they need the graph through the vision tower. The vision tower
+        attention is not cached: generation keeps none, the replay recomputes it with its gradients.
+    '''
+    def __init__(self, model_id, max_bytes=DEFAULT_VISION_CACHE_BYTES, disk_dir=None):
+        self.model_id = model_id
+        self.memory = ArtifactCache(max_bytes)
+        self.disk_dir = disk_dir
+        self.disk_hits = 0
+        self.computed = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _key(self, kind, digest, *extra):
+        name = hashlib.sha256(f'{self.model_id}|{kind}|{digest}|{extra}'.encode()).hexdigest()
+        return (f'vision-{kind}', name)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key[0]}_{key[1]}.pt')
+
+    def _get(self, key, compute):
+        def loader():
+            value = self._load_disk(key)
+            if value is None:
+                value = compute()
+                self.computed += 1
+                self._save_disk(key, value)
+            return value
+        return self.memory.get(key, loader)
+
+    def pixel_values(self, image, compute):
+        '''(1, 3, H, W) pixel values of a PIL `image`, `compute()` runs the image processor on a miss.'''
+        key = self._key('pixels', _image_digest(image))
+        return self._get(key, lambda: compute().detach().cpu())
+
+    def image_features(self, model, original, pixel_values, vision_feature_layer, vision_feature_select_strategy):
+        '''Drop-in for model.get_image_features, looked up per image of the batch.'''
+        if torch.is_grad_enabled():
+            return original(pixel_values=pixel_values, vision_feature_layer=vision_feature_layer,
+                            vision_feature_select_strategy=vision_feature_select_strategy)
+        keys = [self._key('features', tensor_digest(pv), vision_feature_layer, vision_feature_select_strategy)
+                for pv in pixel_values]
+        cached = [self.memory.get(key, lambda key=key: self._load_disk(key)) for key in keys]
+        if all(entry is not None for entry in cached):
+            return torch.cat([entry['features'] for entry in cached]).to(model.device, model.dtype)
+
+        features = original(pixel_values=pixel_values, vision_feature_layer=vision_feature_layer,
+                            vision_feature_select_strategy=vision_feature_select_strategy)
+        self.computed += 1
+        for b, key in enumerate(keys):
+            entry = {'features': features[b:b+1].detach().cpu()}
+            self._save_disk(key, entry)
+            self.memory.put(key, entry)
+        return features
+
+    def _load_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        fn = self._disk_path(key)
+        if not os.path.exists(fn):
+            return None
+        self.disk_hits += 1
+        return torch.load(fn, weights_only=True)
+
+    def _save_disk(self, key, value):
+        if self.disk_dir is None:
+            return
+        fn = self._disk_path(key)
+        torch.save(value, fn + '.tmp')
+        os.replace(fn + '.tmp', fn)
+
+    def install(self, model):
+        '''Route the image features of `model.forward` through the cache.'''
+        original = model.get_image_features
+
+        def get_image_features(pixel_values, vision_feature_layer, vision_feature_select_strategy):
+            return self.image_features(model, original, pixel_values, vision_feature_layer, vision_feature_select_strategy)
+
+        model.get_image_features = get_image_features
+        model.vision_cache = self
+        logger.info(f"Vision feature cache installed ({self.memory.max_bytes/2**20:.0f} MiB in memory, disk: {self.disk_dir})")
+        return self
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update({'disk_hits': self.disk_hits, 'computed': self.computed})
+        return stats
@@ -0,0 +1,232 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+import torch
+
+from utils_backend import pin_process
+
+logger = logging.getLogger(__name__)
+
+# set in a worker process, sends an event to the `on_event` callback of the pool in the parent
+_notify = None
+
+
+def notify(event):
+    '''Send `event` from a worker process to the pool in the parent, a no-op in the parent.'''
+    if _notify is not None:
+        _notify(event)
+
+
+class _Job:
+    def __init__(self, job_id, item):
+        self.job_id = job_id
+        self.item = item
+        self.future = Future()
+        self.arrival = time.time()
+
+
+class _Worker:
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.job = None
+        self.jobs = 0
+        self.busy_time = 0.0
+        self.alive = True
+        self.started = None
+
+
+def _worker_main(index, conn, run_job, num_threads, initializer, initargs, cores=None):
+    global _notify
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    _notify = lambda event: send(('event', None, event))
+    # before any parallel work of this process, the thread pools are sized and pinned once
+    if cores:
+        pin_process(cores)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception as e:
+            logger.exception(f"Model worker {index} failed to start")
+            send(('failed', None, f'{type(e).__name__}: {e}'))
+            return
+    logger.info(f"Model worker {index} (pid {os.getpid()}) ready with {torch.get_num_threads()} threads")
+    send(('ready', None, None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        job_id, item = message
+        try:
+            result = run_job(item)
+        except Exception as e:
+            logger.exception(f"Model worker {index} failed job {job_id}")
+            send(('error', job_id, f'{type(e).__name__}: {e}'))
+        else:
+            send(('result', job_id, result))
+
+
+class ModelWorkerPool:
+    '''
+        `num_workers` spawned processes, each set up by `initializer(*initargs)`, which loads the model
+        with its weights memory-mapped from a file, shared by all workers instead of being held N times.
+        Spawned rather than forked: the parent has threads (server, loader, writers) and OpenMP pools by
+        then, whose locks a forked child would inherit in whatever state they were. Jobs are queued and
+        dispatched to workers that reported ready, which call `run_job(item)`. `run_job` and the
+        initializer are pickled by reference, items and results by value, so they should be small:
+        workers keep the tensors to themselves and write artifacts to disk, returning references (keys).
+        `on_event(event)` receives what workers send with `notify`, e.g. that the artifacts of a key are written.
+        Every worker runs with `threads_per_worker` intra-op threads (default: cores / workers),
+        with `cores` every worker is pinned to its own slice of them.
+    '''
+    def __init__(self, run_job, num_workers=2, threads_per_worker=None, on_event=None, initializer=None,
+                 initargs=(), cores=None, name='model-worker'):
+        self.num_workers = max(int(num_workers), 1)
+        num_cores = len(cores) if cores else os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(num_cores // self.num_workers, 1)
+        self.on_event = on_event
+        self.name = name
+        self._jobs = queue.Queue()
+        self._idle = queue.Queue()
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+        self._closed = False
+        self._started = time.time()
+        self._stats = {'jobs': 0, 'failed_jobs': 0, 'wait_time': 0.0}
+
+        context = multiprocessing.get_context('spawn')
+        self.workers = []
+        for index in range(self.num_workers):
+            worker_cores = None
+            if cores:
+                worker_cores = cores[index * self.threads_per_worker:(index + 1) * self.threads_per_worker] or None
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main, name=f'{name}-{index}', daemon=True,
+                args=(index, child_conn, run_job, self.threads_per_worker, initializer, initargs, worker_cores),
+            )
+            process.start()
+            child_conn.close()
+            worker = _Worker(index, process, parent_conn)
+            self.workers.append(worker)
+            # idle once it reports ready
+            threading.Thread(target=self._read, args=(worker,), name=f'{name}-{index}-reader', daemon=True).start()
+        self._dispatcher = threading.Thread(target=self._dispatch, name=f'{name}-dispatcher', daemon=True)
+        self._dispatcher.start()
+        logger.info(f"Starting {self.num_workers} model workers with {self.threads_per_worker} threads each")
+
+    def submit(self, item):
+        if self._closed:
+            raise RuntimeError("Model worker pool is closed")
+        with self._id_lock:
+            job = _Job(self._next_id, item)
+            self._next_id += 1
+        self._jobs.put(job)
+        return job.future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _dispatch(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            worker = self._idle.get()
+            if worker is None:
+                job.future.set_exception(RuntimeError("Model worker pool is closed"))
+                while True:
+                    try:
+                        job = self._jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    if job is not None:
+                        job.future.set_exception(RuntimeError("Model worker pool is closed"))
+            self._stats['wait_time'] += time.time() - job.arrival
+            worker.job = job
+            worker.started = time.time()
+            try:
+                worker.conn.send((job.job_id, job.item))
+            except (OSError, ValueError) as e:
+                worker.job = None
+                job.future.set_exception(RuntimeError(f"Model worker {worker.index} is gone: {e}"))
+
+    def _read(self, worker):
+        while True:
+            try:
+                kind, job_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.alive = False
+                if worker.job is not None:
+                    worker.job.future.set_exception(RuntimeError(f"Model worker {worker.index} exited"))
+                if not self._closed:
+                    logger.error(f"Model worker {worker.index} exited with code {worker.process.exitcode}")
+                    if not any(w.alive for w in self.workers):
+                        # nothing would ever pick the queued jobs up
+                        self._closed = True
+                        self._idle.put(None)
+                return
+            if kind == 'ready':
+                self._idle.put(worker)
+                continue
+            if kind == 'failed':
+                logger.error(f"Model worker {worker.index} failed to start: {payload}")
+                continue
+            if kind == 'event':
+                if self.on_event is not None:
+                    try:
+                        self.on_event(payload)
+                    except Exception:
+                        logger.exception(f"Handling the event {payload} of model worker {worker.index} failed")
+                continue
+            job, worker.job = worker.job, None
+            worker.jobs += 1
+            worker.busy_time += time.time() - worker.started
+            self._stats['jobs'] += 1
+            if kind == 'error':
+                self._stats['failed_jobs'] += 1
+                job.future.set_exception(RuntimeError(payload))
+            else:
+                job.future.set_result(payload)
+            self._idle.put(worker)
+
+    def close(self):
+        self._closed = True
+        self._jobs.put(None)
+        self._idle.put(None)
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def stats(self):
+        stats = dict(self._stats)
+        elapsed = time.time() - self._started
+        stats['alive_workers'] = sum(1 for w in self.workers if w.alive)
+        stats['busy_workers'] = sum(1 for w in self.workers if w.job is not None)
+        stats['queued_jobs'] = self._jobs.qsize()
+        stats['mean_wait'] = stats['wait_time'] / stats['jobs'] if stats['jobs'] else 0.0
+        stats['utilization'] = [round(w.busy_time / elapsed, 3) for w in self.workers]
+        stats['jobs_per_second'] = stats['jobs'] / elapsed
+        return stats